@@ -0,0 +1,155 @@
+"""Admission control in front of the upstream providers.
+
+Every provider and every upstream account has a concurrency limit with a bounded wait queue. Waiters are served
+oldest first, non-stream requests get a head start of NONSTREAM_PRIORITY_BOOST seconds so short calls like
+title generation don't wait behind long generations, without starving streams. Batch requests queue
+BATCH_PRIORITY_DELAY seconds behind interactive ones, so bulk jobs only use capacity nobody is waiting for. A request is rejected with 429
+and Retry-After as soon as its estimated queue time would exceed ADMISSION_DEADLINE.
+
+Limits are per worker process, divide the upstream budget by WORKERS when running several.
+"""
+
+import asyncio
+import hashlib
+import heapq
+import itertools
+import math
+import os
+import time
+from fastapi import HTTPException
+from metrics import ADMISSION_REJECTIONS, QUEUE_DEPTH, QUEUE_TIME
+
+HOLD_TIME_SMOOTHING = 0.2
+
+
+def _env_number(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def account_id(secret: str) -> str:
+    """Stable label for an account credential that doesn't leak it into metrics."""
+    return hashlib.sha256(secret.encode()).hexdigest()[:12]
+
+
+def too_many_requests(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(max(math.ceil(retry_after), 1))})
+
+
+class AdmissionQueue:
+    def __init__(self, name: str, limit: int, max_queue: int):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.queued = 0
+        # moving average of how long a slot is held, unknown until the first release
+        self.hold_time: float | None = None
+        self.waiters: list[tuple[float, int, asyncio.Future]] = []
+        self.sequence = itertools.count()
+
+    def estimated_wait(self) -> float:
+        if self.hold_time is None or (self.active < self.limit and not self.queued):
+            return 0.0
+        return (self.queued + 1) / self.limit * self.hold_time
+
+    async def acquire(self, priority_boost: float, deadline: float) -> None:
+        if self.active < self.limit and not self.queued:
+            self.active += 1
+            return
+
+        estimated_wait = self.estimated_wait()
+        if self.queued >= self.max_queue:
+            ADMISSION_REJECTIONS.labels(self.name, "queue_full").inc()
+            raise too_many_requests(f"{self.name} is at capacity, please retry", estimated_wait)
+        if estimated_wait > deadline:
+            ADMISSION_REJECTIONS.labels(self.name, "deadline").inc()
+            raise too_many_requests(f"{self.name} is at capacity, please retry", estimated_wait)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (time.monotonic() - priority_boost, next(self.sequence), future))
+        self.queued += 1
+        QUEUE_DEPTH.labels(self.name).inc()
+        try:
+            await asyncio.wait_for(future, deadline)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # the slot was handed over while we were giving up
+                self.release(0.0)
+            else:
+                future.cancel()
+                self.queued -= 1
+                QUEUE_DEPTH.labels(self.name).dec()
+            if isinstance(e, asyncio.TimeoutError):
+                ADMISSION_REJECTIONS.labels(self.name, "timeout").inc()
+                raise too_many_requests(f"{self.name} is at capacity, please retry", self.estimated_wait())
+            raise
+
+    def release(self, hold_time: float) -> None:
+        self.active -= 1
+        if hold_time > 0:
+            if self.hold_time is None:
+                self.hold_time = hold_time
+            else:
+                self.hold_time += HOLD_TIME_SMOOTHING * (hold_time - self.hold_time)
+        while self.active < self.limit and self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if future.done():
+                continue
+            self.active += 1
+            self.queued -= 1
+            QUEUE_DEPTH.labels(self.name).dec()
+            future.set_result(None)
+
+
+class AdmissionLease:
+    """Slots held by one request, release() is idempotent so every exit path can call it."""
+
+    def __init__(self, queues: list[AdmissionQueue]):
+        self.queues = queues
+        self.acquired_at = time.monotonic()
+
+    def release(self) -> None:
+        hold_time = time.monotonic() - self.acquired_at
+        while self.queues:
+            self.queues.pop().release(hold_time)
+
+
+class AdmissionController:
+    def __init__(self):
+        self.queues: dict[str, AdmissionQueue] = {}
+
+    def _get_queue(self, name: str, limit_env: str, default_limit: int) -> AdmissionQueue:
+        if name not in self.queues:
+            limit = int(os.environ.get(limit_env, default_limit))
+            max_queue = int(os.environ.get("ADMISSION_QUEUE_SIZE", 64))
+            self.queues[name] = AdmissionQueue(name, limit, max_queue)
+        return self.queues[name]
+
+    async def acquire(
+        self, provider: str, account: str | None = None, stream: bool = True, background: bool = False
+    ) -> AdmissionLease:
+        """Waits for a provider slot and then an account slot, DEEPSEEK_WEB_CONCURRENCY style variables override
+        PROVIDER_CONCURRENCY per provider."""
+        deadline = _env_number("ADMISSION_DEADLINE", 10)
+        priority_boost = 0.0 if stream else _env_number("NONSTREAM_PRIORITY_BOOST", 5)
+        if background:
+            priority_boost = -_env_number("BATCH_PRIORITY_DELAY", 30)
+        default_limit = int(os.environ.get("PROVIDER_CONCURRENCY", 8))
+        queues = [self._get_queue(provider, f"{provider.upper()}_CONCURRENCY", default_limit)]
+        if account is not None:
+            queues.append(self._get_queue(f"{provider}:{account}", "ACCOUNT_CONCURRENCY", 4))
+
+        priority = "batch" if background else "stream" if stream else "non_stream"
+        start = time.perf_counter()
+        lease = AdmissionLease([])
+        try:
+            for queue in queues:
+                await queue.acquire(priority_boost, max(deadline - (time.perf_counter() - start), 0.001))
+                lease.queues.append(queue)
+        except BaseException:
+            for queue in lease.queues:
+                queue.release(0.0)
+            raise
+        QUEUE_TIME.labels(provider, priority).observe(time.perf_counter() - start)
+        lease.acquired_at = time.monotonic()
+        return lease
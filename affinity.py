@@ -0,0 +1,87 @@
+"""Maps a conversation prefix to the upstream chat session that already holds it.
+
+After a completed answer the whole transcript, the answer included, is hashed and stored with the upstream session id
+and the id of the answer message. The next turn of NextChat sends that transcript back plus one new user message, so
+its prefix hashes to the same key and only the new message has to go upstream as a continuation. Anything that does
+not match (an edited message, another worker, an expired entry) falls back to sending the full history.
+"""
+
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Callable
+from fastapi.encoders import jsonable_encoder
+from schemas import Message
+
+
+class ConversationAffinity:
+    """LRU of prefix hash -> (session id, parent message id), a session is released once no entry refers to it."""
+
+    def __init__(self, max_entries: int, ttl: float, on_release: Callable[[str], None] | None = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_release = on_release
+        self.entries: OrderedDict[str, tuple[float, str, object]] = OrderedDict()
+        self.session_refs: dict[str, int] = {}
+
+    @staticmethod
+    def make_key(model: str, messages: list[Message]) -> str:
+        canonical = json.dumps(
+            [model] + [[message.role, jsonable_encoder(message.content)] for message in messages],
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _delete(self, key: str) -> None:
+        _, session_id, _ = self.entries.pop(key)
+        self.session_refs[session_id] -= 1
+        if self.session_refs[session_id] == 0:
+            del self.session_refs[session_id]
+            if self.on_release is not None:
+                self.on_release(session_id)
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self.entries and next(iter(self.entries.values()))[0] < now:
+            self._delete(next(iter(self.entries)))
+
+    def get(self, key: str) -> tuple[str, object] | None:
+        self._expire()
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        # a turn refreshes its prefix, long running conversations stay warm
+        self.entries[key] = (time.monotonic() + self.ttl, entry[1], entry[2])
+        self.entries.move_to_end(key)
+        return entry[1], entry[2]
+
+    def set(self, key: str, session_id: str, message_id: object) -> None:
+        if key in self.entries:
+            self._delete(key)
+        self.session_refs[session_id] = self.session_refs.get(session_id, 0) + 1
+        self.entries[key] = (time.monotonic() + self.ttl, session_id, message_id)
+        self._expire()
+        while len(self.entries) > self.max_entries:
+            self._delete(next(iter(self.entries)))
+
+    def discard(self, session_id: str) -> None:
+        """Forgets every entry of a session the upstream no longer accepts."""
+        for key in [key for key, entry in self.entries.items() if entry[1] == session_id]:
+            self._delete(key)
+
+    def holds(self, session_id: str) -> bool:
+        return session_id in self.session_refs
+
+
+def create_conversation_affinity(on_release: Callable[[str], None] | None = None) -> ConversationAffinity | None:
+    """CONVERSATION_AFFINITY_ENABLED=false always sends the full history."""
+    if os.environ.get("CONVERSATION_AFFINITY_ENABLED", "true").lower() != "true":
+        return None
+    return ConversationAffinity(
+        max_entries=int(os.environ.get("CONVERSATION_AFFINITY_MAX_ENTRIES", 1024)),
+        ttl=float(os.environ.get("CONVERSATION_AFFINITY_TTL", 1800)),
+        on_release=on_release,
+    )
@@ -0,0 +1,412 @@
+"""OpenAI style batch API: a JSONL file of chat completion requests processed offline from a durable queue.
+
+Uploaded files and batches live under BATCH_DIR (data/batches by default), the queue is a SQLite database next to
+them. Every request line is a row that a worker claims with a lease, at most BATCH_CONCURRENCY lines run at once per
+worker and each goes through the router like an interactive request, so provider and account limits, failover and
+circuit breakers apply. Batch lines queue BATCH_PRIORITY_DELAY seconds behind interactive traffic for a slot.
+
+A line that fails with a retryable error (429, 5xx, timeouts) is retried up to BATCH_MAX_ATTEMPTS times with
+backoff, others go to the error file at once. Results are appended to the output file as lines finish and the
+database records each finished line, so after a restart only unfinished lines run again. A shutdown hands running
+lines back right away, lines held by a worker that crashed are claimed again once their lease of BATCH_LINE_TIMEOUT
+plus a minute expires. When the last line is done the output
+and error files are rewritten from the database, one line per request in input order.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Awaitable, Callable
+from fastapi import HTTPException
+from logger import get_logger
+from metrics import BATCH_LINES
+
+logger = get_logger("batches")
+
+ENDPOINTS = ("/v1/chat/completions",)
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+MAX_BACKOFF = 300
+# a file that is not a batch input is not worth reporting more than this many problems for
+MAX_VALIDATION_ERRORS = 20
+
+
+class BatchQueue:
+    """Files, batches and their request lines in SQLite, every method blocks and is meant for asyncio.to_thread."""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / "batches.db"
+        self._local = threading.local()
+        with self._connection as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS files (id TEXT PRIMARY KEY, purpose TEXT, filename TEXT, bytes INTEGER,"
+                " created_at INTEGER)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS batches (id TEXT PRIMARY KEY, endpoint TEXT, input_file_id TEXT,"
+                " completion_window TEXT, status TEXT, output_file_id TEXT, error_file_id TEXT, errors TEXT,"
+                " metadata TEXT, created_at INTEGER, in_progress_at INTEGER, finalizing_at INTEGER,"
+                " completed_at INTEGER, failed_at INTEGER, cancelling_at INTEGER, cancelled_at INTEGER,"
+                " finalize_lease_until REAL)"
+            )
+            try:
+                # databases created before the finalizing lease had its own column
+                connection.execute("ALTER TABLE batches ADD COLUMN finalize_lease_until REAL")
+            except sqlite3.OperationalError:
+                pass
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS lines (batch_id TEXT, line INTEGER, custom_id TEXT, body TEXT,"
+                " status TEXT, attempts INTEGER DEFAULT 0, not_before REAL DEFAULT 0, lease_until REAL,"
+                " result TEXT, PRIMARY KEY (batch_id, line))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS lines_status ON lines (status, not_before)")
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            self._local.connection = connection
+        return connection
+
+    def file_path(self, file_id: str) -> Path:
+        return self.directory / f"{file_id}.jsonl"
+
+    def add_file(self, file_id: str, purpose: str, filename: str) -> dict:
+        size = self.file_path(file_id).stat().st_size
+        with self._connection as connection:
+            connection.execute(
+                "INSERT INTO files (id, purpose, filename, bytes, created_at) VALUES (?, ?, ?, ?, ?)",
+                (file_id, purpose, filename, size, int(time.time())),
+            )
+        return self.get_file(file_id)
+
+    def get_file(self, file_id: str) -> dict | None:
+        row = self._connection.execute("SELECT * FROM files WHERE id = ?", (file_id,)).fetchone()
+        if row is None:
+            return None
+        return {"object": "file", **dict(row)}
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str, metadata: dict | None) -> dict:
+        lines = []
+        errors = []
+        custom_ids = set()
+        with open(self.file_path(input_file_id), "rb") as file:
+            for line, raw_line in enumerate(file, start=1):
+                if not raw_line.strip():
+                    continue
+                try:
+                    request = json.loads(raw_line)
+                    custom_id = request["custom_id"]
+                    if request.get("method", "POST") != "POST" or request["url"] != endpoint:
+                        raise ValueError(f"url must be {endpoint} and method POST")
+                    if custom_id in custom_ids:
+                        raise ValueError(f"duplicate custom_id {custom_id}")
+                    if not isinstance(request["body"], dict):
+                        raise ValueError("body must be an object")
+                except (ValueError, KeyError, TypeError) as e:
+                    errors.append({"code": "invalid_request", "message": f"{e!r}", "line": line})
+                    if len(errors) >= MAX_VALIDATION_ERRORS:
+                        break
+                    continue
+                custom_ids.add(custom_id)
+                lines.append((custom_id, json.dumps(request["body"], ensure_ascii=False)))
+        if not lines and not errors:
+            errors.append({"code": "empty_file", "message": "The input file has no requests", "line": None})
+
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        now = int(time.time())
+        with self._connection as connection:
+            connection.execute(
+                "INSERT INTO batches (id, endpoint, input_file_id, completion_window, status, errors, metadata,"
+                " created_at, in_progress_at, failed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    batch_id,
+                    endpoint,
+                    input_file_id,
+                    completion_window,
+                    "failed" if errors else "in_progress",
+                    json.dumps({"object": "list", "data": errors}) if errors else None,
+                    json.dumps(metadata) if metadata is not None else None,
+                    now,
+                    None if errors else now,
+                    now if errors else None,
+                ),
+            )
+            if not errors:
+                connection.executemany(
+                    "INSERT INTO lines (batch_id, line, custom_id, body, status) VALUES (?, ?, ?, ?, 'pending')",
+                    [(batch_id, index, custom_id, body) for index, (custom_id, body) in enumerate(lines)],
+                )
+        return self.get_batch(batch_id)
+
+    def get_batch(self, batch_id: str) -> dict | None:
+        row = self._connection.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        if row is None:
+            return None
+        counts = dict(
+            self._connection.execute(
+                "SELECT status, COUNT(*) FROM lines WHERE batch_id = ? GROUP BY status", (batch_id,)
+            ).fetchall()
+        )
+        batch = dict(row)
+        del batch["finalize_lease_until"]
+        batch["errors"] = json.loads(batch["errors"]) if batch["errors"] else None
+        batch["metadata"] = json.loads(batch["metadata"]) if batch["metadata"] else None
+        return {
+            "object": "batch",
+            **batch,
+            "request_counts": {
+                "total": sum(counts.values()),
+                "completed": counts.get("completed", 0),
+                "failed": counts.get("failed", 0),
+            },
+        }
+
+    def list_batches(self, limit: int, after: str | None) -> list[dict]:
+        rows = self._connection.execute(
+            "SELECT id FROM batches WHERE ? IS NULL OR created_at < (SELECT created_at FROM batches WHERE id = ?)"
+            " ORDER BY created_at DESC, id DESC LIMIT ?",
+            (after, after, limit),
+        ).fetchall()
+        return [self.get_batch(row["id"]) for row in rows]
+
+    def cancel_batch(self, batch_id: str) -> dict | None:
+        with self._connection as connection:
+            connection.execute(
+                "UPDATE batches SET status = 'cancelling', cancelling_at = ? WHERE id = ? AND status = 'in_progress'",
+                (int(time.time()), batch_id),
+            )
+        return self.get_batch(batch_id)
+
+    def claim(self, limit: int, lease: float) -> list[sqlite3.Row]:
+        """Takes up to limit runnable lines, oldest batch first, including lines whose worker's lease ran out."""
+        now = time.time()
+        with self._connection as connection:
+            return connection.execute(
+                "UPDATE lines SET status = 'running', attempts = attempts + 1, lease_until = ?"
+                " WHERE rowid IN (SELECT lines.rowid FROM lines JOIN batches ON batches.id = lines.batch_id"
+                "   WHERE batches.status = 'in_progress' AND ((lines.status = 'pending' AND lines.not_before <= ?)"
+                "   OR (lines.status = 'running' AND lines.lease_until < ?))"
+                "   ORDER BY batches.created_at, lines.line LIMIT ?)"
+                " RETURNING batch_id, line, custom_id, body, attempts",
+                (now + lease, now, now, limit),
+            ).fetchall()
+
+    def finish(self, batch_id: str, line: int, status: str, result: dict) -> None:
+        """Records a finished line, then appends it to the output or error file of the batch."""
+        result_line = json.dumps(result, ensure_ascii=False)
+        with self._connection as connection:
+            connection.execute(
+                "UPDATE lines SET status = ?, result = ?, lease_until = NULL WHERE batch_id = ? AND line = ?",
+                (status, result_line, batch_id, line),
+            )
+        # a crash right here loses the append only, the final rewrite restores the line from the database
+        suffix = "output" if status == "completed" else "error"
+        with open(self.directory / f"{batch_id}_{suffix}.jsonl", "ab") as file:
+            file.write(f"{result_line}\n".encode())
+
+    def retry(self, batch_id: str, line: int, not_before: float) -> None:
+        with self._connection as connection:
+            connection.execute(
+                "UPDATE lines SET status = 'pending', not_before = ?, lease_until = NULL WHERE batch_id = ? AND line = ?",
+                (not_before, batch_id, line),
+            )
+
+    def release(self, batch_id: str, line: int) -> None:
+        """Gives back a line interrupted by a shutdown, without counting the attempt."""
+        with self._connection as connection:
+            connection.execute(
+                "UPDATE lines SET status = 'pending', attempts = attempts - 1, lease_until = NULL"
+                " WHERE batch_id = ? AND line = ? AND status = 'running'",
+                (batch_id, line),
+            )
+
+    def finalize_ready(self, lease: float) -> list[str]:
+        """Batches with no line left to run, moved to finalizing by exactly one worker.
+
+        A batch whose finalizing worker died is taken over once lease seconds have passed.
+        """
+        now = time.time()
+        finalized = []
+        rows = self._connection.execute(
+            "SELECT id, status, finalize_lease_until FROM batches WHERE (status IN ('in_progress', 'cancelling') AND NOT EXISTS"
+            " (SELECT 1 FROM lines WHERE batch_id = batches.id AND ((status = 'pending' AND batches.status = 'in_progress')"
+            # a running line of a crashed worker is claimed again, it only stops blocking once the batch is cancelled
+            "  OR (status = 'running' AND (batches.status = 'in_progress' OR lease_until >= ?)))))"
+            " OR (status = 'finalizing' AND finalize_lease_until < ?)",
+            (now, now),
+        ).fetchall()
+        for row in rows:
+            with self._connection as connection:
+                cursor = connection.execute(
+                    "UPDATE batches SET status = 'finalizing', finalizing_at = ?, finalize_lease_until = ? WHERE id = ?"
+                    " AND status = ? AND finalize_lease_until IS ?",
+                    (int(now), now + lease, row["id"], row["status"], row["finalize_lease_until"]),
+                )
+            if cursor.rowcount == 1:
+                finalized.append(row["id"])
+        return finalized
+
+    def write_results(self, batch_id: str) -> None:
+        """Rewrites the output and error files from the database and registers them as files."""
+        file_ids = {}
+        for status, suffix, column in (("completed", "output", "output_file_id"), ("failed", "error", "error_file_id")):
+            rows = self._connection.execute(
+                "SELECT result FROM lines WHERE batch_id = ? AND status = ? ORDER BY line", (batch_id, status)
+            )
+            file_id = f"file-{uuid.uuid4().hex}"
+            path = self.file_path(file_id)
+            count = 0
+            with open(path, "wb") as file:
+                for row in rows:
+                    file.write(f"{row['result']}\n".encode())
+                    count += 1
+            if count:
+                self.add_file(file_id, f"batch_{suffix}", f"{batch_id}_{suffix}.jsonl")
+                file_ids[column] = file_id
+            else:
+                path.unlink()
+            (self.directory / f"{batch_id}_{suffix}.jsonl").unlink(missing_ok=True)
+
+        row = self._connection.execute("SELECT cancelling_at FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        status, column = ("completed", "completed_at") if row["cancelling_at"] is None else ("cancelled", "cancelled_at")
+        with self._connection as connection:
+            connection.execute(
+                f"UPDATE batches SET status = ?, {column} = ?, output_file_id = ?, error_file_id = ? WHERE id = ?",
+                (status, int(time.time()), file_ids.get("output_file_id"), file_ids.get("error_file_id"), batch_id),
+            )
+
+
+def _error_result(custom_id: str, status_code: int, message: str) -> dict:
+    return {
+        "id": f"batch_req_{uuid.uuid4().hex}",
+        "custom_id": custom_id,
+        "response": {"status_code": status_code, "request_id": None, "body": {"error": {"message": message}}},
+        "error": {"code": str(status_code), "message": message},
+    }
+
+
+def _retry_delay(retry_after: str | None, attempts: int) -> float:
+    """Seconds or HTTP date of a Retry-After header, exponential backoff when it is missing or unreadable."""
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0), MAX_BACKOFF)
+        except ValueError:
+            pass
+        try:
+            return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0), MAX_BACKOFF)
+        except (TypeError, ValueError):
+            pass
+    return min(2**attempts, MAX_BACKOFF)
+
+
+class BatchRunner:
+    """Claims lines from the queue and runs them through complete(), which returns the completion body of a line."""
+
+    def __init__(
+        self,
+        queue: BatchQueue,
+        complete: Callable[[bytes], Awaitable[dict]],
+        concurrency: int,
+        max_attempts: int,
+        line_timeout: float,
+        poll_interval: float,
+    ):
+        self.queue = queue
+        self.complete = complete
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.line_timeout = line_timeout
+        self.poll_interval = poll_interval
+        self.running: set[asyncio.Task] = set()
+        self.wakeup = asyncio.Event()
+
+    def notify(self) -> None:
+        self.wakeup.set()
+
+    async def run(self) -> None:
+        try:
+            while True:
+                self.wakeup.clear()
+                try:
+                    for batch_id in await asyncio.to_thread(self.queue.finalize_ready, self.line_timeout):
+                        await asyncio.to_thread(self.queue.write_results, batch_id)
+                        logger.info("Batch %s finished", batch_id)
+                    free = self.concurrency - len(self.running)
+                    lines = await asyncio.to_thread(self.queue.claim, free, self.line_timeout + 60) if free else []
+                except (sqlite3.Error, OSError) as e:
+                    logger.warning("Batch queue failed: %r", e)
+                    lines = []
+                for line in lines:
+                    task = asyncio.create_task(self._run_line(line))
+                    self.running.add(task)
+                    task.add_done_callback(self._line_done)
+                # other workers' batches and retries become runnable without a local wakeup
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in self.running:
+                task.cancel()
+
+    def _line_done(self, task: asyncio.Task) -> None:
+        self.running.discard(task)
+        self.wakeup.set()
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Batch line failed unexpectedly: %r", task.exception())
+
+    async def _run_line(self, line: sqlite3.Row) -> None:
+        try:
+            body = await asyncio.wait_for(self.complete(line["body"].encode()), self.line_timeout)
+        except asyncio.CancelledError:
+            # blocking on purpose, the event loop is shutting down and the next start should not wait for the lease
+            self.queue.release(line["batch_id"], line["line"])
+            raise
+        except asyncio.TimeoutError:
+            error = HTTPException(status_code=504, detail=f"Request timed out after {self.line_timeout:g} seconds")
+        except HTTPException as e:
+            error = e
+        except Exception as e:
+            error = HTTPException(status_code=500, detail=repr(e))
+        else:
+            result = {
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": line["custom_id"],
+                "response": {"status_code": 200, "request_id": body.get("id"), "body": body},
+                "error": None,
+            }
+            await asyncio.to_thread(self.queue.finish, line["batch_id"], line["line"], "completed", result)
+            BATCH_LINES.labels("completed").inc()
+            return
+
+        if error.status_code in RETRYABLE_STATUS_CODES and line["attempts"] < self.max_attempts:
+            delay = _retry_delay((error.headers or {}).get("Retry-After"), line["attempts"])
+            await asyncio.to_thread(self.queue.retry, line["batch_id"], line["line"], time.time() + delay)
+            BATCH_LINES.labels("retried").inc()
+            return
+        detail = error.detail if isinstance(error.detail, str) else json.dumps(error.detail, default=str)
+        result = _error_result(line["custom_id"], error.status_code, detail)
+        await asyncio.to_thread(self.queue.finish, line["batch_id"], line["line"], "failed", result)
+        BATCH_LINES.labels("failed").inc()
+
+
+def create_batch_runner(complete: Callable[[bytes], Awaitable[dict]]) -> BatchRunner:
+    return BatchRunner(
+        queue=BatchQueue(os.environ.get("BATCH_DIR", "data/batches")),
+        complete=complete,
+        concurrency=int(os.environ.get("BATCH_CONCURRENCY", 4)),
+        max_attempts=int(os.environ.get("BATCH_MAX_ATTEMPTS", 3)),
+        line_timeout=float(os.environ.get("BATCH_LINE_TIMEOUT", 600)),
+        poll_interval=float(os.environ.get("BATCH_POLL_INTERVAL", 2)),
+    )
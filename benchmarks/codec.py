@@ -0,0 +1,126 @@
+"""Compares the pydantic request and chunk paths with codec.py, reports µs and transient bytes per operation.
+
+    python -m benchmarks.codec --chunks 20000 --messages 40 --images 1
+
+peak_bytes comes from tracemalloc, which only sees Python allocations: what pydantic-core allocates on the Rust side
+is missing, so its numbers are a lower bound.
+"""
+
+import argparse
+import base64
+import io
+import json
+import time
+import tracemalloc
+from PIL import Image
+from codec import ChunkEncoder, decode_completions, dumps
+from schemas import Choices, CompletionsJsonData, Message, Usage
+from utility import get_openai_chunk_response
+
+MODEL = "deepseek-chat"
+DELTA = "the quick brown fox "
+
+
+def measure(operation, repeat: int) -> dict:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        operation()
+    elapsed = time.perf_counter() - start
+
+    # memory allocated while one operation runs and freed after it, what the allocator churns through per call
+    peaks = []
+    tracemalloc.start()
+    for _ in range(min(repeat, 200)):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        operation()
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    return {"us": round(elapsed / repeat * 1e6, 2), "peak_bytes": round(sum(peaks) / len(peaks))}
+
+
+def bench_chunks(chunks: int) -> dict:
+    per_chunk_data = lambda: (lambda data: data.model_dump_json(exclude_unset=True))(get_openai_chunk_response(MODEL))
+    shared_data = get_openai_chunk_response(MODEL)
+
+    def pydantic_reused() -> str:
+        shared_data.choices[0].delta.content = DELTA
+        return f"data: {shared_data.model_dump_json(exclude_unset=True)}\n\n"
+
+    encoder = ChunkEncoder(MODEL)
+
+    # the template produces the same bytes as the pydantic model
+    reference = json.loads(encoder.delta(DELTA)[6:])
+    shared_data.choices[0].delta.content = DELTA
+    shared_data.id, shared_data.created = reference["id"], reference["created"]
+    assert encoder.delta(DELTA) == f"data: {shared_data.model_dump_json(exclude_unset=True)}\n\n".encode()
+    shared_data.choices = [Choices(delta=Message(content=""), finish_reason="stop")]
+    assert encoder.stop() == f"data: {shared_data.model_dump_json(exclude_unset=True)}\n\n".encode()
+    shared_data.choices, shared_data.usage = [], Usage(prompt_tokens=1, completion_tokens=2, total_tokens=3)
+    assert encoder.usage(shared_data.usage) == f"data: {shared_data.model_dump_json(exclude_unset=True)}\n\n".encode()
+    shared_data = get_openai_chunk_response(MODEL)
+
+    return {
+        "pydantic_new_model_per_chunk": measure(per_chunk_data, chunks),
+        "pydantic_reused_model": measure(pydantic_reused, chunks),
+        "byte_template": measure(lambda: encoder.delta(DELTA), chunks),
+    }
+
+
+def build_history(messages: int, images: int) -> list[dict]:
+    buffer = io.BytesIO()
+    Image.effect_noise((1024, 1024), 64).convert("RGB").save(buffer, format="PNG")
+    image_data = base64.b64encode(buffer.getvalue()).decode()
+    history = [{"role": "system", "content": "You are a helpful assistant."}]
+    for index in range(messages):
+        if index < images:
+            content = [
+                {"type": "text", "text": "What is in this picture?"},
+                {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": image_data}},
+            ]
+            history.append({"role": "user", "content": content})
+        else:
+            history.append({"role": "user" if index % 2 else "assistant", "content": f"Turn {index}: " + DELTA * 40})
+    return history
+
+
+def bench_requests(messages: int, images: int, repeat: int) -> dict:
+    history = build_history(messages, images)
+    turn = [0]
+
+    def next_body() -> bytes:
+        # every request is the next turn: the same history plus one new user message
+        turn[0] += 1
+        payload = {
+            "model": MODEL,
+            "messages": history + [{"role": "user", "content": f"question {turn[0]}"}],
+            "stream": True,
+            "temperature": 0.5,
+            "top_p": 1,
+        }
+        return dumps(payload)
+
+    bodies = [next_body() for _ in range(repeat + 200)]
+    pydantic_bodies, codec_bodies = iter(bodies), iter(bodies)
+    decode_completions(bodies[0])
+    assert decode_completions(bodies[1]) == CompletionsJsonData.model_validate_json(bodies[1])
+    return {
+        "body_bytes": len(bodies[0]),
+        "pydantic_validate": measure(lambda: CompletionsJsonData.model_validate_json(next(pydantic_bodies)), repeat),
+        "codec_next_turn": measure(lambda: decode_completions(next(codec_bodies)), repeat),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark request decoding and chunk encoding")
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--messages", type=int, default=40, help="messages in the replayed history")
+    parser.add_argument("--images", type=int, default=1, help="base64 images among those messages")
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    report = {
+        "chunk": bench_chunks(args.chunks),
+        "request": bench_requests(args.messages, args.images, args.requests),
+    }
+    print(json.dumps(report, indent=4))
@@ -0,0 +1,125 @@
+"""Load driver for /api/openai/v1/chat/completions, reports throughput, TTFT and latency percentiles.
+
+    python -m benchmarks.load --url http://127.0.0.1:5000 --model deepseek-chat --requests 500 --concurrency 32
+
+Every request numbers its prompt, so neither the response cache nor in-flight coalescing can answer it from another
+request. --same-prompt sends the identical payload each time to measure what those two save.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import httpx
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+async def run_request(client: httpx.AsyncClient, url: str, payload: dict, stream: bool) -> dict:
+    start = time.perf_counter()
+    ttft = None
+    chunks = 0
+    async with client.stream("POST", url, json=payload) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return {"ok": False, "status": response.status_code, "latency": time.perf_counter() - start}
+        if stream:
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                try:
+                    delta = json.loads(line[6:])["choices"][0]["delta"].get("content")
+                except (json.JSONDecodeError, KeyError, IndexError):
+                    continue
+                if delta:
+                    chunks += 1
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+        else:
+            await response.aread()
+            ttft = time.perf_counter() - start
+            chunks = 1
+    return {"ok": True, "status": 200, "latency": time.perf_counter() - start, "ttft": ttft, "chunks": chunks}
+
+
+async def run_load(
+    url: str, model: str, requests: int, concurrency: int, stream: bool, prompt: str, same_prompt: bool = False
+) -> dict:
+    endpoint = f"{url.rstrip('/')}/api/openai/v1/chat/completions"
+
+    def make_payload(index: int) -> dict:
+        return {
+            "model": model,
+            "messages": [{"role": "user", "content": prompt if same_prompt else f"{prompt} (request {index})"}],
+            "stream": stream,
+            "temperature": 0.5,
+            "top_p": 1,
+        }
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+
+        async def bounded(index: int) -> dict:
+            async with semaphore:
+                try:
+                    return await run_request(client, endpoint, make_payload(index), stream)
+                except httpx.HTTPError as e:
+                    return {"ok": False, "status": type(e).__name__, "latency": 0.0}
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(bounded(index) for index in range(requests)))
+        elapsed = time.perf_counter() - start
+
+    succeeded = [result for result in results if result["ok"]]
+    latencies = [result["latency"] for result in succeeded]
+    ttfts = [result["ttft"] for result in succeeded if result["ttft"] is not None]
+    errors: dict[str, int] = {}
+    for result in results:
+        if not result["ok"]:
+            errors[str(result["status"])] = errors.get(str(result["status"]), 0) + 1
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "stream": stream,
+        "same_prompt": same_prompt,
+        "succeeded": len(succeeded),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(succeeded) / elapsed, 2) if elapsed else 0.0,
+        "chunks_per_s": round(sum(result["chunks"] for result in succeeded) / elapsed, 2) if elapsed else 0.0,
+        "ttft_ms": {
+            "mean": round(statistics.fmean(ttfts) * 1000, 2) if ttfts else 0.0,
+            "p50": round(percentile(ttfts, 50) * 1000, 2),
+            "p99": round(percentile(ttfts, 99) * 1000, 2),
+        },
+        "latency_ms": {
+            "mean": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive load against the chat completions endpoint")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--model", default="deepseek-chat")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--no-stream", dest="stream", action="store_false")
+    parser.add_argument("--prompt", default="Write a short story about a fox.")
+    parser.add_argument("--same-prompt", action="store_true", help="send one identical payload, cache and coalescing apply")
+    args = parser.parse_args()
+
+    report = asyncio.run(
+        run_load(args.url, args.model, args.requests, args.concurrency, args.stream, args.prompt, args.same_prompt)
+    )
+    print(json.dumps(report, indent=4))
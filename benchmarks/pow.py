@@ -0,0 +1,60 @@
+"""Compares the DeepSeekHashV1 engines, reports the solve time and the hashes per second of each.
+
+    python -m benchmarks.pow --challenges 5 --answer 100000 --batch-size 8192
+
+Every engine has to return 38385 for the sample challenge of ds_wasm_pow.py, and the same answer for the generated
+challenges, before any timing is reported. Set DEEPSEEK_POW_ENGINE to the faster one.
+"""
+
+import argparse
+import json
+import random
+import time
+import numpy as np
+from benchmarks.upstreams import DEEPSEEK_ANSWER, DEEPSEEK_CHALLENGE
+from deepseek_web.conversation import create_pow_engine
+
+
+def make_challenge(answer: int) -> dict:
+    """A challenge with a known answer, hashed with the NumPy engine and checked against wasm below."""
+    salt = "".join(random.choices("0123456789abcdef", k=20))
+    expire_at = int(time.time() * 1000)
+    prefix = f"{salt}_{expire_at}_".encode()
+    lanes = create_pow_engine("numpy")._hash_block(prefix, np.array([answer], dtype=np.uint64), len(str(answer)))
+    challenge = lanes[0].astype("<u8").tobytes().hex()
+    return {"challenge": challenge, "salt": salt, "difficulty": answer * 2, "expire_at": expire_at}
+
+
+def solve(engine, challenge: dict) -> int | None:
+    return engine.calculate_answer(challenge["challenge"], challenge["salt"], challenge["difficulty"], challenge["expire_at"])
+
+
+def bench_engine(engine, challenges: list[tuple[dict, int]]) -> dict:
+    elapsed = 0.0
+    hashes = 0
+    for challenge, answer in challenges:
+        start = time.perf_counter()
+        assert solve(engine, challenge) == answer
+        elapsed += time.perf_counter() - start
+        # the search stops at the answer, every nonce before it was hashed
+        hashes += answer + 1
+    return {"ms_per_solve": round(elapsed / len(challenges) * 1000, 1), "hashes_per_second": round(hashes / elapsed)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the DeepSeek proof of work engines")
+    parser.add_argument("--challenges", type=int, default=5, help="generated challenges on top of the sample one")
+    parser.add_argument("--answer", type=int, default=100000, help="answer of the generated challenges")
+    parser.add_argument("--batch-size", type=int, default=8192, help="nonces per Keccak pass of the NumPy engine")
+    args = parser.parse_args()
+
+    challenges = [(DEEPSEEK_CHALLENGE, DEEPSEEK_ANSWER)]
+    challenges += [(make_challenge(args.answer), args.answer) for _ in range(args.challenges)]
+    engines = {"wasm": create_pow_engine("wasm"), "numpy": create_pow_engine("numpy", args.batch_size)}
+    # warm up and check every engine before timing
+    for engine in engines.values():
+        for challenge, answer in challenges:
+            assert solve(engine, challenge) == answer
+
+    report = {name: bench_engine(engine, challenges) for name, engine in engines.items()}
+    print(json.dumps(report, indent=4))
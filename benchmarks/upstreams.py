@@ -0,0 +1,227 @@
+"""Local stand-ins for the DeepSeek, ChatGPT, TheB.AI and Hugging Chat upstreams.
+
+Each simulator reproduces the endpoints, the stream framing and the proof of work of its upstream with a
+configurable latency profile, so the API can be load tested without network access:
+
+    python -m benchmarks.upstreams --port 9000 --ttfb-ms 400 --token-ms 25 --tokens 200
+
+    DEEPSEEK_BASE_URL=http://127.0.0.1:9000/deepseek DEEPSEEK_SKIP_CF_CHALLENGE=true DEEPSEEK_BEARER_TOKEN=bench \\
+    CHATGPT_BASE_URL=http://127.0.0.1:9000/chatgpt THEB_AI_API_URL=http://127.0.0.1:9000/theb/api \\
+    HUGGING_FACE_URL=http://127.0.0.1:9000/huggingface uvicorn main:app --port 5000
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+# the sample challenge from deepseek_web/ds_wasm_pow.py, its answer is known so every solve can be checked
+DEEPSEEK_CHALLENGE = {
+    "algorithm": "DeepSeekHashV1",
+    "challenge": "2ee17d427355d5d0bb1056a14d8ed6982f117db6c2e4046bc05f53c1546876b6",
+    "salt": "e071bdd62e1dcb455990",
+    "difficulty": 144000,
+    "expire_at": 1736928349211,
+    "signature": "simulated",
+    "target_path": "/api/v0/chat/completion",
+}
+DEEPSEEK_ANSWER = 38385
+WORDS = "the quick brown fox jumps over the lazy dog while the API relays every token to NextChat".split()
+
+
+@dataclass
+class LatencyProfile:
+    ttfb_ms: float = 400
+    token_ms: float = 25
+    tokens: int = 200
+    jitter: float = 0.2
+    active_streams: int = 0
+    prompt_chars: int = 0
+
+    async def sleep(self, milliseconds: float) -> None:
+        jitter = 1 + random.uniform(-self.jitter, self.jitter)
+        await asyncio.sleep(max(milliseconds * jitter, 0) / 1000)
+
+    async def tokens_iter(self):
+        # streams still being generated, a client that hangs up should bring this back down right away
+        self.active_streams += 1
+        try:
+            await self.sleep(self.ttfb_ms)
+            for index in range(self.tokens):
+                if index:
+                    await self.sleep(self.token_ms)
+                yield f"{WORDS[index % len(WORDS)]} "
+        finally:
+            self.active_streams -= 1
+
+
+def create_app(profile: LatencyProfile) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/stats")
+    async def stats():
+        return {"active_streams": profile.active_streams, "prompt_chars": profile.prompt_chars}
+
+    # DeepSeek: session + PoW challenge, the answer comes back base64 encoded in x-ds-pow-response
+    @app.get("/deepseek/version.txt")
+    async def deepseek_version():
+        return PlainTextResponse("20241129.1")
+
+    @app.post("/deepseek/api/v0/chat/create_pow_challenge")
+    async def deepseek_pow_challenge():
+        return {"code": 0, "data": {"biz_code": 0, "biz_data": {"challenge": DEEPSEEK_CHALLENGE}}}
+
+    @app.post("/deepseek/api/v0/chat_session/create")
+    async def deepseek_session_create():
+        return {"code": 0, "data": {"biz_code": 0, "biz_data": {"id": str(uuid.uuid4())}}}
+
+    @app.post("/deepseek/api/v0/chat_session/delete")
+    async def deepseek_session_delete():
+        return {"code": 0, "data": {"biz_code": 0, "biz_data": None}}
+
+    @app.post("/deepseek/api/v0/chat/completion")
+    async def deepseek_completion(request: Request):
+        try:
+            pow_response = json.loads(base64.b64decode(request.headers["x-ds-pow-response"]))
+            pow_valid = pow_response["answer"] == DEEPSEEK_ANSWER
+        except Exception:
+            pow_valid = False
+        if not pow_valid:
+            # DeepSeek reports errors with a 200 status and a json body instead of a stream
+            return JSONResponse({"code": 40300, "msg": "INVALID_POW_RESPONSE", "data": None})
+
+        payload = await request.json()
+        profile.prompt_chars += len(payload.get("prompt") or "")
+        parent_id = payload.get("parent_message_id") or 0
+        message_id = parent_id + 2
+
+        async def stream():
+            chunk = {
+                "id": str(message_id),
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": "deepseek-chat",
+                "message_id": message_id,
+                "parent_id": parent_id + 1,
+            }
+            async for token in profile.tokens_iter():
+                chunk["choices"] = [{"index": 0, "delta": {"content": token, "type": "text"}}]
+                yield f"data: {json.dumps(chunk)}\n\n"
+            chunk["choices"] = [{"index": 0, "delta": {"content": "", "type": "text"}, "finish_reason": "stop"}]
+            yield f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    # ChatGPT: sentinel requirements with a proof of work, the stream repeats the cumulative message parts
+    @app.get("/chatgpt/api/auth/session")
+    async def chatgpt_auth_session():
+        return {"accessToken": "simulated"}
+
+    @app.post("/chatgpt/{backend}/sentinel/chat-requirements")
+    async def chatgpt_chat_requirements(backend: str):
+        return {
+            "persona": "chatgpt-noauth",
+            "token": uuid.uuid4().hex,
+            "arkose": None,
+            "proofofwork": {"required": True, "seed": str(random.random()), "difficulty": "0fffff"},
+        }
+
+    @app.post("/chatgpt/{backend}/conversation")
+    async def chatgpt_conversation(backend: str, request: Request):
+        if not request.headers.get("openai-sentinel-proof-token", "").startswith("gAAAAAB"):
+            return JSONResponse({"detail": "Unusual activity has been detected from your device."}, status_code=403)
+        conversation_id = str(uuid.uuid4())
+        message_id = str(uuid.uuid4())
+
+        async def stream():
+            parts = ""
+            async for token in profile.tokens_iter():
+                parts += token
+                message = {
+                    "id": message_id,
+                    "author": {"role": "assistant", "name": None, "metadata": {}},
+                    "content": {"content_type": "text", "parts": [parts]},
+                    "status": "in_progress",
+                }
+                yield f"data: {json.dumps({'message': message, 'conversation_id': conversation_id, 'error': None})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    # TheB.AI: balance and model lookups before every conversation, the stream repeats the cumulative content
+    @app.get("/theb/api/organization/balance")
+    async def theb_balance():
+        return {"data": {"balance": "1.0"}}
+
+    @app.get("/theb/api/chat_models")
+    async def theb_chat_models():
+        with open("theb_ai/models.json", "r") as models_file:
+            model_key_mapping = json.load(models_file)
+        return {"data": [{"model_name": name, "model_id": uuid.uuid4().hex} for name in model_key_mapping]}
+
+    @app.post("/theb/api/conversation")
+    async def theb_conversation():
+        message_id = uuid.uuid4().hex
+
+        async def stream():
+            content = ""
+            async for token in profile.tokens_iter():
+                content += token
+                yield f"data: {json.dumps({'id': message_id, 'type': 3, 'args': {'content': content}})}\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    # Hugging Chat: conversation + message id lookups, the stream is newline delimited json
+    @app.post("/huggingface/chat/conversation")
+    async def hugging_chat_conversation():
+        return {"conversationId": uuid.uuid4().hex[:24]}
+
+    @app.get("/huggingface/chat/conversation/{conversation_id}/__data.json")
+    async def hugging_chat_data(conversation_id: str):
+        data = {"type": "data", "nodes": [None, {"type": "data", "data": [{}, {}, {}, str(uuid.uuid4())]}]}
+        return PlainTextResponse(json.dumps(data) + "\n")
+
+    @app.post("/huggingface/chat/conversation/{conversation_id}")
+    async def hugging_chat_stream(conversation_id: str):
+        async def stream():
+            yield json.dumps({"type": "status", "status": "started"}) + "\n"
+            text = ""
+            async for token in profile.tokens_iter():
+                text += token
+                yield json.dumps({"type": "stream", "token": token}) + "\n"
+            yield json.dumps({"type": "finalAnswer", "text": text, "interrupted": False}) + "\n"
+
+        return StreamingResponse(stream(), media_type="application/jsonl")
+
+    @app.delete("/huggingface/chat/conversation/{conversation_id}")
+    async def hugging_chat_delete_conversation(conversation_id: str):
+        return {}
+
+    @app.delete("/huggingface/chat/api/conversations")
+    async def hugging_chat_delete_conversations():
+        return {}
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the local upstream simulators")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--ttfb-ms", type=float, default=400, help="delay before the first token")
+    parser.add_argument("--token-ms", type=float, default=25, help="delay between tokens")
+    parser.add_argument("--tokens", type=int, default=200, help="tokens per completion")
+    parser.add_argument("--jitter", type=float, default=0.2, help="relative random jitter applied to every delay")
+    args = parser.parse_args()
+
+    profile = LatencyProfile(args.ttfb_ms, args.token_ms, args.tokens, args.jitter)
+    # h11 keeps the request body when curl_cffi offers an h2c upgrade on plain http, httptools drops it
+    uvicorn.run(create_app(profile), host=args.host, port=args.port, http="h11", log_level="error")
@@ -0,0 +1,214 @@
+"""Warm undetected Chrome contexts for solving Cloudflare challenges.
+
+BROWSER_POOL_SIZE contexts (2 by default) are started the first time a challenge has to be solved and stay open, so a
+solve costs a page load instead of a Chrome and Xvfb cold start. Every context runs in a process of its own: the Xvfb
+display SeleniumBase sets up and the pyautogui clicks of uc_gui_click_captcha are process wide, two contexts sharing a
+process could click on each other's display. Requests queue until a
+context is free, at most BROWSER_POOL_SOLVE_TIMEOUT seconds. A context is replaced after BROWSER_POOL_MAX_USES
+solves, after a failed solve and when the health check it runs every BROWSER_POOL_HEALTH_INTERVAL idle seconds fails.
+A dead context process takes the others down with it, fails the pending solves and the pool is started again on the
+next one.
+
+The pool is per API worker process, the callers already share one clearance between workers through shared_state.
+"""
+
+import asyncio
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from contextlib import suppress
+from logger import get_logger
+from metrics import POOL_OCCUPANCY, observe_stage
+
+logger = get_logger("browser_pool")
+
+# seconds a context waits before retrying after Chrome failed to start
+START_RETRY_DELAY = 5
+
+
+def _is_healthy(sb) -> bool:
+    try:
+        if getattr(sb, "cdp", None) is not None:
+            return sb.cdp.evaluate("1 + 1") == 2
+        return sb.execute_script("return 1 + 1") == 2
+    except Exception:
+        return False
+
+
+def _solve(sb, url: str) -> tuple[dict, str]:
+    # opens url in the running browser once CDP mode is active, the first call attaches to it
+    sb.activate_cdp_mode(url)
+    sb.uc_gui_click_captcha()
+    cookies = {cookie.name: cookie.value for cookie in sb.cdp.get_all_cookies()}
+    return cookies, sb.cdp.get_user_agent()
+
+
+def _run_context(index: int, jobs, results, max_uses: int, health_interval: float) -> None:
+    """Main function of a context process, serves jobs until it gets None."""
+    from seleniumbase import SB
+
+    while True:
+        try:
+            with SB(uc=True, headed=True, xvfb=True) as sb:
+                results.put(("ready", index, None, None))
+                uses = 0
+                while uses < max_uses:
+                    try:
+                        job = jobs.get(timeout=health_interval)
+                    except queue.Empty:
+                        if not _is_healthy(sb):
+                            results.put(("unhealthy", index, None, None))
+                            break
+                        continue
+                    if job is None:
+                        return
+                    job_id, url, attempt = job
+                    try:
+                        results.put(("solved", job_id, _solve(sb, url), None))
+                    except Exception as e:
+                        if attempt == 0:
+                            # one more try on a fresh context before the caller sees the error
+                            jobs.put((job_id, url, 1))
+                        else:
+                            results.put(("failed", job_id, None, repr(e)))
+                        break
+                    uses += 1
+        except Exception as e:
+            results.put(("start_failed", index, None, repr(e)))
+            time.sleep(START_RETRY_DELAY)
+
+
+class BrowserPool:
+    def __init__(self, size: int, max_uses: int, health_interval: float, solve_timeout: float):
+        self.size = size
+        self.max_uses = max_uses
+        self.health_interval = health_interval
+        self.solve_timeout = solve_timeout
+        self.context = multiprocessing.get_context("spawn")
+        self.processes: list | None = None
+        self.jobs = None
+        self.results = None
+        self.pending: dict[int, Future] = {}
+        self.job_ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def _start(self) -> None:
+        # a fresh pair of queues, the old ones may hold messages of the dead processes
+        self.jobs = self.context.Queue()
+        self.results = self.context.Queue()
+        self.processes = [
+            self.context.Process(
+                target=_run_context,
+                args=(index, self.jobs, self.results, self.max_uses, self.health_interval),
+                name=f"browser-pool-{index}",
+                daemon=True,
+            )
+            for index in range(self.size)
+        ]
+        for process in self.processes:
+            process.start()
+        threading.Thread(target=self._read_results, args=(self.processes, self.results), daemon=True).start()
+        logger.info("Started the browser pool with %s contexts", self.size)
+
+    def _read_results(self, processes: list, results) -> None:
+        while True:
+            try:
+                kind, key, value, error = results.get(timeout=1)
+            except queue.Empty:
+                if all(process.is_alive() for process in processes):
+                    continue
+                with self.lock:
+                    if processes is self.processes:
+                        self.processes = None
+                    pending = list(self.pending.values())
+                    self.pending.clear()
+                # jobs taken by the dead process are lost, the pool starts over as a whole
+                for process in processes:
+                    if process.is_alive():
+                        process.kill()
+                for future in pending:
+                    with suppress(InvalidStateError):
+                        future.set_exception(RuntimeError("The browser pool process exited"))
+                exit_codes = [process.exitcode for process in processes]
+                logger.warning("A browser pool process exited, exit codes %s", exit_codes)
+                return
+            if kind in ("solved", "failed"):
+                with self.lock:
+                    future = self.pending.pop(key, None)
+                if future is None:
+                    continue
+                # the caller may have given up in the meantime
+                with suppress(InvalidStateError):
+                    if kind == "solved":
+                        future.set_result(value)
+                    else:
+                        future.set_exception(RuntimeError(f"Challenge solve failed: {error}"))
+            elif kind == "ready":
+                logger.debug("Browser context %s is ready", key)
+            else:
+                logger.warning("Browser context %s was replaced (%s) %s", key, kind, error or "")
+            POOL_OCCUPANCY.labels("browser_pool_pending").set(len(self.pending))
+
+    def submit(self, url: str) -> Future:
+        """Queues a solve, the future resolves to the cookies and the user agent of the browser."""
+        future = Future()
+        with self.lock:
+            if self.processes is None:
+                self._start()
+            job_id = next(self.job_ids)
+            self.pending[job_id] = future
+            self.jobs.put((job_id, url, 0))
+        future.add_done_callback(lambda _: self.pending.pop(job_id, None))
+        POOL_OCCUPANCY.labels("browser_pool_pending").set(len(self.pending))
+        return future
+
+    async def solve(self, url: str) -> tuple[dict, str]:
+        with observe_stage("browser_pool", "solve"):
+            future = self.submit(url)
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), self.solve_timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"No challenge solution for {url} after {self.solve_timeout:g} seconds")
+
+    def solve_blocking(self, url: str) -> tuple[dict, str]:
+        """solve() for synchronous code running outside the event loop."""
+        with observe_stage("browser_pool", "solve"):
+            return self.submit(url).result(self.solve_timeout)
+
+    def close(self) -> None:
+        with self.lock:
+            processes, self.processes = self.processes, None
+        if processes is None:
+            return
+        # every context process takes one None and stops
+        for _ in processes:
+            self.jobs.put(None)
+        deadline = time.monotonic() + 10
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+
+
+_browser_pool = None
+
+
+def get_browser_pool() -> BrowserPool:
+    global _browser_pool
+    if _browser_pool is None:
+        _browser_pool = BrowserPool(
+            size=int(os.environ.get("BROWSER_POOL_SIZE", 2)),
+            max_uses=int(os.environ.get("BROWSER_POOL_MAX_USES", 20)),
+            health_interval=float(os.environ.get("BROWSER_POOL_HEALTH_INTERVAL", 60)),
+            solve_timeout=float(os.environ.get("BROWSER_POOL_SOLVE_TIMEOUT", 90)),
+        )
+    return _browser_pool
+
+
+def close_browser_pool() -> None:
+    if _browser_pool is not None:
+        _browser_pool.close()
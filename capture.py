@@ -0,0 +1,274 @@
+"""Record upstream exchanges and replay them without network access.
+
+CAPTURE_MODE=record appends every upstream request and its response chunks, with their arrival offsets, to
+CAPTURE_FILE (one json object per line). CAPTURE_MODE=replay serves those exchanges back round robin per
+provider, method and path, at CAPTURE_REPLAY_SPEED times the recorded pace (0 replays as fast as possible).
+Cookies, authorization and proof of work headers and token fields of request bodies are never written.
+"""
+
+import asyncio
+import codecs
+import itertools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any, AsyncIterator
+from urllib.parse import urlsplit
+import httpx
+from curl_cffi.requests import Headers
+from curl_cffi.requests.models import Response
+
+# credentials never reach the capture file, headers are dropped and body fields replaced
+REDACTED_HEADERS = {"set-cookie", "cookie", "authorization", "proxy-authorization", "x-ds-pow-response"}
+REDACTED_HEADER_PREFIXES = ("openai-sentinel-",)
+# "p" is the ChatGPT sentinel proof token
+REDACTED_FIELDS = {"p", "password", "access_token", "api_key", "token"}
+_write_lock = threading.Lock()
+_replay_index = None
+
+
+def capture_mode() -> str | None:
+    return os.environ.get("CAPTURE_MODE")
+
+
+def capture_file() -> str:
+    return os.environ.get("CAPTURE_FILE", "captures/upstream.jsonl")
+
+
+def _exchange_key(provider: str, method: str, url: str) -> tuple[str, str, str]:
+    return provider, method.upper(), urlsplit(str(url)).path
+
+
+def _write_exchange(exchange: dict) -> None:
+    path = capture_file()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    line = json.dumps(exchange, ensure_ascii=False) + "\n"
+    with _write_lock, open(path, "a", encoding="utf-8") as file:
+        file.write(line)
+
+
+def _is_redacted_header(key: str) -> bool:
+    key = key.lower()
+    return key in REDACTED_HEADERS or key.startswith(REDACTED_HEADER_PREFIXES)
+
+
+def _redact_body(body: Any) -> Any:
+    if isinstance(body, dict):
+        return {
+            key: "[redacted]" if key in REDACTED_FIELDS and isinstance(value, str) else _redact_body(value)
+            for key, value in body.items()
+        }
+    if isinstance(body, list):
+        return [_redact_body(value) for value in body]
+    return body
+
+
+def _new_exchange(provider: str, method: str, url: str, body: Any, status_code: int, headers) -> dict:
+    return {
+        "provider": provider,
+        "method": method.upper(),
+        "url": str(url),
+        "request": _redact_body(body),
+        "status": status_code,
+        "headers": {key: value for key, value in headers.items() if not _is_redacted_header(key)},
+        "recorded_at": time.time(),
+        "chunks": [],
+    }
+
+
+def _record_chunks(exchange: dict):
+    """Returns a callback appending decoded chunks with their offset, utf-8 sequences split between two chunks
+    are carried over to the next one."""
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    start = time.perf_counter()
+
+    def record(chunk: bytes) -> None:
+        exchange["chunks"].append([round(time.perf_counter() - start, 4), decoder.decode(chunk)])
+
+    return record
+
+
+def _get_replay_index() -> dict[tuple, itertools.cycle]:
+    global _replay_index
+    if _replay_index is None:
+        exchanges = defaultdict(list)
+        with open(capture_file(), "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    exchange = json.loads(line)
+                    key = _exchange_key(exchange["provider"], exchange["method"], exchange["url"])
+                    exchanges[key].append(exchange)
+        _replay_index = {key: itertools.cycle(values) for key, values in exchanges.items()}
+    return _replay_index
+
+
+def _next_exchange(provider: str, method: str, url: str) -> dict:
+    key = _exchange_key(provider, method, url)
+    try:
+        return next(_get_replay_index()[key])
+    except KeyError:
+        raise RuntimeError(f"No recorded exchange for {' '.join(key)} in {capture_file()}")
+
+
+async def _replay_chunks(chunks: list) -> AsyncIterator[bytes]:
+    speed = float(os.environ.get("CAPTURE_REPLAY_SPEED", 1))
+    start = time.perf_counter()
+    for offset, chunk in chunks:
+        if speed > 0:
+            delay = offset / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield chunk.encode("utf-8")
+
+
+class ReplayResponse(Response):
+    """curl_cffi response fed from a recorded exchange, supports the stream and the buffered accessors."""
+
+    def __init__(self, exchange: dict):
+        super().__init__()
+        self.url = exchange["url"]
+        self.status_code = exchange["status"]
+        self.headers = Headers(exchange["headers"])
+        self.encoding = "utf-8"
+        self.chunks = exchange["chunks"]
+        self.content = "".join(chunk for _, chunk in self.chunks).encode("utf-8")
+
+    async def aiter_content(self, chunk_size=None, decode_unicode=False):
+        async for chunk in _replay_chunks(self.chunks):
+            yield chunk
+
+    async def acontent(self) -> bytes:
+        return b"".join([chunk async for chunk in self.aiter_content()])
+
+    async def aclose(self):
+        pass
+
+
+class CaptureSession:
+    """Stands in for a curl_cffi AsyncSession, records through the wrapped session or replays from the file."""
+
+    def __init__(self, session, provider: str, mode: str):
+        self.session = session
+        self.provider = provider
+        self.mode = mode
+
+    def __getattr__(self, name: str):
+        return getattr(self.session, name)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def get(self, url: str, **kwargs) -> Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def put(self, url: str, **kwargs) -> Response:
+        return await self.request("PUT", url, **kwargs)
+
+    async def request(self, method: str, url: str, **kwargs) -> Response:
+        stream = kwargs.get("stream", False)
+        if self.mode == "replay":
+            return ReplayResponse(_next_exchange(self.provider, method, url))
+
+        response = await self.session.request(method, url, **kwargs)
+        body = kwargs.get("json", kwargs.get("data"))
+        exchange = _new_exchange(self.provider, method, url, body, response.status_code, response.headers)
+        if not stream:
+            exchange["chunks"].append([0.0, response.content.decode("utf-8", "replace")])
+            _write_exchange(exchange)
+            return response
+
+        aiter_content = response.aiter_content
+        record = _record_chunks(exchange)
+
+        async def recording_aiter_content(*args, **kwargs):
+            try:
+                async for chunk in aiter_content(*args, **kwargs):
+                    record(chunk)
+                    yield chunk
+            finally:
+                _write_exchange(exchange)
+
+        # curl_cffi builds aiter_lines and acontent on top of aiter_content
+        response.aiter_content = recording_aiter_content
+        return response
+
+
+class RecordingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, exchange: dict):
+        self.stream = stream
+        self.exchange = exchange
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        record = _record_chunks(self.exchange)
+        async for chunk in self.stream:
+            record(chunk)
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self.stream.aclose()
+        _write_exchange(self.exchange)
+
+
+class ReplayStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: list):
+        self.chunks = chunks
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in _replay_chunks(self.chunks):
+            yield chunk
+
+
+class CaptureTransport(httpx.AsyncBaseTransport):
+    def __init__(self, provider: str, mode: str):
+        self.provider = provider
+        self.mode = mode
+        self.transport = httpx.AsyncHTTPTransport() if mode == "record" else None
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self.mode == "replay":
+            exchange = _next_exchange(self.provider, request.method, request.url)
+            headers = {
+                key: value
+                for key, value in exchange["headers"].items()
+                if key.lower() not in ("content-length", "content-encoding", "transfer-encoding")
+            }
+            return httpx.Response(exchange["status"], headers=headers, stream=ReplayStream(exchange["chunks"]))
+
+        # record the plain body, the replay drops content-encoding anyway
+        request.headers["Accept-Encoding"] = "identity"
+        response = await self.transport.handle_async_request(request)
+        try:
+            body = json.loads(request.content)
+        except (json.JSONDecodeError, UnicodeDecodeError, httpx.RequestNotRead):
+            body = None
+        exchange = _new_exchange(self.provider, request.method, request.url, body, response.status_code, response.headers)
+        response.stream = RecordingStream(response.stream, exchange)
+        return response
+
+    async def aclose(self) -> None:
+        if self.transport is not None:
+            await self.transport.aclose()
+
+
+def capture_session(session, provider: str):
+    """Wrap a curl_cffi AsyncSession when CAPTURE_MODE is set, otherwise return it untouched."""
+    mode = capture_mode()
+    return CaptureSession(session, provider, mode) if mode in ("record", "replay") else session
+
+
+def capture_transport(provider: str) -> httpx.AsyncBaseTransport | None:
+    """Transport for a provider's httpx.AsyncClient, None keeps the default transport."""
+    mode = capture_mode()
+    return CaptureTransport(provider, mode) if mode in ("record", "replay") else None
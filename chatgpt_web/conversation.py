@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import hashlib
 import json
@@ -11,19 +12,26 @@ from io import BytesIO
 from datetime import datetime, timezone
 from fastapi import HTTPException
 from schemas import Message
-from utility import color_print, get_user_agent
+from utility import get_user_agent
+from logger import get_logger
+from shared_state import get_shared_store
+from capture import capture_session
+from images import get_image_store, image_markdown
+from metrics import RETRIES, observe_stage, record_cache, record_response
 from curl_cffi import requests
 from curl_cffi.requests import AsyncSession
 from curl_cffi.requests.models import Response
 from PIL import Image
 from distutils.util import strtobool
 
+logger = get_logger("chatgpt_web")
+
 
 class ChatGPT_Web_RE:
-    openai_url = "https://chatgpt.com"
-    proof_token = None
-    async_session = AsyncSession()
+    openai_url = os.environ.get("CHATGPT_BASE_URL", "https://chatgpt.com")
+    async_session = capture_session(AsyncSession(), "chatgpt_web")
     max_retries = 3
+    models = ["o3-mini", "o1-preview", "o1-mini", "gpt-4o", "gpt-4o-mini", "gpt-4", "gpt-3.5"]
     alias_model = {"gpt-3.5": "text-davinci-002-render-sha"}
     accepted_file_mime_types = []
     accepted_image_mime_types = []
@@ -38,6 +46,21 @@ class ChatGPT_Web_RE:
     def is_anonymous(self) -> bool:
         return not bool(os.environ.get("CHATGPT_WEB_SESSION_TOKEN"))
 
+    @staticmethod
+    def _new_session() -> AsyncSession:
+        return capture_session(AsyncSession(), "chatgpt_web")
+
+    async def _get_proof_token(self) -> str | None:
+        # shared between workers, the pure python proof token search is expensive. The store calls block, so they
+        # run on a thread
+        return await asyncio.to_thread(get_shared_store().get, "chatgpt_web:proof_token")
+
+    async def _set_proof_token(self, proof_token: str | None) -> None:
+        if proof_token is None:
+            await asyncio.to_thread(get_shared_store().delete, "chatgpt_web:proof_token")
+        else:
+            await asyncio.to_thread(get_shared_store().set, "chatgpt_web:proof_token", proof_token)
+
     @property
     def backend_name(self) -> str:
         name = "anon" if self.is_anonymous else "api"
@@ -54,7 +77,7 @@ class ChatGPT_Web_RE:
             else:
                 error_response = response.json()
             if "detail" in error_response:
-                color_print(f"OpenAI Error Response: {error_response}", "red")
+                logger.error("OpenAI Error Response: %s", error_response)
                 return error_response["detail"]
         except:
             pass
@@ -76,12 +99,12 @@ class ChatGPT_Web_RE:
     async def _set_file_accept_type(self) -> None:
         # only for login users
         if not self.is_anonymous:
-            async with AsyncSession() as session:
+            async with self._new_session() as session:
                 response = await session.get(
                     f"{self.openai_url}/backend-api/models", headers=self.headers, impersonate="chrome"
                 )
                 if response.status_code != 200:
-                    color_print(f"Failed to get models: {response.status_code}", "red")
+                    logger.error("Failed to get models: %s", response.status_code)
                     raise HTTPException(
                         status_code=response.status_code, detail=await self._parse_openai_error_response(response)
                     )
@@ -93,7 +116,7 @@ class ChatGPT_Web_RE:
                         self.accepted_image_mime_types = attachments["image_mime_types"]
                         break
                 else:
-                    color_print(f"Available models: {response_json}", "yellow")
+                    logger.warning("Available models: %s", response_json)
                     raise HTTPException(
                         status_code=400,
                         detail="There are no available models with attachments now, maybe try again later.",
@@ -126,38 +149,43 @@ class ChatGPT_Web_RE:
     async def _chat_requirements(self) -> dict:
         chat_requirements_url = f"{self.openai_url}/{self.backend_name}/sentinel/chat-requirements"
 
-        async with AsyncSession() as session:
+        proof_token = await self._get_proof_token()
+        async with self._new_session() as session:
             response = await session.post(
                 chat_requirements_url,
-                json={"p": self.proof_token} if self.proof_token else {},
+                json={"p": proof_token} if proof_token else {},
                 headers=self.headers,
                 impersonate="chrome",
             )
+            record_response("chatgpt_web", response.status_code)
             if response.status_code == 401 and self.max_retries > 0:
                 # token expired, get new token
-                color_print("Access token expired, getting new token...", "yellow")
+                logger.warning("Access token expired, getting new token...")
+                RETRIES.labels("chatgpt_web", "401").inc()
                 self._set_access_token()
                 self.max_retries -= 1
                 return await self._chat_requirements()
             elif response.status_code != 200:
-                color_print(f"Failed to get chat requirements: {response.status_code}", "red")
+                logger.error("Failed to get chat requirements: %s", response.status_code)
                 self.max_retries = 3
                 raise HTTPException(
                     status_code=response.status_code, detail=await self._parse_openai_error_response(response)
                 )
             response_json = response.json()
             # reload until arkose is not required
-            if self.proof_token is None or response_json.get("arkose"):
-                color_print("Generating proof token...", "yellow")
+            if proof_token is None or response_json.get("arkose"):
+                logger.info("Generating proof token...")
                 time.sleep(1)
                 pow = response_json["proofofwork"]
-                self.proof_token = self._generate_proof_token(seed=pow["seed"], difficulty=pow["difficulty"])
+                with observe_stage("chatgpt_web", "pow_solve"):
+                    proof_token = self._generate_proof_token(seed=pow["seed"], difficulty=pow["difficulty"])
+                await self._set_proof_token(proof_token)
                 response_json = await self._chat_requirements()
         return response_json
 
     async def _get_uploaded_file_detail(self, file_id: str) -> dict:
         file_detail_url = f"{self.openai_url}/backend-api/files/{file_id}"
-        async with AsyncSession() as session:
+        async with self._new_session() as session:
             response = await session.get(file_detail_url, headers=self.headers, impersonate="chrome")
             if response.status_code != 200:
                 raise Exception(f"Failed to get file details: {response.status_code}")
@@ -178,16 +206,16 @@ class ChatGPT_Web_RE:
                     width, height = img.width, img.height
                 file_use_cases = "multimodal"
             except Exception as e:
-                color_print(f"Failed to get image dimensions: {e}, setting mime_type to text/plain", "yellow")
+                logger.warning("Failed to get image dimensions: %s, setting mime_type to text/plain", e)
                 mime_type = "text/plain"
         if mime_type in self.accepted_file_mime_types:
             file_use_cases = "my_files"
         elif mime_type not in self.accepted_image_mime_types + self.accepted_file_mime_types:
             file_use_cases = "ace_upload"
             mime_type = ""
-            color_print(f"File type: {mime_type} not supported, setting mime_type to empty string", "yellow")
+            logger.warning("File type: %s not supported, setting mime_type to empty string", mime_type)
 
-        async with AsyncSession() as session:
+        async with self._new_session() as session:
             # get url for file upload
             upload_api_url = f"{self.openai_url}/backend-api/files"
             file_size = len(file_content)
@@ -255,29 +283,24 @@ class ChatGPT_Web_RE:
     async def _get_file_metadata(self, file_content, mime_type) -> dict:
         sha256_hash = hashlib.sha256(file_content).hexdigest()
 
-        file_cache_path = "chatgpt_web/file_cache.json"
-        # load file_cache.json file
-        try:
-            with open(file_cache_path, "r") as f:
-                file_cache = json.load(f)
-            cache_data = file_cache.get(sha256_hash)
-            if cache_data:
-                # check if file is still available in cloud
-                try:
-                    await self._get_uploaded_file_detail(cache_data["file_id"])
-                    color_print(f"File found in cache: {cache_data}", "green")
-                    return cache_data
-                except Exception:
-                    color_print("File has been deleted from cloud, re-uploading...", "yellow")
-        except FileNotFoundError:
-            file_cache = {}
-
-        color_print("Uploading file...", "yellow")
-        new_file_data = await self._upload_file(file_content, mime_type)
-        color_print(f"File uploaded: {new_file_data}", "green")
-        with open(file_cache_path, "w") as f:
-            file_cache[sha256_hash] = new_file_data
-            f.write(json.dumps(file_cache, indent=4))
+        shared_store = get_shared_store()
+        file_cache_key = f"chatgpt_web:file:{sha256_hash}"
+        cache_data = await asyncio.to_thread(shared_store.get, file_cache_key)
+        record_cache("chatgpt_file", bool(cache_data))
+        if cache_data:
+            # check if file is still available in cloud
+            try:
+                await self._get_uploaded_file_detail(cache_data["file_id"])
+                logger.debug("File found in cache: %s", cache_data)
+                return cache_data
+            except Exception:
+                logger.warning("File has been deleted from cloud, re-uploading...")
+
+        logger.info("Uploading file...")
+        with observe_stage("chatgpt_web", "upload"):
+            new_file_data = await self._upload_file(file_content, mime_type)
+        logger.debug("File uploaded: %s", new_file_data)
+        await asyncio.to_thread(shared_store.set, file_cache_key, new_file_data)
         return new_file_data
 
     async def _generate_formatted_messages(self, messages: list[Message]) -> list:
@@ -308,14 +331,14 @@ class ChatGPT_Web_RE:
                             # fetch image from URL
                             else:
                                 tmp_headers = {"User-Agent": self.user_agent}
-                                async with AsyncSession() as session:
+                                async with self._new_session() as session:
                                     file_response = await session.get(
                                         file_url, headers=tmp_headers, impersonate="chrome"
                                     )
                                     file_content = file_response.content
                                     mime_type = file_response.headers.get("Content-Type", "").split(";")[0].strip()
                         except Exception as e:
-                            color_print(f"Failed to fetch image: {e}", "red")
+                            logger.error("Failed to fetch image: %s", e)
                             continue
 
                         file_metadata = await self._get_file_metadata(file_content, mime_type)
@@ -352,13 +375,52 @@ class ChatGPT_Web_RE:
 
         return formatted_messages
 
-    async def download_image(self, file_id: str) -> dict:
+    async def iter_image(self, file_id: str):
         url = f"{self.openai_url}/backend-api/files/{file_id}/download"
-        async with AsyncSession() as session:
-            response = await session.get(url, headers=self.headers, impersonate="chrome")
-            download_details = response.json()
-            image = await session.get(download_details["download_url"], impersonate="chrome")
-        return {"file_name": download_details["file_name"].replace("dalle-generations/", ""), "image": image.content}
+        async with self._new_session() as session:
+            response = await session.get(url, headers=self.headers, cookies=self.cookies, impersonate="chrome")
+            record_response("chatgpt_web", response.status_code)
+            response.raise_for_status()
+            image = await session.get(response.json()["download_url"], impersonate="chrome", stream=True)
+            try:
+                image.raise_for_status()
+                async for chunk in image.aiter_content():
+                    yield chunk
+            finally:
+                await image.aclose()
+
+    async def iter_text(self, response: Response):
+        """Text deltas of a conversation stream, every event repeats the whole message so far.
+
+        Generated images are downloaded in the background and show up as markdown links to /image.
+        """
+        text = ""
+        image_ids = set()
+        async for line in response.aiter_lines():
+            if not line.startswith(b"data: {"):
+                continue
+            try:
+                message = json.loads(line[6:]).get("message")
+            except json.JSONDecodeError:
+                continue
+            if not message:
+                continue
+            parts = message["content"].get("parts") or [""]
+            for part in parts:
+                # image generation answers with asset pointers like file-service://file-abc, from the tool role
+                if isinstance(part, dict) and part.get("content_type") == "image_asset_pointer":
+                    file_id = part["asset_pointer"].split("://")[-1]
+                    if file_id not in image_ids:
+                        image_ids.add(file_id)
+                        file_name = get_image_store().download(
+                            f"chatgpt_web:{file_id}", "png", lambda file_id=file_id: self.iter_image(file_id)
+                        )
+                        yield image_markdown(file_name)
+            if message["author"]["role"] != "assistant":
+                continue
+            if isinstance(parts[0], str) and parts[0].startswith(text) and len(parts[0]) > len(text):
+                yield parts[0][len(text) :]
+                text = parts[0]
 
     async def conversation(self, model: str, messages: list[Message]) -> Response:
         conversation_url = f"{self.openai_url}/{self.backend_name}/conversation"
@@ -367,9 +429,10 @@ class ChatGPT_Web_RE:
         self.headers["Openai-Sentinel-Chat-Requirements-Token"] = chat_requirements["token"]
         if chat_requirements.get("proofofwork") and chat_requirements["proofofwork"]["required"]:
             pow = chat_requirements["proofofwork"]
-            self.headers["Openai-Sentinel-Proof-Token"] = self._generate_proof_token(
-                seed=pow["seed"], difficulty=pow["difficulty"]
-            )
+            with observe_stage("chatgpt_web", "pow_solve"):
+                self.headers["Openai-Sentinel-Proof-Token"] = self._generate_proof_token(
+                    seed=pow["seed"], difficulty=pow["difficulty"]
+                )
 
         payload = {
             "action": "next",
@@ -385,22 +448,25 @@ class ChatGPT_Web_RE:
             "force_rate_limit": False,
             "websocket_request_id": str(uuid.uuid4()),
         }
-        response = await self.async_session.request(
-            "POST",
-            conversation_url,
-            json=payload,
-            headers=self.headers,
-            cookies=self.cookies,
-            impersonate="chrome",
-            stream=True,
-            timeout=None,
-        )
-        color_print(f"ChatGPT Web Response Status Code: {response.status_code}", "blue")
+        with observe_stage("chatgpt_web", "upstream_ttfb"):
+            response = await self.async_session.request(
+                "POST",
+                conversation_url,
+                json=payload,
+                headers=self.headers,
+                cookies=self.cookies,
+                impersonate="chrome",
+                stream=True,
+                timeout=None,
+            )
+        record_response("chatgpt_web", response.status_code)
+        logger.debug("ChatGPT Web Response Status Code: %s", response.status_code)
         if response.status_code == 403:
             if self.max_retries > 0:
-                color_print("Retrying chat request...", "yellow")
+                logger.warning("Retrying chat request...")
+                RETRIES.labels("chatgpt_web", "403").inc()
                 self.max_retries -= 1
-                self.proof_token = None
+                await self._set_proof_token(None)
                 response = await self.conversation(model, messages)
             else:
                 self.max_retries = 3  # reset max_retries
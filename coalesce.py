@@ -0,0 +1,131 @@
+"""Merges the text deltas of a stream into fewer SSE chunks.
+
+Upstreams send one event per token, relaying each as its own chunk costs an ASGI message, a write and a network frame
+per token. With coalescing on, the first delta still goes out at once, later ones wait until window_ms have passed
+since the previous chunk or max_chars are buffered and leave as one chunk. A delta that arrives after a quiet period
+longer than the window is sent right away, so slow streams look the same as before.
+
+Settings come from STREAM_COALESCE_FILE (stream_coalesce.json by default), a map of model to
+{"window_ms": ..., "max_chars": ...} with a "default" row. A window of 0 turns coalescing off, so does a file that
+does not parse or check out.
+"""
+
+import asyncio
+import json
+import math
+import os
+from functools import lru_cache
+from typing import AsyncIterator
+from logger import get_logger
+from metrics import STREAM_FRAMES, STREAM_FRAMES_SAVED
+
+logger = get_logger("coalesce")
+
+DEFAULT_SETTINGS = {"window_ms": 0, "max_chars": 1024}
+
+
+@lru_cache(maxsize=1)
+def _load_settings(path: str, mtime: float) -> dict[str, dict]:
+    """Read and checked once per version of the file, a broken file is logged and leaves coalescing off."""
+    try:
+        with open(path, "r") as file:
+            settings = json.load(file)
+        if not isinstance(settings, dict):
+            raise ValueError("expected a map of model to settings")
+        for model, model_settings in settings.items():
+            if not isinstance(model_settings, dict) or model_settings.keys() - DEFAULT_SETTINGS.keys():
+                raise ValueError(f"{model}: expected an object with window_ms and max_chars")
+            window_ms = float(model_settings.get("window_ms", 0))
+            max_chars = int(model_settings.get("max_chars", 1))
+            if window_ms < 0 or max_chars < 1:
+                raise ValueError(f"{model}: window_ms must not be negative and max_chars must be positive")
+        return settings
+    except FileNotFoundError:
+        return {}
+    except (ValueError, TypeError) as e:
+        logger.error("Ignoring %s, stream coalescing is off: %s", path, e)
+        return {}
+
+
+def get_settings(model: str) -> tuple[float, int]:
+    """Window in seconds and buffer limit in characters for a model."""
+    path = os.environ.get("STREAM_COALESCE_FILE", "stream_coalesce.json")
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = 0.0
+    settings = _load_settings(path, mtime)
+    model_settings = DEFAULT_SETTINGS | settings.get("default", {}) | settings.get(model, {})
+    return float(model_settings["window_ms"]) / 1000, int(model_settings["max_chars"])
+
+
+async def _next_delta(iterator: AsyncIterator[str]) -> tuple[bool, str | None]:
+    # StopAsyncIteration must not escape a task
+    try:
+        return True, await anext(iterator)
+    except StopAsyncIteration:
+        return False, None
+
+
+async def coalesce_deltas(text_deltas: AsyncIterator[str], model: str) -> AsyncIterator[str]:
+    window, max_chars = get_settings(model)
+    iterator = aiter(text_deltas)
+    if window <= 0:
+        try:
+            async for text_delta in iterator:
+                yield text_delta
+        finally:
+            if hasattr(text_deltas, "aclose"):
+                await text_deltas.aclose()
+        return
+
+    loop = asyncio.get_running_loop()
+    buffer: list[str] = []
+    buffered_chars = 0
+    # the first delta is always flushed at once
+    last_flush = -math.inf
+    received = sent = 0
+    pending: asyncio.Task | None = None
+    try:
+        while True:
+            if buffer:
+                # something is waiting to go out, the next delta may not come before the window closes
+                if pending is None:
+                    pending = asyncio.ensure_future(_next_delta(iterator))
+                done, _ = await asyncio.wait((pending,), timeout=max(last_flush + window - loop.time(), 0))
+                if not done:
+                    text, buffer, buffered_chars = "".join(buffer), [], 0
+                    last_flush = loop.time()
+                    sent += 1
+                    yield text
+                    continue
+                has_delta, text_delta = pending.result()
+                pending = None
+            elif pending is not None:
+                has_delta, text_delta = await pending
+                pending = None
+            else:
+                has_delta, text_delta = await _next_delta(iterator)
+            if not has_delta:
+                break
+
+            received += 1
+            buffer.append(text_delta)
+            buffered_chars += len(text_delta)
+            if buffered_chars >= max_chars or loop.time() - last_flush >= window:
+                text, buffer, buffered_chars = "".join(buffer), [], 0
+                last_flush = loop.time()
+                sent += 1
+                yield text
+        if buffer:
+            sent += 1
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            # the source generator can only be closed once the cancelled step has unwound
+            await asyncio.wait((pending,))
+        if hasattr(text_deltas, "aclose"):
+            await text_deltas.aclose()
+        STREAM_FRAMES.labels(model).inc(sent)
+        STREAM_FRAMES_SAVED.labels(model).inc(max(received - sent, 0))
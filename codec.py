@@ -0,0 +1,184 @@
+"""Fast paths for the completions endpoint: request decoding and SSE chunk encoding.
+
+Requests are parsed with orjson and each message is validated by pydantic only the first time it is seen. NextChat
+resends the whole history every turn, so a follow-up request validates just its new messages and large base64 images
+are decoded and compressed once per process instead of once per turn.
+
+Chunks come from a per-stream byte template: everything but the delta text is serialized once when the stream starts
+and every chunk splices the JSON encoded delta in between, the bytes match OpenAiData.model_dump_json. The Anthropic route does
+the same with ChunkJson content_block_delta events, so either wire format is written straight from the provider deltas.
+"""
+
+import hashlib
+import json
+import time
+import uuid
+from collections import OrderedDict
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+from schemas import CompletionsJsonData, Message, MessageJsonData, Usage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MESSAGE_CACHE_SIZE = 4096
+
+
+def loads(data: bytes):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class MessageDecoder:
+    """Validated Message per raw message, keyed by a digest of its canonical bytes."""
+
+    def __init__(self, max_entries: int = MESSAGE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.messages: OrderedDict[bytes, Message] = OrderedDict()
+
+    def decode(self, raw_message: dict) -> Message:
+        key = hashlib.sha1(dumps(raw_message)).digest()
+        message = self.messages.get(key)
+        if message is not None:
+            self.messages.move_to_end(key)
+            return message
+        message = Message.model_validate(raw_message)
+        self.messages[key] = message
+        if len(self.messages) > self.max_entries:
+            self.messages.popitem(last=False)
+        return message
+
+
+_message_decoder = MessageDecoder()
+
+
+def _decode(body: bytes, schema: type[BaseModel]):
+    try:
+        data = loads(body)
+    except ValueError as e:
+        raise RequestValidationError(
+            [{"type": "json_invalid", "loc": ("body",), "msg": f"JSON decode error: {e}", "input": {}}]
+        )
+    if not isinstance(data, dict) or not isinstance(data.get("messages"), list):
+        # let pydantic describe what is wrong
+        try:
+            return schema.model_validate(data)
+        except ValidationError as e:
+            raise RequestValidationError(e.errors(include_url=False), body=data)
+
+    errors = []
+    messages = []
+    for index, raw_message in enumerate(data["messages"]):
+        try:
+            messages.append(_message_decoder.decode(raw_message))
+        except ValidationError as e:
+            errors.extend(
+                {**error, "loc": ("body", "messages", index, *error["loc"])} for error in e.errors(include_url=False)
+            )
+    try:
+        json_data = schema.model_validate({**data, "messages": []})
+    except ValidationError as e:
+        for error in e.errors(include_url=False):
+            # missing fields report the whole body as their input, not the copy validated here
+            if error["type"] == "missing":
+                error["input"] = data
+            errors.append({**error, "loc": ("body", *error["loc"])})
+    if errors:
+        raise RequestValidationError(errors, body=data)
+    json_data.messages = messages
+    return json_data
+
+
+def decode_completions(body: bytes) -> CompletionsJsonData:
+    """Same result and the same 422 errors as declaring CompletionsJsonData as the request body."""
+    return _decode(body, CompletionsJsonData)
+
+
+def decode_messages(body: bytes) -> MessageJsonData:
+    """Anthropic Messages request, its messages share the cache of the completions endpoint."""
+    return _decode(body, MessageJsonData)
+
+
+class ChunkEncoder:
+    """SSE frames of one completion stream, all sharing the id and created time of the first."""
+
+    def __init__(self, model: str):
+        tail = dumps(
+            {
+                "created": int(time.time()),
+                "id": f"chatcmpl-{uuid.uuid4().hex[:29]}",
+                "object": "chat.completion.chunk",
+                "model": model,
+            }
+        )
+        # '{"created":...}' -> ',"created":...}\n\n'
+        self.tail = b"," + tail[1:] + b"\n\n"
+        self.delta_head = b'data: {"choices":[{"delta":{"role":"assistant","content":'
+        self.delta_tail = b"}}]" + self.tail
+
+    def delta(self, text: str) -> bytes:
+        return b"".join((self.delta_head, dumps(text), self.delta_tail))
+
+    def stop(self) -> bytes:
+        return b'data: {"choices":[{"delta":{"content":""},"finish_reason":"stop"}]' + self.tail
+
+    def usage(self, usage: Usage) -> bytes:
+        return b'data: {"choices":[]' + self.tail[:-3] + b',"usage":' + dumps(usage.model_dump()) + b"}\n\n"
+
+    @staticmethod
+    def done() -> bytes:
+        return b"data: [DONE]\n\n"
+
+
+class MessageEventEncoder:
+    """Anthropic Messages SSE events of one stream, text deltas are spliced into a ChunkJson template."""
+
+    def __init__(self, model: str):
+        self.id = f"msg_{uuid.uuid4().hex[:24]}"
+        self.model = model
+        self.delta_head = b'event: content_block_delta\ndata: {"type":"content_block_delta","delta":{"text":'
+        self.delta_tail = b',"type":"text_delta"},"index":0}\n\n'
+
+    @staticmethod
+    def event(event_type: str, data: dict) -> bytes:
+        return b"".join((b"event: ", event_type.encode(), b"\ndata: ", dumps({"type": event_type, **data}), b"\n\n"))
+
+    def start(self, input_tokens: int) -> bytes:
+        message = {
+            "id": self.id,
+            "type": "message",
+            "role": "assistant",
+            "model": self.model,
+            "content": [],
+            "stop_reason": None,
+            "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": 0},
+        }
+        return b"".join(
+            (
+                self.event("message_start", {"message": message}),
+                self.event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}}),
+            )
+        )
+
+    def delta(self, text: str) -> bytes:
+        return b"".join((self.delta_head, dumps(text), self.delta_tail))
+
+    def stop(self, output_tokens: int) -> bytes:
+        return b"".join(
+            (
+                self.event("content_block_stop", {"index": 0}),
+                self.event(
+                    "message_delta",
+                    {"delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": output_tokens}},
+                ),
+                self.event("message_stop", {}),
+            )
+        )
@@ -1,18 +1,43 @@
+import asyncio
 import json
 import os
 import base64
+import weakref
 from fastapi import HTTPException
+from pydantic import ValidationError
 from curl_cffi import requests
 from curl_cffi.requests import AsyncSession
-from seleniumbase import SB
-from utility import color_print
+from schemas import Message, OpenAiData
+from affinity import ConversationAffinity, create_conversation_affinity
+from logger import get_logger
+from shared_state import get_shared_store
+from capture import capture_session
+from metrics import observe_stage, record_cache, record_response
+from browser_pool import get_browser_pool
 from .ds_wasm_pow import DS_WasmPow
-from multiprocessing import Process, Queue
+from .ds_numpy_pow import DS_NumpyPow
+
+logger = get_logger("deepseek_web")
+
+# seconds a session replaced after a Cloudflare refusal stays open for the streams still using it
+STALE_SESSION_CLOSE_DELAY = 600
+
+
+def create_pow_engine(engine: str | None = None, batch_size: int | None = None):
+    """DEEPSEEK_POW_ENGINE selects wasm (default) or numpy, python -m benchmarks.pow tells which is faster on a host."""
+    engine = engine or os.environ.get("DEEPSEEK_POW_ENGINE", "wasm")
+    if engine == "wasm":
+        return DS_WasmPow("deepseek_web/sha3_wasm_bg.7b9ca65ddd.wasm")
+    if engine == "numpy":
+        return DS_NumpyPow(batch_size or int(os.environ.get("DEEPSEEK_POW_BATCH_SIZE", 8192)))
+    raise ValueError(f"Unknown DEEPSEEK_POW_ENGINE {engine}, expected wasm or numpy")
+
 
 class Deepseek_Web_RE:
-    base_url = "https://chat.deepseek.com"
+    base_url = os.environ.get("DEEPSEEK_BASE_URL", "https://chat.deepseek.com")
     api_prefix = f"{base_url}/api/v0"
     models = ["deepseek-chat"]
+    cf_challenge_key = "deepseek_web:cf_challenge"
 
     def __init__(self, cookies: dict, user_agent: str):
         self.cf_challenge_cookies = cookies
@@ -22,38 +47,72 @@ class Deepseek_Web_RE:
             "authorization": f"Bearer +mzX6SY48LgKHayFNCxQAfarRe8xqVKKxvfqKwi+oNheHF7fJAHGuen5qayACntq",
             "x-app-version": self.app_version,
         }
-        self.async_session = AsyncSession(
-            headers=self.headers, 
-            impersonate="chrome", 
-            timeout=None, 
-            cookies=self.cf_challenge_cookies
+        self.async_session = self._new_session()
+        self.cf_challenge_lock = asyncio.Lock()
+        self.pow_engine = create_pow_engine()
+        self.affinity = create_conversation_affinity(on_release=self._release_chat_session)
+        # response -> (chat session id, messages) of streams whose answer can be continued on the next turn
+        self.continuations: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._release_tasks: set[asyncio.Task] = set()
+
+    def _new_session(self):
+        return capture_session(
+            AsyncSession(headers=self.headers, impersonate="chrome", timeout=None, cookies=self.cf_challenge_cookies),
+            "deepseek_web",
         )
-        self.ds_wasm_pow = DS_WasmPow("deepseek_web/sha3_wasm_bg.7b9ca65ddd.wasm")
 
-    @staticmethod
-    def _get_cf_challenge(queue: Queue, base_url: str):
-        """Run in separate process to isolate event loops"""
-        with SB(uc=True, headed=True, xvfb=True) as sb:
-            sb.uc_gui_click_captcha()
-            sb.activate_cdp_mode(base_url)  # Use the passed base_url
-            cookies = {cookie.name: cookie.value for cookie in sb.cdp.get_all_cookies()}
-            user_agent = sb.get_user_agent()
-            queue.put((cookies, user_agent))
+    @classmethod
+    def _get_cf_challenge(cls, stale_cookies: dict | None = None) -> tuple[dict, str]:
+        """Cookies and user agent of the shared clearance, solved by the browser pool when there is none yet or
+        the shared one is the stale_cookies a worker was just refused with."""
+        shared_store = get_shared_store()
+        # only one worker solves the challenge, the others wait and reuse its clearance
+        with shared_store.lock(cls.cf_challenge_key):
+            cf_challenge = shared_store.get(cls.cf_challenge_key)
+            if cf_challenge and cf_challenge["cookies"] == stale_cookies:
+                cf_challenge = None
+            record_cache("cf_clearance", bool(cf_challenge))
+            if cf_challenge:
+                logger.info("Reusing the shared Cloudflare clearance")
+                return cf_challenge["cookies"], cf_challenge["user_agent"]
+
+            cookies, user_agent = get_browser_pool().solve_blocking(cls.base_url)
+            if "cf_clearance" not in cookies:
+                logger.warning("Failed to solve the Cloudflare challenge")
+                raise RuntimeError("Cloudflare challenge failed")
+
+            cf_clearance_ttl = float(os.environ.get("CF_CLEARANCE_TTL", 1800))
+            shared_store.set(cls.cf_challenge_key, {"cookies": cookies, "user_agent": user_agent}, ttl=cf_clearance_ttl)
+        return cookies, user_agent
 
     @classmethod
     def create(cls):
-        """Factory method to handle CF challenge in isolated process"""
-        queue = Queue()
-        p = Process(target=cls._get_cf_challenge, args=(queue, cls.base_url))  # Pass base_url
-        p.start()
-        p.join()
-        
-        cookies, user_agent = queue.get()
-        if "cf_clearance" not in cookies:
-            color_print("Failed to solve the Cloudflare challenge", "yellow")
-            raise RuntimeError("Cloudflare challenge failed")
-            
-        return cls(cookies, user_agent)
+        """Factory method, the CF challenge is solved by the browser pool"""
+        if os.environ.get("DEEPSEEK_SKIP_CF_CHALLENGE", "false").lower() == "true":
+            # local upstream simulators (benchmarks/upstreams.py) have no Cloudflare in front of them
+            return cls({}, "Mozilla/5.0")
+        return cls(*cls._get_cf_challenge())
+
+    async def _refresh_cf_challenge(self, stale_cookies: dict) -> None:
+        """Replaces the clearance Cloudflare refused, the session is rebuilt with the new cookies."""
+        async with self.cf_challenge_lock:
+            if self.cf_challenge_cookies is not stale_cookies:
+                # another request of this worker refreshed it in the meantime
+                return
+            cookies, user_agent = await asyncio.to_thread(self._get_cf_challenge, stale_cookies)
+            self.cf_challenge_cookies = cookies
+            self.user_agent = user_agent
+            self.headers = self.headers | {"user-agent": user_agent}
+            stale_session, self.async_session = self.async_session, self._new_session()
+        # streams still reading from the old session get some time to finish before it is closed
+        task = asyncio.create_task(self._close_session_later(stale_session))
+        self._release_tasks.add(task)
+        task.add_done_callback(self._release_done)
+
+    @staticmethod
+    async def _close_session_later(session) -> None:
+        await asyncio.sleep(STALE_SESSION_CLOSE_DELAY)
+        await session.close()
 
     @property
     def bearer_token(self) -> str:
@@ -61,6 +120,8 @@ class Deepseek_Web_RE:
 
     @property
     def app_version(self) -> str:
+        if os.environ.get("DEEPSEEK_APP_VERSION"):
+            return os.environ["DEEPSEEK_APP_VERSION"]
         url = f"{self.base_url}/version.txt"
         response = requests.get(url, headers={"user-agent": self.user_agent}, cookies=self.cf_challenge_cookies)
         return response.text
@@ -74,11 +135,12 @@ class Deepseek_Web_RE:
         return response.json()["data"]["biz_data"]["challenge"]
 
     async def _get_ds_pow(self) -> str:
+        # every completion gets a fresh challenge, so answers are never worth caching
         challenge = await self._create_pow_challenge()
-
-        answer = self.ds_wasm_pow.calculate_answer(
-            challenge["challenge"], challenge["salt"], challenge["difficulty"], challenge["expire_at"]
-        )
+        with observe_stage("deepseek_web", "pow_solve"):
+            answer = self.pow_engine.calculate_answer(
+                challenge["challenge"], challenge["salt"], challenge["difficulty"], challenge["expire_at"]
+            )
         if not answer:
             raise HTTPException(status_code=400, detail="Failed to solve the proof of work challenge")
         result = {
@@ -91,13 +153,21 @@ class Deepseek_Web_RE:
         }
         return base64.b64encode(json.dumps(result).encode()).decode()
 
-    async def _get_session_id(self) -> str:
+    async def _get_session_id(self, retry: bool = True) -> str:
         url = f"{self.api_prefix}/chat_session/create"
         payload = {"character_id": None}
+        cf_challenge_cookies = self.cf_challenge_cookies
         response = await self.async_session.post(url, json=payload)
+        record_response("deepseek_web", response.status_code)
         if response.status_code == 403:
-            self.__init__()
-            raise HTTPException(status_code=403, detail="Cloudflare challenge expired, please retry")
+            if not retry:
+                raise HTTPException(status_code=403, detail="Cloudflare challenge expired, please retry")
+            logger.warning("Cloudflare refused the clearance, solving a new challenge")
+            try:
+                await self._refresh_cf_challenge(cf_challenge_cookies)
+            except Exception as e:
+                raise HTTPException(status_code=403, detail=f"Cloudflare challenge expired and solving failed: {e!r}")
+            return await self._get_session_id(retry=False)
         if response.status_code != 200:
             raise HTTPException(status_code=response.status_code, detail=response.text)
         return response.json()["data"]["biz_data"]["id"]
@@ -109,29 +179,102 @@ class Deepseek_Web_RE:
         if response.status_code != 200:
             raise HTTPException(status_code=response.status_code, detail=response.text)
 
-    async def completions(self, message: str):
+    def _release_chat_session(self, chat_session_id: str) -> None:
+        task = asyncio.create_task(self._delete_chat_session(chat_session_id))
+        self._release_tasks.add(task)
+        task.add_done_callback(self._release_done)
+
+    def _release_done(self, task: asyncio.Task) -> None:
+        self._release_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Failed to delete chat session: %r", task.exception())
+
+    async def iter_text(self, response):
+        """Text deltas of a completion stream, the lines already follow the OpenAI chunk format.
+
+        A completed answer is remembered with its message id, the next turn continues the same chat session.
+        """
+        continuation = self.continuations.pop(response, None)
+        text_deltas = []
+        message_id = None
+        completed = False
+        try:
+            async for line in response.aiter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                try:
+                    line_json = json.loads(line[6:])
+                    data = OpenAiData(**line_json)
+                except (json.JSONDecodeError, ValidationError):
+                    continue
+                message_id = line_json.get("message_id", message_id)
+                if data.choices and data.choices[0].delta and data.choices[0].delta.content:
+                    text_deltas.append(data.choices[0].delta.content)
+                    yield data.choices[0].delta.content
+            completed = True
+        finally:
+            if continuation is not None:
+                chat_session_id, messages = continuation
+                if completed and message_id is not None:
+                    answer = Message(role="assistant", content="".join(text_deltas))
+                    self.affinity.set(
+                        ConversationAffinity.make_key("deepseek_web", messages + [answer]), chat_session_id, message_id
+                    )
+                elif not self.affinity.holds(chat_session_id):
+                    self._release_chat_session(chat_session_id)
+
+    async def completions(self, message: str, messages: list[Message] | None = None, continue_session: bool = True):
+        """message is the full history, messages lets a follow-up turn send only its last user message."""
         if not self.bearer_token:
             raise HTTPException(status_code=401, detail="Please set the DEEPSEEK_BEARER_TOKEN environment variable")
 
-        chat_session_id = await self._get_session_id()
+        if self.affinity is None or not messages:
+            messages = None
+        continuation = None
+        if messages and continue_session and messages[-1].role == "user" and isinstance(messages[-1].content, str):
+            continuation = self.affinity.get(ConversationAffinity.make_key("deepseek_web", messages[:-1]))
+            record_cache("conversation_affinity", continuation is not None)
+
+        if continuation is not None:
+            chat_session_id, parent_message_id = continuation
+            prompt = messages[-1].content
+        else:
+            with observe_stage("deepseek_web", "session_create"):
+                chat_session_id = await self._get_session_id()
+            parent_message_id, prompt = None, message
 
         url = f"{self.api_prefix}/chat/completion"
-        headers = self.headers | {"x-ds-pow-response": await self._get_ds_pow()}
         payload = {
             "chat_session_id": chat_session_id,
-            "parent_message_id": None,
-            "prompt": message,
+            "parent_message_id": parent_message_id,
+            "prompt": prompt,
             "ref_file_ids": [],
             "search_enabled": False,
             "thinking_enabled": False,
         }
-        response = await self.async_session.post(url, json=payload, headers=headers, stream=True)
-
-        color_print(f"Deepseek Web Response Status Code: {response.status_code}", "blue")
-        # error will still return 200 status code, but only json format
-        if response.headers.get("content-type") == "application/json":
-            error_json = json.loads(await response.atext())
-            raise HTTPException(status_code=400, detail=error_json)
+        keep_session = False
+        try:
+            headers = self.headers | {"x-ds-pow-response": await self._get_ds_pow()}
+            with observe_stage("deepseek_web", "upstream_ttfb"):
+                response = await self.async_session.post(url, json=payload, headers=headers, stream=True)
 
-        await self._delete_chat_session(chat_session_id)
-        return response
\ No newline at end of file
+            record_response("deepseek_web", response.status_code)
+            logger.debug("Deepseek Web Response Status Code: %s", response.status_code)
+            # error will still return 200 status code, but only json format
+            if response.headers.get("content-type") == "application/json":
+                error_json = json.loads(await response.atext())
+                if continuation is not None:
+                    # the session expired upstream, start over with the full history
+                    logger.warning("Continuing chat session failed, sending the full history: %s", error_json)
+                    self.affinity.discard(chat_session_id)
+                    return await self.completions(message, messages, continue_session=False)
+                raise HTTPException(status_code=400, detail=error_json)
+            if messages is not None:
+                self.continuations[response] = (chat_session_id, messages)
+                keep_session = True
+        finally:
+            # without affinity the chat session is not needed once the completion has started,
+            # failed attempts must not leave it behind either
+            if not keep_session and continuation is None:
+                await self._delete_chat_session(chat_session_id)
+        return response
@@ -0,0 +1,117 @@
+import numpy as np
+
+# DeepSeekHashV1 is SHA3-256 with the first of the 24 Keccak-f rounds left out
+ROUND_CONSTANTS = [
+    0x0000000000008082, 0x800000000000808A, 0x8000000080008000, 0x000000000000808B, 0x0000000080000001,
+    0x8000000080008081, 0x8000000000008009, 0x000000000000008A, 0x0000000000000088, 0x0000000080008009,
+    0x000000008000000A, 0x000000008000808B, 0x800000000000008B, 0x8000000000008089, 0x8000000000008003,
+    0x8000000000008002, 0x8000000000000080, 0x000000000000800A, 0x800000008000000A, 0x8000000080008081,
+    0x8000000000008080, 0x0000000080000001, 0x8000000080008008,
+]  # fmt: skip
+# rotation offsets and the pi step as (source lane, destination lane), lanes indexed x + 5 * y
+ROTATIONS = [0, 1, 62, 28, 27, 36, 44, 6, 55, 20, 3, 10, 43, 25, 39, 41, 45, 15, 21, 8, 18, 2, 61, 56, 14]
+PI = [(x + 5 * y, y + 5 * ((2 * x + 3 * y) % 5)) for x in range(5) for y in range(5)]
+# chi combines every lane with the next two of its row
+CHI = [(i, (i + 1) % 5 + i - i % 5, (i + 2) % 5 + i - i % 5) for i in range(25)]
+RATE = 136
+DIGEST_LANES = 4
+
+
+def _keccak_f(state: np.ndarray) -> None:
+    """The 23 rounds, in place on a (25, n) state holding one candidate per column.
+
+    Every step writes into preallocated arrays, a fresh temporary per operation costs more than the xor itself.
+    """
+    n = state.shape[1]
+    lanes = list(state)
+    b = list(np.empty((25, n), dtype=np.uint64))
+    c = list(np.empty((5, n), dtype=np.uint64))
+    d = list(np.empty((5, n), dtype=np.uint64))
+    temp = np.empty(n, dtype=np.uint64)
+    one, sixty_three = np.uint64(1), np.uint64(63)
+    rotations = [(np.uint64(offset), np.uint64(64 - offset)) for offset in ROTATIONS]
+    for round_constant in ROUND_CONSTANTS:
+        # theta
+        for x in range(5):
+            np.bitwise_xor(lanes[x], lanes[x + 5], out=c[x])
+            c[x] ^= lanes[x + 10]
+            c[x] ^= lanes[x + 15]
+            c[x] ^= lanes[x + 20]
+        for x in range(5):
+            np.left_shift(c[(x + 1) % 5], one, out=d[x])
+            np.right_shift(c[(x + 1) % 5], sixty_three, out=temp)
+            d[x] |= temp
+            d[x] ^= c[(x - 1) % 5]
+        # rho and pi
+        for source, destination in PI:
+            lanes[source] ^= d[source % 5]
+            left, right = rotations[source]
+            if left:
+                np.left_shift(lanes[source], left, out=b[destination])
+                np.right_shift(lanes[source], right, out=temp)
+                b[destination] |= temp
+            else:
+                b[destination][:] = lanes[source]
+        # chi and iota
+        for lane, next_lane, after_next_lane in CHI:
+            np.invert(b[next_lane], out=temp)
+            temp &= b[after_next_lane]
+            np.bitwise_xor(b[lane], temp, out=lanes[lane])
+        lanes[0] ^= np.uint64(round_constant)
+
+
+class DS_NumpyPow:
+    """DeepSeekHashV1 search without the wasm module, hashes a block of candidate nonces per Keccak pass."""
+
+    def __init__(self, batch_size: int = 8192):
+        self.batch_size = batch_size
+
+    def _hash_block(self, prefix: bytes, nonces: np.ndarray, digits: int) -> np.ndarray:
+        """First DIGEST_LANES lanes of the digests of prefix + nonce, nonces all have the given number of digits."""
+        length = len(prefix) + digits
+        blocks = np.zeros((len(nonces), RATE), dtype=np.uint8)
+        blocks[:, : len(prefix)] = np.frombuffer(prefix, dtype=np.uint8)
+        remaining = nonces.copy()
+        for position in range(length - 1, len(prefix) - 1, -1):
+            blocks[:, position] = remaining % 10 + 48
+            remaining //= 10
+        # SHA3 padding, both bits land in one byte when the message fills the block but one byte
+        blocks[:, length] = 0x06
+        blocks[:, RATE - 1] |= 0x80
+
+        state = np.zeros((25, len(nonces)), dtype=np.uint64)
+        state[: RATE // 8] = blocks.view("<u8").T
+        _keccak_f(state)
+        return state[:DIGEST_LANES].T
+
+    def calculate_answer(self, challenge, salt, difficulty, expire_at):
+        prefix = f"{salt}_{expire_at}_".encode()
+        target = np.frombuffer(bytes.fromhex(challenge), dtype="<u8")
+        if len(prefix) + len(str(int(difficulty))) >= RATE:
+            # never happens with DeepSeek's salts, a multi block message is not worth supporting
+            raise ValueError("The challenge prefix does not fit in one Keccak block")
+
+        start = 0
+        end = int(difficulty)
+        while start < end:
+            # a block holds nonces of one length only
+            digits = len(str(start))
+            stop = min(start + self.batch_size, end, 10**digits)
+            nonces = np.arange(start, stop, dtype=np.uint64)
+            matches = np.flatnonzero((self._hash_block(prefix, nonces, digits) == target).all(axis=1))
+            if len(matches):
+                return int(nonces[matches[0]])
+            start = stop
+        return None
+
+
+if __name__ == "__main__":
+    ds_numpy_pow = DS_NumpyPow()
+    challenge = "2ee17d427355d5d0bb1056a14d8ed6982f117db6c2e4046bc05f53c1546876b6"
+    salt = "e071bdd62e1dcb455990"
+    difficulty = 144000
+    expire_at = 1736928349211
+
+    answer = ds_numpy_pow.calculate_answer(challenge, salt, difficulty, expire_at)
+    print("Answer:", answer)  # 38385, the same as DS_WasmPow
+    assert answer == 38385
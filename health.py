@@ -0,0 +1,147 @@
+"""Circuit breakers with a rolling error rate and latency EWMA per provider and per provider account.
+
+A breaker opens when at least BREAKER_MIN_REQUESTS outcomes in the last HEALTH_WINDOW seconds have an error rate of
+BREAKER_ERROR_RATE or more. After BREAKER_OPEN_SECONDS it goes half-open and lets a single probe through, a success
+closes it and a failure opens it again for twice as long (capped at BREAKER_MAX_OPEN_SECONDS).
+"""
+
+import math
+import os
+import time
+from collections import deque
+from typing import Callable
+from fastapi import HTTPException
+from metrics import BREAKER_STATE
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+LATENCY_SMOOTHING = 0.2
+
+
+def _env_number(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self.outcomes: deque[tuple[float, bool]] = deque()
+        self.latency_ewma: float | None = None
+        self.opened_at = 0.0
+        self.open_seconds = _env_number("BREAKER_OPEN_SECONDS", 30)
+        self.probe_in_flight = False
+        self.last_error: str | None = None
+        BREAKER_STATE.labels(name).set(STATE_VALUES[CLOSED])
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        BREAKER_STATE.labels(self.name).set(STATE_VALUES[state])
+
+    def _trim(self, now: float) -> None:
+        window = _env_number("HEALTH_WINDOW", 60)
+        while self.outcomes and self.outcomes[0][0] < now - window:
+            self.outcomes.popleft()
+
+    @property
+    def error_rate(self) -> float:
+        self._trim(time.monotonic())
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, ok in self.outcomes if not ok) / len(self.outcomes)
+
+    @property
+    def retry_after(self) -> float:
+        return max(self.opened_at + self.open_seconds - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        """False means the target is skipped without a request. A half-open breaker admits one probe at a time."""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if self.retry_after > 0:
+                return False
+            self._set_state(HALF_OPEN)
+        if self.probe_in_flight:
+            return False
+        self.probe_in_flight = True
+        return True
+
+    def release_probe(self) -> None:
+        # the probe was cancelled before it produced an outcome, e.g. it lost a hedge
+        self.probe_in_flight = False
+
+    def record(self, ok: bool, latency: float | None = None, error: str | None = None) -> None:
+        now = time.monotonic()
+        self.outcomes.append((now, ok))
+        self._trim(now)
+        if latency is not None:
+            self.latency_ewma = (
+                latency if self.latency_ewma is None else self.latency_ewma + LATENCY_SMOOTHING * (latency - self.latency_ewma)
+            )
+        if not ok:
+            self.last_error = error
+
+        if self.state == HALF_OPEN:
+            self.probe_in_flight = False
+            if ok:
+                self.outcomes.clear()
+                self.open_seconds = _env_number("BREAKER_OPEN_SECONDS", 30)
+                self._set_state(CLOSED)
+            else:
+                self.open_seconds = min(self.open_seconds * 2, _env_number("BREAKER_MAX_OPEN_SECONDS", 600))
+                self.opened_at = now
+                self._set_state(OPEN)
+        elif self.state == CLOSED and not ok:
+            if len(self.outcomes) >= _env_number("BREAKER_MIN_REQUESTS", 5) and self.error_rate >= _env_number(
+                "BREAKER_ERROR_RATE", 0.5
+            ):
+                self.opened_at = now
+                self._set_state(OPEN)
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "error_rate": round(self.error_rate, 3),
+            "requests": len(self.outcomes),
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "retry_after_s": round(self.retry_after, 1) if self.state == OPEN else 0,
+            "last_error": self.last_error,
+        }
+
+
+class CircuitOpen(HTTPException):
+    def __init__(self, breaker: CircuitBreaker):
+        super().__init__(
+            status_code=503,
+            detail=f"{breaker.name} is unavailable after repeated failures",
+            headers={"Retry-After": str(max(math.ceil(breaker.retry_after), 1))},
+        )
+
+
+class HealthRegistry:
+    """Breakers keyed by provider and by provider:account, on_change(provider, healthy) follows the provider ones."""
+
+    def __init__(self, on_change: Callable[[str, bool], None] | None = None):
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.on_change = on_change
+
+    def get(self, provider: str, account: str | None = None) -> CircuitBreaker:
+        name = f"{provider}:{account}" if account else provider
+        if name not in self.breakers:
+            self.breakers[name] = CircuitBreaker(name)
+        return self.breakers[name]
+
+    def record(self, provider: str, account: str | None, ok: bool, latency: float | None = None, error: str | None = None):
+        breaker = self.get(provider)
+        was_closed = breaker.state == CLOSED
+        breaker.record(ok, latency, error)
+        if account:
+            self.get(provider, account).record(ok, latency, error)
+        if self.on_change is not None and was_closed != (breaker.state == CLOSED):
+            self.on_change(provider, breaker.state == CLOSED)
+
+    def snapshot(self) -> dict[str, dict]:
+        return {name: breaker.snapshot() for name, breaker in sorted(self.breakers.items())}
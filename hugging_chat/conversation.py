@@ -1,18 +1,30 @@
+import asyncio
 import json
+import mimetypes
 import random
 import string
 import httpx
 import os
 import yaml
 from fastapi import HTTPException
+from pydantic import ValidationError
 from urllib3 import encode_multipart_formdata
 from urllib3.fields import RequestField
-from utility import color_print, get_user_agent, update_nextchat_custom_models
+from schemas import HuggingChatData
+from utility import get_user_agent, update_nextchat_custom_models
+from logger import get_logger
+from prompt import TRANSCRIPT_SYSTEM_PROMPT
+from capture import capture_transport
+from images import IMAGE_EXTENSIONS, get_image_store, image_markdown
+from metrics import RETRIES, observe_stage, record_response
+
+logger = get_logger("hugging_chat")
 
 
 class HuggingChat_RE:
-    hugging_face_url = "https://huggingface.co"
+    hugging_face_url = os.environ.get("HUGGING_FACE_URL", "https://huggingface.co")
     chat_conversation_url = f"{hugging_face_url}/chat/conversation"
+    models_file = "hugging_chat/models.json"
     web_search = False
 
     def __init__(self, async_client: httpx.AsyncClient = None) -> None:
@@ -21,9 +33,11 @@ class HuggingChat_RE:
             "User-Agent": get_user_agent(),
             "Origin": self.hugging_face_url,
         }
-        self.async_client = async_client or httpx.AsyncClient()
+        self.async_client = async_client or httpx.AsyncClient(transport=capture_transport("hugging_chat"))
         self.conversation_id = None
         self.message_id = None
+        # conversation id -> images still downloading, the conversation is deleted only after them
+        self.conversation_images: dict[str, list[str]] = {}
         self.model_key_mapping = self._get_latest_models()
 
     @property
@@ -68,52 +82,54 @@ class HuggingChat_RE:
                 key = model_name.split("/")[-1].lower()
                 model_key_mapping[key] = model_name
 
-        existing_models_file = "hugging_chat/models.json"
-        with open(existing_models_file, "r") as file:
+        with open(self.models_file, "r") as file:
             existing_models = json.load(file)
 
         models_to_remove = set()
         if existing_models != model_key_mapping:
             models_to_remove = set(existing_models.keys()) - set(model_key_mapping.keys())
-            with open(existing_models_file, "w") as file:
+            with open(self.models_file, "w") as file:
                 json.dump(model_key_mapping, file, indent=4)
 
         update_nextchat_custom_models(model_key_mapping.keys(), models_to_remove)
         return model_key_mapping
 
-    async def _init_conversation(self, model: str, system_prompt: str) -> None:
+    async def _init_conversation(self, model: str, system_prompt: str) -> tuple[str, str]:
         max_retries = 3
         retries = 0
 
         while retries <= max_retries:
             try:
-                self.conversation_id = await self._find_conversation_id(model, system_prompt)
-                self.message_id = await self._find_message_id()
-                break
+                # kept local, concurrent requests share this instance
+                conversation_id = await self._find_conversation_id(model, system_prompt)
+                message_id = await self._find_message_id(conversation_id)
+                self.conversation_id, self.message_id = conversation_id, message_id
+                return conversation_id, message_id
             except httpx.ReadTimeout:
-                color_print("ReadTimeout Error: Retrying...", "yellow")
+                logger.warning("ReadTimeout Error: Retrying...")
+                RETRIES.labels("hugging_chat", "timeout").inc()
                 retries += 1
-        if retries == max_retries:
-            color_print("Max retries exceeded. Unable to initialize conversation.", "red")
-            raise HTTPException(status_code=500, detail="Unable to initialize conversation.")
+        logger.error("Max retries exceeded. Unable to initialize conversation.")
+        raise HTTPException(status_code=500, detail="Unable to initialize conversation.")
 
     async def _find_conversation_id(self, model: str, system_prompt: str) -> str:
         payload = {"model": model, "preprompt": system_prompt}
         response = await self.async_client.post(self.chat_conversation_url, json=payload, headers=self.headers)
+        record_response("hugging_chat", response.status_code)
         if response.status_code == 401:
             raise HTTPException(status_code=401, detail="Invalid Hugging Face chat token.")
         response.raise_for_status()
         response_json = response.json()
-        color_print(f"Initialised Conversation ID: {response_json['conversationId']}", "green")
+        logger.debug("Initialised Conversation ID: %s", response_json["conversationId"])
         return response_json["conversationId"]
 
-    async def _find_message_id(self) -> str:
-        url = f"{self.chat_conversation_url}/{self.conversation_id}/__data.json?x-sveltekit-invalidated=11"
+    async def _find_message_id(self, conversation_id: str) -> str:
+        url = f"{self.chat_conversation_url}/{conversation_id}/__data.json?x-sveltekit-invalidated=11"
         response = await self.async_client.get(url, headers=self.headers)
         response.raise_for_status()
         response_json = json.loads(response.text.split("\n")[0])
         message_id = response_json["nodes"][1]["data"][3]
-        color_print(f"Initialised Message ID: {message_id}", "green")
+        logger.debug("Initialised Message ID: %s", message_id)
         return message_id
 
     async def delete_all_conversation(self) -> None:
@@ -121,31 +137,75 @@ class HuggingChat_RE:
         headers = self.headers | {"Content-Type": f"multipart/form-data; boundary={self.generate_random_boundary()}"}
         response = await self.async_client.delete(delete_url, headers=headers)
         response.raise_for_status()
-        color_print("All conversation deleted.", "green")
-
-    async def generate_image(self, sha: str):
-        if not self.conversation_id:
-            await self._init_conversation()
-        url = f"{self.chat_conversation_url}/{self.conversation_id}/output/{sha}"
-        response = await self.async_client.get(url, headers=self.headers)
-        response.raise_for_status()
-        return response
+        logger.info("All conversation deleted.")
+
+    async def delete_conversation(self, conversation_id: str) -> None:
+        image_store = get_image_store()
+        downloads = [
+            image_store.downloads[file_name]
+            for file_name in self.conversation_images.pop(conversation_id, [])
+            if file_name in image_store.downloads
+        ]
+        if downloads:
+            # the images are fetched from the conversation, but a stuck download must not leave it upstream for good
+            _, pending = await asyncio.wait(downloads, timeout=float(os.environ.get("HUGGING_CHAT_IMAGE_WAIT", 300)))
+            if pending:
+                logger.warning("Deleting conversation %s with %s image downloads unfinished", conversation_id, len(pending))
+        url = f"{self.chat_conversation_url}/{conversation_id}"
+        response = await self.async_client.delete(url, headers=self.headers)
+        record_response("hugging_chat", response.status_code)
+        logger.debug("Deleted conversation %s: %s", conversation_id, response.status_code)
+
+    async def iter_image(self, conversation_id: str, sha: str):
+        url = f"{self.chat_conversation_url}/{conversation_id}/output/{sha}"
+        async with self.async_client.stream("GET", url, headers=self.headers) as response:
+            record_response("hugging_chat", response.status_code)
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                yield chunk
+
+    async def iter_text(self, response: httpx.Response):
+        """Text deltas of a conversation stream, one json object per line.
+
+        Generated images are downloaded in the background and show up as markdown links to /image.
+        """
+        conversation_id = response.request.url.path.rsplit("/", 1)[-1]
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            try:
+                data = HuggingChatData(**json.loads(line))
+            except (json.JSONDecodeError, ValidationError):
+                continue
+            if data.type == "file" and data.sha:
+                extension = (mimetypes.guess_extension(data.mime or "") or "").lstrip(".")
+                if extension not in IMAGE_EXTENSIONS:
+                    continue
+                file_name = get_image_store().download(
+                    f"hugging_chat:{data.sha}", extension, lambda sha=data.sha: self.iter_image(conversation_id, sha)
+                )
+                self.conversation_images.setdefault(conversation_id, []).append(file_name)
+                yield image_markdown(file_name, data.name or "image")
+            # the final tokens come padded with null characters
+            elif data.type == "stream" and data.token and data.token.strip("\x00"):
+                yield data.token.strip("\x00")
 
     async def request_conversation(
         self,
         query: str,
         model: str,
-        system_prompt: str = "Act as an AI assistant that responds to user inputs in the language they use. Parse the provided JSON-formatted conversation history, but respond only to the final user message without referencing the JSON format. Maintain consistency with previous responses and adapt to the user's language preference.",
-    ):
+        system_prompt: str = TRANSCRIPT_SYSTEM_PROMPT,
+    ) -> tuple[str, httpx.Response]:
         if not self.hf_chat:
             raise HTTPException(status_code=400, detail="Please set the HUGGING_CHAT_TOKEN environment variable.")
 
-        await self._init_conversation(
-            model=self.model_key_mapping.get(model),
-            system_prompt=system_prompt,
-        )
+        with observe_stage("hugging_chat", "session_create"):
+            conversation_id, message_id = await self._init_conversation(
+                model=self.model_key_mapping.get(model),
+                system_prompt=system_prompt,
+            )
 
-        url = f"{self.chat_conversation_url}/{self.conversation_id}"
+        url = f"{self.chat_conversation_url}/{conversation_id}"
 
         request_fields = [
             RequestField(
@@ -153,7 +213,7 @@ class HuggingChat_RE:
                 data=json.dumps(
                     {
                         "inputs": query,
-                        "id": self.message_id,
+                        "id": message_id,
                         "is_retry": False,
                         "is_continue": False,
                         "web_search": self.web_search,
@@ -167,6 +227,8 @@ class HuggingChat_RE:
         content, content_type = encode_multipart_formdata(request_fields, boundary=self.generate_random_boundary())
         headers = self.headers | {"Content-Type": content_type}
         req = self.async_client.build_request("POST", url, content=content, headers=headers, timeout=None)
-        response = await self.async_client.send(req, stream=True)
-        color_print(f"Hugging Chat Response Status Code: {response.status_code}", "blue")
-        return response
+        with observe_stage("hugging_chat", "upstream_ttfb"):
+            response = await self.async_client.send(req, stream=True)
+        record_response("hugging_chat", response.status_code)
+        logger.debug("Hugging Chat Response Status Code: %s", response.status_code)
+        return conversation_id, response
@@ -0,0 +1,286 @@
+"""Store for generated images, served by /image/{file_name} and filled by the download pipeline.
+
+A file name is a sha256 hex digest plus an extension, taken over the upstream asset id rather than the content: the
+stream links to an image before its bytes arrive, and an asset id never changes its content either. The extension is
+the provider's guess, responses take their Content-Type from the magic bytes of the file. Responses carry the hash as ETag with an immutable Cache-Control and repeat loads become 304s. Files up
+to IMAGE_MEMORY_MAX_FILE_BYTES stay in an in-memory LRU so hot thumbnails skip the disk. A background task deletes
+files older than IMAGE_MAX_AGE_DAYS, then the least recently used ones while the directory is over IMAGE_DIR_MAX_BYTES.
+
+Providers hand their generated images to download(), which returns the local name at once so the chat stream can link
+to it while the file is still being fetched. A request for an image that is still downloading waits for it, at most
+IMAGE_WAIT_TIMEOUT seconds before it gets a 503.
+"""
+
+import asyncio
+import hashlib
+import mimetypes
+import os
+import re
+import time
+from collections import OrderedDict
+from contextlib import suppress
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import AsyncIterator, Callable
+import anyio
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response
+from logger import get_logger
+from metrics import record_cache
+
+logger = get_logger("images")
+
+IMAGE_EXTENSIONS = ("png", "jpg", "jpeg", "webp", "gif")
+FILE_NAME_PATTERN = re.compile(rf"^([0-9a-f]{{64}})\.({'|'.join(IMAGE_EXTENSIONS)})$")
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# half written files of a crashed save are removed after this many seconds
+TEMP_FILE_MAX_AGE = 3600
+# (offset, signature, media type), upstreams do not always send the format their asset names suggest
+MAGIC_BYTES = (
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF8", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+)
+MAGIC_BYTES_LENGTH = 12
+
+
+def _sniff_media_type(head: bytes, file_name: str) -> str | None:
+    for offset, signature, media_type in MAGIC_BYTES:
+        if head[offset : offset + len(signature)] == signature:
+            return media_type
+    return mimetypes.guess_type(file_name)[0]
+
+
+def _parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """Inclusive byte range of a single range request, None to answer with the whole file."""
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        # multipart ranges are not worth it for images, a full 200 is a valid answer
+        return None
+    start, _, end = ranges.strip().partition("-")
+    try:
+        if not start:
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def _is_not_modified(request: Request, etag: str, last_modified: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return any(tag.strip().removeprefix("W/") in (etag, "*") for tag in if_none_match.split(","))
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class ImageStore:
+    def __init__(
+        self,
+        directory: str,
+        memory_max_bytes: int,
+        memory_max_file_bytes: int,
+        max_bytes: int,
+        max_age: float,
+        download_concurrency: int,
+        wait_timeout: float,
+    ):
+        self.directory = Path(directory)
+        self.memory_max_bytes = memory_max_bytes
+        self.memory_max_file_bytes = memory_max_file_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.memory_bytes = 0
+        self.memory: OrderedDict[str, tuple[bytes, float]] = OrderedDict()
+        self.downloads: dict[str, asyncio.Task] = {}
+        self.download_slots = asyncio.Semaphore(download_concurrency)
+        self.wait_timeout = wait_timeout
+
+    def download(self, source: str, extension: str, fetch: Callable[[], AsyncIterator[bytes]]) -> str:
+        """Fetches an upstream image in the background and returns its file name right away.
+
+        source is the upstream id of the image, every request for the same id shares one download.
+        """
+        file_name = f"{hashlib.sha256(source.encode()).hexdigest()}.{extension.lower().lstrip('.')}"
+        if FILE_NAME_PATTERN.match(file_name) is None:
+            raise ValueError(f"Unsupported image extension {extension}")
+        if file_name not in self.downloads:
+            task = asyncio.create_task(self._download(file_name, fetch), name=file_name)
+            self.downloads[file_name] = task
+            task.add_done_callback(self._download_done)
+        return file_name
+
+    async def _download(self, file_name: str, fetch: Callable[[], AsyncIterator[bytes]]) -> None:
+        path = self.directory / file_name
+        exists = await anyio.Path(path).exists()
+        record_cache("image_download", exists)
+        if exists:
+            return
+        async with self.download_slots:
+            await anyio.Path(self.directory).mkdir(parents=True, exist_ok=True)
+            temp_path = path.with_name(f".{file_name}.{os.getpid()}.tmp")
+            try:
+                # chunks go straight to disk, memory stays bounded whatever the image size
+                async with await anyio.open_file(temp_path, "wb") as file:
+                    async for chunk in fetch():
+                        await file.write(chunk)
+                await asyncio.to_thread(os.replace, temp_path, path)
+            except BaseException:
+                with suppress(OSError):
+                    await anyio.Path(temp_path).unlink()
+                raise
+
+    def _download_done(self, task: asyncio.Task) -> None:
+        self.downloads.pop(task.get_name(), None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Image download %s failed: %r", task.get_name(), task.exception())
+
+    async def wait(self, file_name: str) -> None:
+        task = self.downloads.get(file_name)
+        if task is not None:
+            # leaves the download running when the waiter is cancelled or gives up
+            done, _ = await asyncio.wait([task], timeout=self.wait_timeout)
+            if not done:
+                raise HTTPException(status_code=503, detail="Image is still downloading", headers={"Retry-After": "5"})
+
+    def _remember(self, file_name: str, content: bytes, mtime: float) -> None:
+        if len(content) > self.memory_max_file_bytes:
+            return
+        self._forget(file_name)
+        self.memory[file_name] = (content, mtime)
+        self.memory_bytes += len(content)
+        while self.memory_bytes > self.memory_max_bytes:
+            self._forget(next(iter(self.memory)))
+
+    def _forget(self, file_name: str) -> None:
+        entry = self.memory.pop(file_name, None)
+        if entry is not None:
+            self.memory_bytes -= len(entry[0])
+
+    async def response(self, request: Request, file_name: str) -> Response:
+        match = FILE_NAME_PATTERN.match(file_name)
+        if match is None:
+            raise HTTPException(status_code=404, detail="Image not found")
+
+        await self.wait(file_name)
+        entry = self.memory.get(file_name)
+        record_cache("image", entry is not None)
+        if entry is not None:
+            self.memory.move_to_end(file_name)
+            content, mtime = entry
+        else:
+            path = self.directory / file_name
+            try:
+                stat_result = await anyio.Path(path).stat()
+            except FileNotFoundError:
+                raise HTTPException(status_code=404, detail="Image not found")
+            content, mtime = None, stat_result.st_mtime
+
+        etag = f'"{match.group(1)}"'
+        last_modified = formatdate(mtime, usegmt=True)
+        headers = {"ETag": etag, "Last-Modified": last_modified, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+        if _is_not_modified(request, etag, last_modified, mtime):
+            return Response(status_code=304, headers=headers)
+
+        if content is None:
+            if stat_result.st_size > self.memory_max_file_bytes:
+                async with await anyio.open_file(path, "rb") as file:
+                    media_type = _sniff_media_type(await file.read(MAGIC_BYTES_LENGTH), file_name)
+                # starlette streams large files itself, including Range, If-Range and HEAD
+                return FileResponse(path, headers=headers, media_type=media_type, stat_result=stat_result)
+            content = await anyio.Path(path).read_bytes()
+            self._remember(file_name, content, mtime)
+        media_type = _sniff_media_type(content[:MAGIC_BYTES_LENGTH], file_name)
+
+        status_code = 200
+        range_header = request.headers.get("range")
+        if range_header and request.headers.get("if-range", etag) in (etag, last_modified):
+            byte_range = _parse_range(range_header, len(content))
+            if byte_range is not None:
+                start, end = byte_range
+                headers["Content-Range"] = f"bytes {start}-{end}/{len(content)}"
+                content = content[start : end + 1]
+                status_code = 206
+        headers["Content-Length"] = str(len(content))
+        if request.method == "HEAD":
+            content = b""
+        return Response(content, status_code=status_code, headers=headers, media_type=media_type)
+
+    def cleanup(self) -> list[str]:
+        """Blocking, returns the names of the deleted images."""
+        now = time.time()
+        images, removed = [], []
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return removed
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            stat_result = entry.stat()
+            if entry.name.endswith(".tmp"):
+                if now - stat_result.st_mtime > TEMP_FILE_MAX_AGE:
+                    os.remove(entry.path)
+            elif FILE_NAME_PATTERN.match(entry.name) and now - stat_result.st_mtime > self.max_age:
+                os.remove(entry.path)
+                removed.append(entry.name)
+            elif FILE_NAME_PATTERN.match(entry.name):
+                images.append((max(stat_result.st_atime, stat_result.st_mtime), stat_result.st_size, entry))
+
+        total_bytes = sum(size for _, size, _ in images)
+        for _, size, entry in sorted(images, key=lambda image: image[0]):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(entry.path)
+            removed.append(entry.name)
+            total_bytes -= size
+        return removed
+
+    async def run_cleanup(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = await asyncio.to_thread(self.cleanup)
+            except OSError as e:
+                logger.warning("Image cleanup failed: %r", e)
+                continue
+            for file_name in removed:
+                self._forget(file_name)
+            if removed:
+                logger.info("Removed %s generated images", len(removed))
+
+
+def image_markdown(file_name: str, alt_text: str = "image") -> str:
+    return f"\n![{alt_text}]({os.environ.get('API_HOST', 'http://localhost:5000')}/image/{file_name})\n"
+
+
+_image_store = None
+
+
+def get_image_store() -> ImageStore:
+    global _image_store
+    if _image_store is None:
+        _image_store = _create_image_store()
+    return _image_store
+
+
+def _create_image_store() -> ImageStore:
+    return ImageStore(
+        directory=os.environ.get("IMAGE_DIR", "generated_images"),
+        memory_max_bytes=int(os.environ.get("IMAGE_MEMORY_CACHE_BYTES", 32 * 1024 * 1024)),
+        memory_max_file_bytes=int(os.environ.get("IMAGE_MEMORY_MAX_FILE_BYTES", 1024 * 1024)),
+        max_bytes=int(os.environ.get("IMAGE_DIR_MAX_BYTES", 1024 * 1024 * 1024)),
+        max_age=float(os.environ.get("IMAGE_MAX_AGE_DAYS", 30)) * 86400,
+        download_concurrency=int(os.environ.get("IMAGE_DOWNLOAD_CONCURRENCY", 4)),
+        wait_timeout=float(os.environ.get("IMAGE_WAIT_TIMEOUT", 60)),
+    )
@@ -0,0 +1,130 @@
+"""Shares one upstream completion between identical requests that are in flight at the same time.
+
+NextChat sends the same request more than once: retries, the title and summary calls, several tabs with the same
+message. A request whose canonical key (ResponseCache.make_key) matches one already in flight attaches to its stream
+instead of opening another upstream session. Every caller reads the deltas from a replay buffer with its own cursor,
+a caller that joins late gets everything sent so far and a slow one never holds the others back. The upstream is
+cancelled once every caller has gone. The entry is dropped as soon as the upstream finishes, answers that are already
+complete are the job of the response cache.
+
+Coalescing is per API worker process and opt-in, INFLIGHT_COALESCING_ENABLED=true turns it on. Like the response
+cache it hands every caller of a sampled (temperature > 0) request the same answer, which separate users may not expect.
+"""
+
+import asyncio
+import os
+from typing import AsyncIterator, Awaitable, Callable
+from metrics import POOL_OCCUPANCY, record_cache
+from router import UpstreamStream
+
+
+class Flight:
+    """One upstream completion and the deltas it has produced so far."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.opened = asyncio.get_running_loop().create_future()
+        self.text_deltas: list[str] = []
+        self.finished = False
+        self.error: Exception | None = None
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+        self.task: asyncio.Task | None = None
+
+    def notify(self) -> None:
+        # wakes every cursor waiting at the end of the buffer, the next wait gets a fresh event
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class Subscription:
+    """A caller's view of a flight, used by generate_text in place of the UpstreamStream."""
+
+    def __init__(self, flight: Flight, release: Callable[[Flight], Awaitable]):
+        self.flight = flight
+        self.release = release
+        self.closed = False
+        flight.subscribers += 1
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        flight = self.flight
+        cursor = 0
+        while True:
+            if cursor < len(flight.text_deltas):
+                cursor += 1
+                yield flight.text_deltas[cursor - 1]
+            elif flight.finished:
+                if flight.error is not None:
+                    raise flight.error
+                return
+            else:
+                await flight.changed.wait()
+
+    async def aclose(self) -> None:
+        """Idempotent like UpstreamStream.aclose, the last caller to leave cancels the upstream."""
+        if self.closed:
+            return
+        self.closed = True
+        await self.release(self.flight)
+
+
+class InflightRequests:
+    def __init__(self):
+        self.flights: dict[str, Flight] = {}
+
+    async def _run(self, flight: Flight, open_upstream: Callable[[], Awaitable[UpstreamStream]]) -> None:
+        upstream = None
+        try:
+            upstream = await open_upstream()
+            flight.opened.set_result(None)
+            async for text_delta in upstream:
+                flight.text_deltas.append(text_delta)
+                flight.notify()
+        except Exception as e:
+            # routing errors reach every waiting caller as they are, mid stream errors after the buffered deltas
+            if not flight.opened.done():
+                flight.opened.set_exception(e)
+            flight.error = e
+        finally:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+            POOL_OCCUPANCY.labels("inflight_requests").set(len(self.flights))
+            flight.finished = True
+            flight.notify()
+            if not flight.opened.done():
+                flight.opened.cancel()
+            if upstream is not None:
+                await upstream.aclose()
+
+    async def _release(self, flight: Flight) -> None:
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.finished:
+            # nobody reads the answer anymore, the upstream session and its admission slot go back at once
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+            flight.task.cancel()
+            await asyncio.wait((flight.task,))
+
+    async def open(self, key: str, open_upstream: Callable[[], Awaitable[UpstreamStream]]) -> Subscription:
+        """Attaches to the flight of key, or starts one with open_upstream, once its first delta has arrived."""
+        flight = self.flights.get(key)
+        record_cache("inflight", flight is not None)
+        if flight is None:
+            flight = Flight(key)
+            self.flights[key] = flight
+            POOL_OCCUPANCY.labels("inflight_requests").set(len(self.flights))
+            flight.task = asyncio.create_task(self._run(flight, open_upstream))
+        subscription = Subscription(flight, self._release)
+        try:
+            # shielded, a caller that gives up must not cancel the open for the others
+            await asyncio.shield(flight.opened)
+        except BaseException:
+            await subscription.aclose()
+            raise
+        return subscription
+
+
+def create_inflight_requests() -> InflightRequests | None:
+    if os.environ.get("INFLIGHT_COALESCING_ENABLED", "false").lower() != "true":
+        return None
+    return InflightRequests()
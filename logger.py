@@ -0,0 +1,68 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from contextvars import ContextVar
+
+request_id_var: ContextVar[str | None] = ContextVar("request_id", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.request_id:
+            entry["request_id"] = record.request_id
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Only attaches the request id and applies sampling on the caller side, formatting and the write happen
+    on the listener thread so a log call never blocks the event loop on stdout."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id_var.get()
+        return record
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # extra={"sample_rate": 0.01} keeps roughly 1% of a high volume event
+        sample_rate = getattr(record, "sample_rate", None)
+        if sample_rate is not None and random.random() >= sample_rate:
+            return
+        super().emit(record)
+
+
+def _setup_logging() -> logging.Logger:
+    root = logging.getLogger("llm_api")
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    root.propagate = False
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    root.addHandler(ContextQueueHandler(log_queue))
+    return root
+
+
+_root_logger = _setup_logging()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Pass values as %-style arguments, a disabled level then returns before any formatting happens."""
+    return _root_logger.getChild(name)
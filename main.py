@@ -1,25 +1,42 @@
 import httpx
 import asyncio
-import json
-import re
+import anyio
 import time
 import uuid
 from pathlib import Path
-from pydantic import ValidationError
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Request
+from fastapi import FastAPI, BackgroundTasks, Depends, Form, HTTPException, Request, UploadFile
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
+from contextlib import aclosing, asynccontextmanager
+from functools import cache, partial
 from environs import Env
 from schemas import (
-    CompletionsJsonData,
+    BatchJsonData,
     OpenAiData,
     Choices,
+    CompletionsJsonData,
     Message,
     Usage,
 )
+from coalesce import coalesce_deltas, get_settings as get_coalesce_settings
+from codec import ChunkEncoder, MessageEventEncoder, decode_completions, decode_messages, dumps, loads
 from deepseek_web.conversation import Deepseek_Web_RE
+from admission import AdmissionController
+from batches import ENDPOINTS, create_batch_runner
+from browser_pool import close_browser_pool
+from health import HealthRegistry
+from images import get_image_store
+from inflight import create_inflight_requests
+from router import Router
+from model_index import ModelIndex
+from metrics import record_cache, render_metrics
+from logger import request_id_var
+from prompt import render_prompt
+from profiling import get_recent_traces, require_admin, sample_stacks, span, start_trace
+from response_cache import create_response_cache, ResponseCache
+from tokenizer import CompletionCounter, count_prompt_tokens, count_tokens, get_usage, load_encodings
 from utility import get_response_headers
 
 env = Env()
@@ -29,22 +46,45 @@ API_HOST = env("API_HOST", "http://localhost:5000")
 
 async_client = httpx.AsyncClient()
 deepseek_web = None
+router = None
+batch_runner = None
+model_index = ModelIndex()
+response_cache = create_response_cache()
+inflight_requests = create_inflight_requests()
+admission = AdmissionController()
+health = HealthRegistry(on_change=model_index.set_health)
+image_store = get_image_store()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Initialize Deepseek_Web_RE in a separate process
-    global deepseek_web
+    global deepseek_web, router, batch_runner
+    model_index.refresh()
+    # tiktoken downloads its vocabularies on first use, that must not happen on a request
+    await load_encodings(float(env("TOKENIZER_LOAD_TIMEOUT", 30)))
+    # a broken stream_coalesce.json is reported now rather than on the first stream
+    get_coalesce_settings("default")
     try:
         deepseek_web = await asyncio.to_thread(Deepseek_Web_RE.create)
     except Exception as e:
         raise RuntimeError(f"Failed to initialize Deepseek: {str(e)}")
+    model_index.set_health("deepseek_web", True)
+    # the other providers are created by the router on first use
+    router = Router(admission, health, model_index, {"deepseek_web": deepseek_web})
+    image_cleanup = asyncio.create_task(image_store.run_cleanup(float(env("IMAGE_CLEANUP_INTERVAL", 3600))))
+    # picks up where the previous run stopped, finished lines are never sent again
+    batch_runner = create_batch_runner(complete_batch_line)
+    batch_task = asyncio.create_task(batch_runner.run())
     
     yield
     
     # Cleanup
+    image_cleanup.cancel()
+    batch_task.cancel()
+    await asyncio.to_thread(close_browser_pool)
     await async_client.aclose()
-    if deepseek_web:
-        await deepseek_web.async_session.aclose()
+    if router:
+        await router.aclose()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -62,73 +102,314 @@ async def load_env_middleware(request: Request, call_next):
     response = await call_next(request)
     return response
 
+@app.middleware("http")
+async def request_id_middleware(request: Request, call_next):
+    # correlates every log line of a request, NextChat or a proxy may already send one
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    token = request_id_var.set(request_id)
+    try:
+        with start_trace(request_id, f"{request.method} {request.url.path}"):
+            response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
 @app.get("/")
 async def home():
     return {"message": "Welcome to the API Home Route"}
 
+@app.get("/metrics")
+async def metrics():
+    content, content_type = render_metrics()
+    return Response(content, media_type=content_type)
+
+@app.get("/api/openai/v1/models")
+async def openai_models(request: Request):
+    headers = {"ETag": model_index.etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == model_index.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(model_index.body, media_type="application/json", headers=headers)
+
+@app.get("/api/openai/v1/models/{model_id}")
+async def openai_model(model_id: str):
+    model_card = model_index.get(model_id)
+    if model_card is None:
+        raise HTTPException(status_code=404, detail="Model not found")
+    return model_card
+
 @app.post("/api/openai/v1/chat/completions")
-async def openai_chat_completions(
-    comletions_json_data: CompletionsJsonData,
-    background_tasks: BackgroundTasks,
-):
+async def openai_chat_completions(request: Request, background_tasks: BackgroundTasks):
+    with span("decode_request"):
+        comletions_json_data = decode_completions(await request.body())
     model = comletions_json_data.model
     stream = comletions_json_data.stream
+    include_usage = not stream or bool((comletions_json_data.stream_options or {}).get("include_usage"))
     response_headers = get_response_headers(stream)
-    messages_str = json.dumps(
-        [jsonable_encoder(message, exclude_unset=True) for message in comletions_json_data.messages],
-        ensure_ascii=False,
+    text_deltas, get_completion_usage = await generate_text(comletions_json_data, background_tasks, include_usage)
+    if stream:
+        return StreamingResponse(
+            openai_stream(model, text_deltas, get_completion_usage if include_usage else None),
+            headers=response_headers,
+        )
+    content = "".join([text_delta async for text_delta in text_deltas])
+    return JSONResponse(get_completion_response(model, content, get_completion_usage()), headers=response_headers)
+
+@app.post("/api/anthropic/v1/messages")
+async def anthropic_messages(request: Request, background_tasks: BackgroundTasks):
+    with span("decode_request"):
+        message_json_data = decode_messages(await request.body())
+    model = message_json_data.model
+    stream = message_json_data.stream
+    messages = message_json_data.messages
+    if message_json_data.system:
+        messages = [Message(role="system", content=message_json_data.system)] + messages
+    # the same pipeline as the OpenAI route, only the framing of the deltas differs
+    comletions_json_data = CompletionsJsonData(
+        messages=messages,
+        model=model,
+        stream=stream,
+        temperature=message_json_data.temperature,
+        top_p=message_json_data.top_p,
     )
+    response_headers = get_response_headers(stream)
+    text_deltas, get_completion_usage = await generate_text(comletions_json_data, background_tasks, True)
+    if stream:
+        return StreamingResponse(
+            anthropic_stream(model, text_deltas, get_completion_usage), headers=response_headers
+        )
+    content = "".join([text_delta async for text_delta in text_deltas])
+    return JSONResponse(get_message_response(model, content, get_completion_usage()), headers=response_headers)
 
-    if deepseek_web is None:
+async def generate_text(
+    comletions_json_data: CompletionsJsonData,
+    background_tasks: BackgroundTasks,
+    include_usage: bool,
+    background: bool = False,
+):
+    """Text deltas of the answer, from the response cache or the routed upstream, and a getter of its usage."""
+    model = comletions_json_data.model
+    with span("render_messages"):
+        messages_str = render_prompt(comletions_json_data.messages, model)
+
+    if router is None:
         raise HTTPException(status_code=500, detail="Server not initialized properly")
 
-    if model in deepseek_web.models:
-        response = await deepseek_web.completions(messages_str)
-
-        async def content_generator():
-            async for line in response.aiter_lines():
-                if stream:
-                    yield line.decode("utf-8") + "\n"
-                else:
-                    if line:
-                        line_content = re.sub("^data: ", "", line)
-                        try:
-                            data = OpenAiData(**json.loads(line_content))
-                        except (json.JSONDecodeError, ValidationError):
-                            continue
-                        yield data.choices[0].delta.content
+    if router.get_policy(model) is None:
+        raise HTTPException(status_code=400, detail="Model not supported")
+
+    # the Anthropic stream asks for the usage twice, the prompt is counted once
+    get_prompt_tokens = cache(partial(count_prompt_tokens, comletions_json_data.messages, model))
+
+    request_key = cache_key = None
+    if response_cache is not None or inflight_requests is not None:
+        request_key = ResponseCache.make_key(comletions_json_data)
+    if response_cache is not None:
+        cache_key = request_key
+        cached_content = response_cache.get(cache_key)
+        record_cache("response", cached_content is not None)
+        if cached_content is not None:
+
+            def get_cached_usage() -> Usage:
+                return get_usage(get_prompt_tokens(), count_tokens(cached_content, model))
+
+            return iterate_text([cached_content]), get_cached_usage
 
+    open_upstream = partial(router.open, model, comletions_json_data, messages_str, background)
+    if inflight_requests is not None:
+        # a duplicate of a request in flight reads that request's stream instead of opening its own
+        upstream = await inflight_requests.open(request_key, open_upstream)
     else:
-        raise HTTPException(status_code=400, detail="Model not supported")
+        upstream = await open_upstream()
+    completion_counter = CompletionCounter(model) if include_usage else None
 
-    background_tasks.add_task(response.aclose)
-    return (
-        StreamingResponse(content_generator(), headers=response_headers)
-        if stream
-        else JSONResponse(
-            OpenAiData(
-                choices=[
-                    Choices(
-                        message=Message(
-                            role="assistant",
-                            content="".join([text_delta async for text_delta in content_generator()]),
-                        ),
-                        finish_reason="stop",
-                    )
-                ],
-                created=int(time.time()),
-                id=f"chatcmpl-{uuid.uuid4().hex[:29]}",
-                object="chat.completion",
-                model=model,
-                usage=Usage(prompt_tokens=0, completion_tokens=0, total_tokens=0),
-            ).model_dump(exclude_unset=True),
-            headers=response_headers,
-        )
+    def get_completion_usage() -> Usage:
+        return get_usage(get_prompt_tokens(), completion_counter.total)
+
+    async def text_generator():
+        text_deltas = []
+        try:
+            async for text_delta in upstream:
+                text_deltas.append(text_delta)
+                if completion_counter is not None:
+                    completion_counter.add(text_delta)
+                yield text_delta
+        finally:
+            # also runs when the client disconnects mid stream, starlette cancels the generator at that point
+            await upstream.aclose()
+        # only completed streams get here, errors and disconnects never fill the cache
+        if cache_key is not None:
+            response_cache.set(cache_key, "".join(text_deltas))
+
+    # covers responses whose generator never started
+    background_tasks.add_task(upstream.aclose)
+    return text_generator(), get_completion_usage
+
+def get_completion_response(model: str, content: str, usage: Usage) -> dict:
+    return OpenAiData(
+        choices=[Choices(message=Message(role="assistant", content=content), finish_reason="stop")],
+        created=int(time.time()),
+        id=f"chatcmpl-{uuid.uuid4().hex[:29]}",
+        object="chat.completion",
+        model=model,
+        usage=usage,
+    ).model_dump(exclude_unset=True)
+
+async def iterate_text(text_deltas: list[str]):
+    for text_delta in text_deltas:
+        yield text_delta
+
+async def openai_stream(model: str, text_deltas, get_completion_usage=None):
+    """OpenAI chunks for the text deltas of any provider, with the usage chunk before [DONE] when requested."""
+    chunk_encoder = ChunkEncoder(model)
+    async with aclosing(coalesce_deltas(text_deltas, model)) as text_deltas:
+        async for text_delta in text_deltas:
+            yield chunk_encoder.delta(text_delta)
+    yield chunk_encoder.stop()
+    if get_completion_usage is not None:
+        yield chunk_encoder.usage(get_completion_usage())
+    yield chunk_encoder.done()
+
+def get_message_response(model: str, content: str, usage: Usage) -> dict:
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": model,
+        "content": [{"type": "text", "text": content}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": usage.prompt_tokens, "output_tokens": usage.completion_tokens},
+    }
+
+async def anthropic_stream(model: str, text_deltas, get_completion_usage):
+    """Anthropic Messages events for the text deltas of any provider, each delta becomes one content_block_delta."""
+    event_encoder = MessageEventEncoder(model)
+    # the prompt side of the usage is known before the first delta, message_start carries it
+    yield event_encoder.start(get_completion_usage().prompt_tokens)
+    async with aclosing(coalesce_deltas(text_deltas, model)) as text_deltas:
+        async for text_delta in text_deltas:
+            yield event_encoder.delta(text_delta)
+    yield event_encoder.stop(get_completion_usage().completion_tokens)
+
+async def complete_batch_line(body: bytes) -> dict:
+    """Completion body for one request of a batch file, with the defaults of the OpenAI batch API."""
+    data = loads(body)
+    data.update(stream=False)
+    data.setdefault("temperature", 1)
+    data.setdefault("top_p", 1)
+    try:
+        comletions_json_data = decode_completions(dumps(data))
+    except RequestValidationError as e:
+        raise HTTPException(status_code=400, detail=jsonable_encoder(e.errors()))
+    background_tasks = BackgroundTasks()
+    try:
+        text_deltas, get_completion_usage = await generate_text(comletions_json_data, background_tasks, True, True)
+        content = "".join([text_delta async for text_delta in text_deltas])
+    finally:
+        await background_tasks()
+    return get_completion_response(comletions_json_data.model, content, get_completion_usage())
+
+def get_batch_runner():
+    if batch_runner is None:
+        raise HTTPException(status_code=500, detail="Server not initialized properly")
+    return batch_runner
+
+@app.post("/api/openai/v1/files")
+async def openai_upload_file(file: UploadFile, purpose: str = Form(...)):
+    if purpose != "batch":
+        raise HTTPException(status_code=400, detail="Only files with purpose batch are supported")
+    queue = get_batch_runner().queue
+    file_id = f"file-{uuid.uuid4().hex}"
+    # copied in chunks, a batch of thousands of prompts never sits in memory as a whole
+    async with await anyio.open_file(queue.file_path(file_id), "wb") as output:
+        while chunk := await file.read(1024 * 1024):
+            await output.write(chunk)
+    return await asyncio.to_thread(queue.add_file, file_id, purpose, file.filename or f"{file_id}.jsonl")
+
+@app.get("/api/openai/v1/files/{file_id}")
+async def openai_file(file_id: str):
+    file = await asyncio.to_thread(get_batch_runner().queue.get_file, file_id)
+    if file is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return file
+
+@app.get("/api/openai/v1/files/{file_id}/content")
+async def openai_file_content(file_id: str):
+    queue = get_batch_runner().queue
+    file = await asyncio.to_thread(queue.get_file, file_id)
+    if file is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return FileResponse(queue.file_path(file_id), media_type="application/jsonl", filename=file["filename"])
+
+@app.post("/api/openai/v1/batches")
+async def openai_create_batch(batch_json_data: BatchJsonData):
+    runner = get_batch_runner()
+    if batch_json_data.endpoint not in ENDPOINTS:
+        raise HTTPException(status_code=400, detail=f"endpoint must be one of {', '.join(ENDPOINTS)}")
+    input_file = await asyncio.to_thread(runner.queue.get_file, batch_json_data.input_file_id)
+    if input_file is None or input_file["purpose"] != "batch":
+        raise HTTPException(status_code=404, detail="Input file not found")
+    batch = await asyncio.to_thread(
+        runner.queue.create_batch,
+        batch_json_data.input_file_id,
+        batch_json_data.endpoint,
+        batch_json_data.completion_window,
+        batch_json_data.metadata,
     )
+    runner.notify()
+    return batch
+
+@app.get("/api/openai/v1/batches")
+async def openai_batches(limit: int = 20, after: str | None = None):
+    limit = min(max(limit, 1), 100)
+    batches = await asyncio.to_thread(get_batch_runner().queue.list_batches, limit + 1, after)
+    has_more = len(batches) > limit
+    batches = batches[:limit]
+    return {
+        "object": "list",
+        "data": batches,
+        "first_id": batches[0]["id"] if batches else None,
+        "last_id": batches[-1]["id"] if batches else None,
+        "has_more": has_more,
+    }
+
+@app.get("/api/openai/v1/batches/{batch_id}")
+async def openai_batch(batch_id: str):
+    batch = await asyncio.to_thread(get_batch_runner().queue.get_batch, batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return batch
+
+@app.post("/api/openai/v1/batches/{batch_id}/cancel")
+async def openai_cancel_batch(batch_id: str):
+    runner = get_batch_runner()
+    batch = await asyncio.to_thread(runner.queue.cancel_batch, batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    runner.notify()
+    return batch
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+async def admin_profile(seconds: float = 10, interval_ms: float = 5):
+    if not 0 < seconds <= 300:
+        raise HTTPException(status_code=400, detail="seconds must be between 0 and 300")
+    collapsed_stacks = await asyncio.to_thread(sample_stacks, seconds, interval_ms / 1000)
+    return PlainTextResponse(
+        collapsed_stacks, headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'}
+    )
+
+@app.get("/admin/traces", dependencies=[Depends(require_admin)])
+async def admin_traces(limit: int = 50):
+    return list(get_recent_traces(limit))
+
+@app.get("/admin/health", dependencies=[Depends(require_admin)])
+async def admin_health():
+    return health.snapshot()
 
-@app.get("/image/{file_name}")
-def image(file_name: str):
-    return FileResponse(f"generated_images/{file_name}")
+@app.api_route("/image/{file_name}", methods=["GET", "HEAD"])
+async def image(request: Request, file_name: str):
+    return await image_store.response(request, file_name)
 
 if __name__ == "__main__":
     import uvicorn
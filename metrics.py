@@ -0,0 +1,103 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator
+from profiling import record_span
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_LATENCY = Histogram(
+    "llm_api_stage_seconds",
+    "Latency of each provider stage: pow_solve, session_create, upstream_ttfb, stream, upload",
+    ["provider", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_RESPONSES = Counter(
+    "llm_api_upstream_responses_total", "Upstream responses by status code", ["provider", "status"]
+)
+RETRIES = Counter("llm_api_retries_total", "Upstream request retries", ["provider", "reason"])
+CACHE_HITS = Counter("llm_api_cache_hits_total", "Cache hits", ["cache"])
+CACHE_MISSES = Counter("llm_api_cache_misses_total", "Cache misses", ["cache"])
+INFLIGHT_STREAMS = Gauge(
+    "llm_api_inflight_streams", "Streams currently being relayed", ["provider"], multiprocess_mode="livesum"
+)
+POOL_OCCUPANCY = Gauge("llm_api_pool_occupancy", "Items in use or available per pool", ["pool"], multiprocess_mode="livesum")
+QUEUE_TIME = Histogram(
+    "llm_api_admission_queue_seconds", "Time spent waiting for a provider slot", ["provider", "priority"], buckets=LATENCY_BUCKETS
+)
+QUEUE_DEPTH = Gauge("llm_api_admission_queue_depth", "Requests waiting for a slot", ["queue"], multiprocess_mode="livesum")
+ROUTE_ATTEMPTS = Counter(
+    "llm_api_route_attempts_total", "Provider attempts made by the router by outcome: won, failed, skipped, cancelled", ["provider", "outcome"]
+)
+HEDGES = Counter("llm_api_hedges_total", "Hedged second attempts started because the first was slow", ["model"])
+BREAKER_STATE = Gauge(
+    "llm_api_breaker_state",
+    "Circuit breaker state per provider and account: 0 closed, 1 half-open, 2 open",
+    ["target"],
+    multiprocess_mode="max",
+)
+ADMISSION_REJECTIONS = Counter(
+    "llm_api_admission_rejections_total", "Requests rejected with 429 by admission control", ["queue", "reason"]
+)
+STREAM_FRAMES = Counter("llm_api_stream_frames_total", "SSE chunks sent by coalesced streams", ["model"])
+STREAM_FRAMES_SAVED = Counter(
+    "llm_api_stream_frames_saved_total", "Text deltas merged into an earlier chunk by stream coalescing", ["model"]
+)
+BATCH_LINES = Counter(
+    "llm_api_batch_lines_total", "Batch request lines processed by outcome: completed, failed, retried", ["outcome"]
+)
+
+
+@contextmanager
+def observe_stage(provider: str, stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        STAGE_LATENCY.labels(provider, stage).observe(end - start)
+        record_span(f"{provider}.{stage}", start, end)
+
+
+def record_response(provider: str, status_code: int) -> None:
+    UPSTREAM_RESPONSES.labels(provider, str(status_code)).inc()
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    (CACHE_HITS if hit else CACHE_MISSES).labels(cache).inc()
+
+
+async def observe_stream(provider: str, lines: AsyncIterator) -> AsyncIterator:
+    """Relay an upstream stream while tracking the in-flight gauge and the stream duration."""
+    inflight = INFLIGHT_STREAMS.labels(provider)
+    inflight.inc()
+    start = time.perf_counter()
+    try:
+        async for line in lines:
+            yield line
+    finally:
+        # the provider's own cleanup runs now instead of whenever the generator is collected
+        if hasattr(lines, "aclose"):
+            await lines.aclose()
+        end = time.perf_counter()
+        inflight.dec()
+        STAGE_LATENCY.labels(provider, "stream").observe(end - start)
+        record_span(f"{provider}.stream", start, end)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    # with several workers every process writes to PROMETHEUS_MULTIPROC_DIR and the scrape merges them
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import time
+from schemas import ModelCapabilities, ModelCard, ModelList
+from utility import get_model_vendor
+from deepseek_web.conversation import Deepseek_Web_RE
+from chatgpt_web.conversation import ChatGPT_Web_RE
+
+# providers whose catalogs live in json files, value is the side of the mapping holding the model ids
+CATALOG_FILES = {
+    "theb_ai": ("theb_ai/models.json", "values"),
+    "hugging_chat": ("hugging_chat/models.json", "keys"),
+}
+# provider level capabilities, the model name patterns below are added on top
+PROVIDER_CAPABILITIES = {
+    "deepseek_web": {"vision": False, "tools": False, "thinking": False},
+    "chatgpt_web": {"vision": True, "tools": True, "thinking": False},
+    "theb_ai": {"vision": False, "tools": False, "thinking": False},
+    "hugging_chat": {"vision": False, "tools": True, "thinking": False},
+}
+CAPABILITY_PATTERNS = {
+    "vision": ("vision", "gpt-4o", "claude-3", "gemini"),
+    "thinking": ("thinking", "o1", "o3", "r1", "qwq", "reasoner"),
+}
+
+
+class ModelIndex:
+    """In-memory index of every backend model, the response body and ETag are rebuilt only on change."""
+
+    def __init__(self):
+        self.catalogs: dict[str, list[str]] = {}
+        self.health: dict[str, bool] = {}
+        self.cards: dict[str, ModelCard] = {}
+        self.body = b""
+        self.etag = ""
+
+    @staticmethod
+    def _load_catalogs() -> dict[str, list[str]]:
+        catalogs = {
+            "deepseek_web": list(Deepseek_Web_RE.models),
+            "chatgpt_web": list(ChatGPT_Web_RE.models),
+        }
+        for provider, (path, side) in CATALOG_FILES.items():
+            try:
+                with open(path, "r") as file:
+                    mapping = json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                mapping = {}
+            catalogs[provider] = list(getattr(mapping, side)())
+        return catalogs
+
+    @staticmethod
+    def _get_capabilities(provider: str, model: str) -> ModelCapabilities:
+        capabilities = dict(PROVIDER_CAPABILITIES.get(provider, {}))
+        for capability, patterns in CAPABILITY_PATTERNS.items():
+            if any(pattern in model for pattern in patterns):
+                capabilities[capability] = True
+        return ModelCapabilities(**capabilities)
+
+    def _rebuild(self) -> None:
+        created = int(time.time())
+        cards = {}
+        for provider, models in self.catalogs.items():
+            for model in models:
+                # the first provider registered for a model serves it
+                if model in cards:
+                    continue
+                cards[model] = ModelCard(
+                    id=model,
+                    created=created,
+                    owned_by=get_model_vendor(model) or provider,
+                    provider=provider,
+                    capabilities=self._get_capabilities(provider, model),
+                    healthy=self.health.get(provider, False),
+                )
+        content = ModelList(data=list(cards.values())).model_dump_json().encode()
+        # created changes on every rebuild, so only hash the stable part of the cards
+        stable = json.dumps([card.model_dump(exclude={"created"}) for card in cards.values()]).encode()
+        self.cards = cards
+        self.body = content
+        self.etag = f'"{hashlib.sha1(stable).hexdigest()}"'
+
+    def refresh(self) -> None:
+        self.catalogs = self._load_catalogs()
+        self._rebuild()
+
+    def set_health(self, provider: str, healthy: bool) -> None:
+        if self.health.get(provider) != healthy:
+            self.health[provider] = healthy
+            self._rebuild()
+
+    def get(self, model: str) -> ModelCard | None:
+        return self.cards.get(model)
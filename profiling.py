@@ -0,0 +1,102 @@
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+from fastapi import HTTPException, Request
+
+trace_var: ContextVar[dict | None] = ContextVar("trace", default=None)
+recent_traces: deque[dict] = deque(maxlen=int(os.environ.get("TRACE_BUFFER_SIZE", 200)))
+_profile_lock = threading.Lock()
+
+
+def require_admin(request: Request) -> None:
+    """FastAPI dependency for the admin routes, they stay disabled until ADMIN_TOKEN is set."""
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled, set ADMIN_TOKEN to enable them")
+    if request.headers.get("authorization") != f"Bearer {admin_token}":
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+def _collapse_stack(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> str:
+    """Sample every thread's stack for the given time and return them in collapsed format (flamegraph.pl input)."""
+    if not _profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    try:
+        own_thread_id = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread_id:
+                    stacks[_collapse_stack(frame)] += 1
+            time.sleep(interval)
+    finally:
+        _profile_lock.release()
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+
+@contextmanager
+def start_trace(request_id: str, name: str):
+    """Trace a request when TRACE_SAMPLE_RATE picks it, untraced requests only pay for one random() call.
+
+    duration_ms ends when the response starts, spans of a streamed body are still appended afterwards.
+    """
+    sample_rate = float(os.environ.get("TRACE_SAMPLE_RATE", 0))
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        yield None
+        return
+    start = time.perf_counter()
+    trace = {"request_id": request_id, "name": name, "start": time.time(), "perf_start": start, "spans": []}
+    token = trace_var.set(trace)
+    try:
+        yield trace
+    finally:
+        trace["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        trace_var.reset(token)
+        recent_traces.append(trace)
+
+
+def get_recent_traces(limit: int) -> Iterator[dict]:
+    for trace in list(recent_traces)[-limit:]:
+        yield {key: value for key, value in trace.items() if key != "perf_start"}
+
+
+def record_span(name: str, start: float, end: float) -> None:
+    """Add a finished span measured with time.perf_counter to the current trace, if any."""
+    trace = trace_var.get()
+    if trace is not None:
+        trace["spans"].append(
+            {
+                "name": name,
+                "offset_ms": round((start - trace["perf_start"]) * 1000, 3),
+                "duration_ms": round((end - start) * 1000, 3),
+            }
+        )
+
+
+@contextmanager
+def span(name: str):
+    trace = trace_var.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, start, time.perf_counter())
@@ -0,0 +1,219 @@
+"""Renders the chat history into the single prompt string the web upstreams take.
+
+Every message becomes one "Role: text" turn of a plain transcript instead of a JSON array, images are reduced to an
+[image] marker. The rendered transcript is cached under a chained digest of its messages, the key of every message is
+the digest of the previous key and the message, so a follow-up request finds the transcript of its longest known
+prefix and only renders and counts its new messages. Every message is still hashed, the request carries the whole
+history. PROMPT_CACHE_CHARS (32M by default) bounds the cached transcripts, oldest conversations go first. When the transcript is over the model's token budget the oldest turns after
+the system prompt are dropped, leaving a short digest of the user questions they contained.
+
+Budgets come from PROMPT_BUDGETS_FILE (prompt_budgets.json by default), a map of model to tokens with a "default" row.
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from functools import lru_cache
+from schemas import Message
+from tokenizer import count_tokens
+
+# every upstream gets this instead of the instructions for parsing a JSON history
+TRANSCRIPT_SYSTEM_PROMPT = "Act as an AI assistant that responds to user inputs in the language they use. The conversation so far is given as a transcript of turns prefixed with their role, respond only to the final User turn without a role prefix. Maintain consistency with previous responses and adapt to the user's language preference."
+DEFAULT_BUDGET = 16000
+# share of the budget the digest of dropped turns may take
+DIGEST_SHARE = 0.1
+DIGEST_CHARS = 120
+# rendered transcripts kept for the follow-up requests of their conversations
+TRANSCRIPT_CACHE_CHARS = int(os.environ.get("PROMPT_CACHE_CHARS", 32_000_000))
+TRANSCRIPT_CACHE_ENTRIES = 4096
+ROLE_NAMES = {"system": "System", "user": "User", "assistant": "Assistant", "tool": "Tool", "developer": "System"}
+
+
+@lru_cache(maxsize=1)
+def _load_budgets(path: str, mtime: float) -> dict[str, int]:
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def get_budget(model: str) -> int:
+    path = os.environ.get("PROMPT_BUDGETS_FILE", "prompt_budgets.json")
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = 0.0
+    budgets = _load_budgets(path, mtime)
+    return int(budgets.get(model, budgets.get("default", DEFAULT_BUDGET)))
+
+
+def _get_text(message: Message) -> str:
+    content = message.content
+    if content is None:
+        text = ""
+    elif isinstance(content, str):
+        text = content
+    elif isinstance(content, list):
+        text = " ".join(part.text if part.type == "text" else "[image]" for part in content if part.text or part.type != "text")
+    else:
+        text = " ".join(part if isinstance(part, str) else "[image]" for part in content.parts)
+    if message.tool_calls:
+        text = f"{text} {json.dumps(message.tool_calls, separators=(',', ':'), ensure_ascii=False)}".strip()
+    return text
+
+
+class _Transcript:
+    """Every turn of a conversation prefix rendered and counted, turn i starts at offsets[i] of text."""
+
+    def __init__(self, text: str, offsets: list[int], tokens: list[int]):
+        self.text = text
+        self.offsets = offsets
+        self.tokens = tokens
+
+    def turn(self, index: int) -> str:
+        end = self.offsets[index + 1] - 2 if index + 1 < len(self.offsets) else len(self.text)
+        return self.text[self.offsets[index]:end]
+
+
+# prefix key of the messages -> their transcript, the latest prefix of each conversation
+_transcripts: OrderedDict[bytes, _Transcript] = OrderedDict()
+_transcript_chars = 0
+
+
+def _prefix_keys(messages: list[Message], model: str) -> list[bytes]:
+    """Chained digests, the key of message i is the digest of the key of message i - 1 and message i."""
+    key = hashlib.blake2b(model.encode(), digest_size=16).digest()
+    keys = []
+    for message in messages:
+        digest = hashlib.blake2b(key, digest_size=16)
+        digest.update(f"{message.role}\0{message.name or ''}\0".encode())
+        digest.update(_get_text(message).encode())
+        key = digest.digest()
+        keys.append(key)
+    return keys
+
+
+def _forget_transcript(key: bytes) -> None:
+    global _transcript_chars
+    transcript = _transcripts.pop(key, None)
+    if transcript is not None:
+        _transcript_chars -= len(transcript.text)
+
+
+def _remember_transcript(key: bytes, transcript: _Transcript) -> None:
+    global _transcript_chars
+    _forget_transcript(key)
+    _transcripts[key] = transcript
+    _transcript_chars += len(transcript.text)
+    while len(_transcripts) > 1 and (_transcript_chars > TRANSCRIPT_CACHE_CHARS or len(_transcripts) > TRANSCRIPT_CACHE_ENTRIES):
+        _forget_transcript(next(iter(_transcripts)))
+
+
+def _render_turn(role: str, name: str | None, text: str, model: str) -> tuple[str, int]:
+    label = ROLE_NAMES.get(role, role.capitalize())
+    if name:
+        label = f"{label} ({name})"
+    turn = f"{label}: {text}"
+    # the blank line between turns is about one more token
+    return turn, count_tokens(turn, model) + 1
+
+
+def _get_transcript(messages: list[Message], model: str) -> _Transcript:
+    """The transcript of messages, only the messages after the longest cached prefix are rendered and counted."""
+    keys = _prefix_keys(messages, model)
+    start = len(keys)
+    while start and keys[start - 1] not in _transcripts:
+        start -= 1
+    if start == len(keys):
+        _transcripts.move_to_end(keys[-1])
+        return _transcripts[keys[-1]]
+
+    parts, offsets, tokens, length = [], [], [], 0
+    if start:
+        previous = _transcripts[keys[start - 1]]
+        parts.append(previous.text)
+        offsets.extend(previous.offsets)
+        tokens.extend(previous.tokens)
+        length = len(previous.text) + 2
+        # the conversation moved on, its shorter prefix is not asked for again
+        _forget_transcript(keys[start - 1])
+    for message in messages[start:]:
+        turn, turn_tokens = _render_turn(message.role or "user", message.name, _get_text(message), model)
+        parts.append(turn)
+        offsets.append(length)
+        tokens.append(turn_tokens)
+        length += len(turn) + 2
+    transcript = _Transcript("\n\n".join(parts), offsets, tokens)
+    _remember_transcript(keys[-1], transcript)
+    return transcript
+
+
+@lru_cache(maxsize=8192)
+def _count_digest_line(question: str, model: str) -> int:
+    return count_tokens(question, model) + 1
+
+
+def _digest_line(text: str, model: str) -> tuple[str, int]:
+    question = " ".join(text.split())
+    if len(question) > DIGEST_CHARS:
+        question = f"{question[:DIGEST_CHARS]}..."
+    # only the short question is a cache key, never the whole message
+    return question, _count_digest_line(question, model)
+
+
+def _digest(messages: list[Message], budget: int, model: str) -> str:
+    """First words of the user questions of the dropped messages, newest kept when they do not all fit."""
+    questions = []
+    used = 0
+    for message in reversed(messages):
+        if message.role != "user":
+            continue
+        text = _get_text(message)
+        if not text:
+            continue
+        question, tokens = _digest_line(text, model)
+        if used + tokens > budget:
+            break
+        questions.append(question)
+        used += tokens
+    omitted = f"[{len(messages)} earlier messages omitted]"
+    if not questions:
+        return omitted
+    return "\n".join([omitted, "Earlier the user asked:"] + [f"- {question}" for question in reversed(questions)])
+
+
+def render_prompt(messages: list[Message], model: str) -> str:
+    # a lone user message goes through as is, like any other chat client would send it
+    if len(messages) == 1 and messages[0].role == "user" and isinstance(messages[0].content, str):
+        return messages[0].content
+
+    transcript = _get_transcript(messages, model)
+    budget = get_budget(model)
+    if sum(transcript.tokens) <= budget:
+        return transcript.text
+
+    system_count = 0
+    while system_count < len(messages) - 1 and messages[system_count].role in ("system", "developer"):
+        system_count += 1
+    used = sum(transcript.tokens[:system_count])
+    # newest first, the last message is always sent even when it alone is over budget
+    index = len(messages)
+    while index > system_count:
+        tokens = transcript.tokens[index - 1]
+        if index < len(messages) and used + tokens > budget:
+            break
+        used += tokens
+        index -= 1
+
+    # make room for the digest of what is dropped
+    digest_budget = int(budget * DIGEST_SHARE)
+    while index < len(messages) - 1 and used > budget - digest_budget:
+        used -= transcript.tokens[index]
+        index += 1
+    lines = [transcript.turn(i) for i in range(system_count)]
+    if index > system_count:
+        lines.append(_digest(messages[system_count:index], max(budget - used, 0), model))
+    lines.extend(transcript.turn(i) for i in range(index, len(messages)))
+    return "\n\n".join(lines)
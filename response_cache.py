@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from fastapi.encoders import jsonable_encoder
+from schemas import CompletionsJsonData
+
+
+class ResponseCache:
+    """LRU cache of completed answers bounded by entry count and total bytes, entries expire after ttl seconds."""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self.entries: OrderedDict[str, tuple[float, str, int]] = OrderedDict()
+
+    @staticmethod
+    def make_key(completions_json_data: CompletionsJsonData) -> str:
+        # only the fields that change the answer, serialized canonically so key order and spacing never matter
+        canonical = json.dumps(
+            {
+                "model": completions_json_data.model,
+                "messages": [jsonable_encoder(message, exclude_unset=True) for message in completions_json_data.messages],
+                "temperature": completions_json_data.temperature,
+                "top_p": completions_json_data.top_p,
+                "frequency_penalty": completions_json_data.frequency_penalty,
+                "presence_penalty": completions_json_data.presence_penalty,
+                "tools": jsonable_encoder(completions_json_data.tools),
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _delete(self, key: str) -> None:
+        _, _, size = self.entries.pop(key)
+        self.total_bytes -= size
+
+    def get(self, key: str) -> str | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._delete(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: str, content: str) -> None:
+        size = len(content.encode())
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._delete(key)
+        self.entries[key] = (time.monotonic() + self.ttl, content, size)
+        self.total_bytes += size
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self._delete(next(iter(self.entries)))
+
+
+def create_response_cache() -> ResponseCache | None:
+    """The cache is opt-in, RESPONSE_CACHE_ENABLED=true turns it on."""
+    if os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() != "true":
+        return None
+    return ResponseCache(
+        max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1024)),
+        max_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+        ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 600)),
+    )
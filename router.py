@@ -0,0 +1,332 @@
+"""Routes a model alias to the providers serving it, with ordered failover and optional hedging.
+
+ROUTING_FILE (routing.json by default) maps an alias to its targets in order of preference:
+
+    {
+        "llama-3.1-70b": {
+            "targets": [
+                {"provider": "theb_ai"},
+                {"provider": "hugging_chat", "model": "meta-llama-3.1-70b-instruct"}
+            ],
+            "hedge_after_ms": "p95"
+        }
+    }
+
+Targets should serve the same model, callers are not told which one answered. The shipped file has no policies.
+A target that fails before its first token hands over to the next one. Hedging is opt-in: with hedge_after_ms set
+(milliseconds, or "p95" for the observed time to first token of the first target) the next target is also started
+when the current one is still silent after that delay, the first to produce a token wins and the other is
+cancelled. Models without a policy go to the provider listed in the model index. Targets whose circuit breaker is
+open, or whose provider credentials are not configured, are skipped without sending a request.
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable
+import anyio
+from fastapi import HTTPException
+from admission import AdmissionController, AdmissionLease, account_id
+from chatgpt_web.conversation import ChatGPT_Web_RE
+from health import HALF_OPEN, CircuitBreaker, CircuitOpen, HealthRegistry
+from hugging_chat.conversation import HuggingChat_RE
+from logger import get_logger
+from metrics import HEDGES, ROUTE_ATTEMPTS, observe_stream
+from model_index import ModelIndex
+from schemas import CompletionsJsonData
+from utility import close_upstream
+
+logger = get_logger("router")
+
+TTFT_SAMPLES = 200
+# below this many samples the p95 is not trusted and HEDGE_AFTER_MS is used instead
+TTFT_MIN_SAMPLES = 20
+_cleanup_tasks: set[asyncio.Task] = set()
+
+
+@dataclass
+class Target:
+    provider: str
+    model: str
+
+
+@dataclass
+class RoutePolicy:
+    targets: list[Target]
+    hedge_after_ms: float | str | None = None
+
+
+def load_policies(path: str) -> dict[str, RoutePolicy]:
+    try:
+        with open(path, "r") as file:
+            routing = json.load(file)
+    except FileNotFoundError:
+        return {}
+    return {
+        alias: RoutePolicy(
+            targets=[Target(target["provider"], target.get("model", alias)) for target in policy["targets"]],
+            hedge_after_ms=policy.get("hedge_after_ms"),
+        )
+        for alias, policy in routing.items()
+    }
+
+
+def _schedule_cleanup(cleanup: Callable[[], Awaitable]) -> None:
+    # conversations are deleted in the background, the client should not wait for it
+    task = asyncio.create_task(cleanup())
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_done)
+
+
+def _cleanup_done(task: asyncio.Task) -> None:
+    _cleanup_tasks.discard(task)
+    # nobody awaits these tasks, a failed delete would otherwise only show up as an unretrieved exception
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Upstream cleanup failed: %r", task.exception())
+
+
+@dataclass
+class UpstreamStream:
+    """An upstream completion whose first text delta has already arrived."""
+
+    target: Target
+    response: object
+    deltas: AsyncIterator[str]
+    lease: AdmissionLease
+    cleanup: Callable[[], Awaitable] | None = None
+    first_delta: str = ""
+    closed: bool = field(default=False, init=False)
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        yield self.first_delta
+        async for text_delta in self.deltas:
+            yield text_delta
+
+    async def aclose(self) -> None:
+        """Idempotent, runs on completion, on client disconnect and for hedging losers."""
+        if self.closed:
+            return
+        self.closed = True
+        self.lease.release()
+        await close_upstream(self.response)
+        with anyio.CancelScope(shield=True):
+            await self.deltas.aclose()
+        if self.cleanup is not None:
+            _schedule_cleanup(self.cleanup)
+
+
+async def _start_deepseek_web(deepseek_web, model: str, data: CompletionsJsonData, messages_str: str):
+    return await deepseek_web.completions(messages_str, data.messages), None
+
+
+async def _start_chatgpt_web(chatgpt_web, model: str, data: CompletionsJsonData, messages_str: str):
+    return await chatgpt_web.conversation(model, data.messages), None
+
+
+async def _start_theb_ai(theb_ai, model: str, data: CompletionsJsonData, messages_str: str):
+    return await theb_ai.conversation(model, messages_str, data.temperature, data.top_p), None
+
+
+async def _start_hugging_chat(hugging_chat, model: str, data: CompletionsJsonData, messages_str: str):
+    conversation_id, response = await hugging_chat.request_conversation(messages_str, model)
+    return response, lambda: hugging_chat.delete_conversation(conversation_id)
+
+
+# provider -> (request starter, credential the account level admission limit is keyed on)
+# environment variables a provider cannot work without, chatgpt_web and theb_ai also run anonymously
+PROVIDER_CREDENTIALS = {"deepseek_web": "DEEPSEEK_BEARER_TOKEN", "hugging_chat": "HUGGING_CHAT_TOKEN"}
+
+
+def has_credentials(provider: str) -> bool:
+    return provider not in PROVIDER_CREDENTIALS or bool(os.environ.get(PROVIDER_CREDENTIALS[provider]))
+
+
+PROVIDER_ADAPTERS = {
+    "deepseek_web": (_start_deepseek_web, lambda provider: provider.bearer_token),
+    "chatgpt_web": (_start_chatgpt_web, lambda provider: os.environ.get("CHATGPT_WEB_SESSION_TOKEN")),
+    "theb_ai": (_start_theb_ai, lambda provider: provider.organization_id),
+    "hugging_chat": (_start_hugging_chat, lambda provider: provider.hf_chat),
+}
+
+
+class Router:
+    def __init__(
+        self,
+        admission: AdmissionController,
+        health: HealthRegistry,
+        model_index: ModelIndex,
+        providers: dict[str, object],
+    ):
+        self.admission = admission
+        self.health = health
+        self.model_index = model_index
+        self.providers = dict(providers)
+        self.provider_locks: dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.policies = load_policies(os.environ.get("ROUTING_FILE", "routing.json"))
+        self.ttft: dict[str, deque[float]] = defaultdict(lambda: deque(maxlen=TTFT_SAMPLES))
+
+    def get_policy(self, model: str) -> RoutePolicy | None:
+        if model in self.policies:
+            return self.policies[model]
+        model_card = self.model_index.get(model)
+        if model_card is None:
+            return None
+        return RoutePolicy(targets=[Target(model_card.provider, model)])
+
+    async def get_provider(self, name: str):
+        """Providers other than DeepSeek are created on first use, their constructors do blocking network calls."""
+        if name in self.providers:
+            return self.providers[name]
+        async with self.provider_locks[name]:
+            if name not in self.providers:
+                if name == "chatgpt_web":
+                    provider = await asyncio.to_thread(ChatGPT_Web_RE)
+                elif name == "hugging_chat":
+                    provider = await asyncio.to_thread(HuggingChat_RE)
+                elif name == "theb_ai":
+                    # imported on demand, account registration pulls in the browser automation packages
+                    from theb_ai.conversation import TheB_AI_RE
+
+                    provider = await asyncio.to_thread(TheB_AI_RE)
+                else:
+                    raise HTTPException(status_code=500, detail=f"Unknown provider {name}")
+                self.providers[name] = provider
+                if name == "hugging_chat":
+                    # the constructor refreshed hugging_chat/models.json from the upstream model list
+                    self.model_index.refresh()
+                self.model_index.set_health(name, True)
+        return self.providers[name]
+
+    def get_hedge_delay(self, policy: RoutePolicy) -> float | None:
+        if policy.hedge_after_ms is None or len(policy.targets) < 2:
+            return None
+        if policy.hedge_after_ms != "p95":
+            return float(policy.hedge_after_ms) / 1000
+        samples = sorted(self.ttft[policy.targets[0].provider])
+        if len(samples) < TTFT_MIN_SAMPLES:
+            return float(os.environ.get("HEDGE_AFTER_MS", 3000)) / 1000
+        return samples[int(0.95 * (len(samples) - 1))]
+
+    async def _open_target(
+        self, target: Target, completions_json_data: CompletionsJsonData, messages_str: str, background: bool
+    ) -> UpstreamStream:
+        start_request, get_credential = PROVIDER_ADAPTERS[target.provider]
+        probes: list[CircuitBreaker] = []
+
+        def check_breaker(breaker: CircuitBreaker) -> None:
+            if not breaker.allow():
+                raise CircuitOpen(breaker)
+            if breaker.state == HALF_OPEN:
+                probes.append(breaker)
+
+        account = None
+        lease = None
+        upstream = None
+        # waiting for an admission slot says nothing about the upstream's health
+        counts_as_outcome = True
+        try:
+            check_breaker(self.health.get(target.provider))
+            provider = await self.get_provider(target.provider)
+            credential = get_credential(provider)
+            account = account_id(credential) if credential else None
+            counts_as_outcome = False
+            if account:
+                check_breaker(self.health.get(target.provider, account))
+            lease = await self.admission.acquire(target.provider, account, completions_json_data.stream, background)
+            counts_as_outcome = True
+
+            start = time.perf_counter()
+            response, cleanup = await start_request(provider, target.model, completions_json_data, messages_str)
+            deltas = observe_stream(target.provider, provider.iter_text(response))
+            upstream = UpstreamStream(target, response, deltas, lease, cleanup)
+            try:
+                upstream.first_delta = await anext(deltas)
+            except StopAsyncIteration:
+                raise HTTPException(status_code=502, detail=f"{target.provider} returned an empty response")
+            ttft = time.perf_counter() - start
+            self.ttft[target.provider].append(ttft)
+            self.health.record(target.provider, account, True, ttft)
+            return upstream
+        except BaseException as e:
+            if upstream is not None:
+                await upstream.aclose()
+            elif lease is not None:
+                lease.release()
+            if counts_as_outcome and not isinstance(e, (asyncio.CancelledError, CircuitOpen)):
+                self.health.record(target.provider, account, False, error=repr(e))
+            else:
+                for breaker in probes:
+                    breaker.release_probe()
+            raise
+
+    async def open(
+        self, model: str, completions_json_data: CompletionsJsonData, messages_str: str, background: bool = False
+    ) -> UpstreamStream:
+        policy = self.get_policy(model)
+        if policy is None:
+            raise HTTPException(status_code=400, detail="Model not supported")
+
+        # creating a provider without credentials only fails and trips its breaker, the first target is kept so
+        # the caller still gets the provider's own error when nothing is configured
+        targets = [target for target in policy.targets if has_credentials(target.provider)] or policy.targets[:1]
+        hedge_delay = self.get_hedge_delay(policy) if len(targets) > 1 else None
+        attempts: dict[asyncio.Task, Target] = {}
+        last_error: BaseException | None = None
+        skipped: list[CircuitOpen] = []
+
+        def start_next_target() -> None:
+            target = targets.pop(0)
+            task = asyncio.create_task(self._open_target(target, completions_json_data, messages_str, background))
+            attempts[task] = target
+
+        start_next_target()
+        try:
+            while attempts:
+                # only one hedge per request, failover still walks the rest of the list
+                timeout = hedge_delay if targets and len(attempts) == 1 and hedge_delay is not None else None
+                done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info("%s is slow, hedging with %s", attempts[next(iter(attempts))].provider, targets[0].provider)
+                    HEDGES.labels(model).inc()
+                    hedge_delay = None
+                    start_next_target()
+                    continue
+                for task in done:
+                    target = attempts.pop(task)
+                    if task.exception() is None:
+                        ROUTE_ATTEMPTS.labels(target.provider, "won").inc()
+                        return task.result()
+                    if isinstance(task.exception(), CircuitOpen):
+                        ROUTE_ATTEMPTS.labels(target.provider, "skipped").inc()
+                        skipped.append(task.exception())
+                        continue
+                    last_error = task.exception()
+                    ROUTE_ATTEMPTS.labels(target.provider, "failed").inc()
+                    logger.warning("%s failed for %s: %r", target.provider, model, last_error)
+                if not attempts and targets:
+                    start_next_target()
+        finally:
+            # losers of a hedge, or attempts still running when the client went away
+            for task, target in attempts.items():
+                ROUTE_ATTEMPTS.labels(target.provider, "cancelled").inc()
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    await task.result().aclose()
+                else:
+                    task.cancel()
+
+        if last_error is None and skipped:
+            # every target is shedding load, tell the client when the first one reopens
+            raise min(skipped, key=lambda error: int(error.headers["Retry-After"]))
+        if isinstance(last_error, HTTPException):
+            raise last_error
+        raise HTTPException(status_code=502, detail=f"All providers failed for {model}: {last_error!r}")
+
+    async def aclose(self) -> None:
+        for provider in self.providers.values():
+            if getattr(provider, "async_client", None) is not None:
+                await provider.async_client.aclose()
+            if getattr(provider, "async_session", None) is not None:
+                await provider.async_session.close()
@@ -3,6 +3,7 @@ import io
 from typing import Optional, Literal
 from PIL import Image
 from pydantic import BaseModel, field_validator
+from profiling import span
 
 
 class Claude_ImageSource(BaseModel):
@@ -13,17 +14,18 @@ class Claude_ImageSource(BaseModel):
     @field_validator("data")
     @classmethod
     def compress_image(cls, base64_image):
-        # Convert base64 image to PIL Image
-        image_bytes = base64.b64decode(base64_image)
-        image = Image.open(io.BytesIO(image_bytes))
+        with span("claude_image_compress"):
+            # Convert base64 image to PIL Image
+            image_bytes = base64.b64decode(base64_image)
+            image = Image.open(io.BytesIO(image_bytes))
 
-        # Resize image to max 512x512
-        image.thumbnail((512, 512))
+            # Resize image to max 512x512
+            image.thumbnail((512, 512))
 
-        # Convert PIL Image to base64
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        return base64.b64encode(buffered.getvalue()).decode()
+            # Convert PIL Image to base64
+            buffered = io.BytesIO()
+            image.save(buffered, format="JPEG")
+            return base64.b64encode(buffered.getvalue()).decode()
 
 
 class OpenAI_ImageURL(BaseModel):
@@ -68,10 +70,11 @@ class MessageJsonData(BaseModel):
     max_tokens: int
     messages: list[Message]
     model: str
-    stream: bool
-    temperature: float
-    top_k: int
-    top_p: int
+    stream: bool = False
+    system: Optional[str | list[Content]] = None
+    temperature: float = 1
+    top_k: Optional[int] = None
+    top_p: int = 1
 
 
 class Tool(BaseModel):
@@ -85,11 +88,19 @@ class CompletionsJsonData(BaseModel):
     model: str
     presence_penalty: float = 0
     stream: bool
+    stream_options: Optional[dict] = None
     temperature: float
     tools: Optional[list[Tool]] = None
     top_p: int
 
 
+class BatchJsonData(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+    metadata: Optional[dict] = None
+
+
 class TheB_Data(BaseModel):
     id: str
     type: int
@@ -130,3 +141,24 @@ class OpenAiData(BaseModel):
     object: str = Literal["chat.completion", "chat.completion.chunk"]
     model: str
     usage: Optional[Usage] = None
+
+
+class ModelCapabilities(BaseModel):
+    vision: bool = False
+    tools: bool = False
+    thinking: bool = False
+
+
+class ModelCard(BaseModel):
+    id: str
+    object: str = "model"
+    created: int
+    owned_by: str
+    provider: str
+    capabilities: ModelCapabilities
+    healthy: bool
+
+
+class ModelList(BaseModel):
+    object: str = "list"
+    data: list[ModelCard]
@@ -0,0 +1,149 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import AbstractContextManager, contextmanager
+from pathlib import Path
+from typing import Any, Callable
+
+
+class SharedStore(ABC):
+    """Key value store shared by every worker process, values are json encoded and may expire."""
+
+    @abstractmethod
+    def get(self, key: str) -> Any: ...
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: float = None) -> None: ...
+
+    @abstractmethod
+    def delete(self, key: str) -> None: ...
+
+    @abstractmethod
+    def lock(self, name: str, lease: float = 300, timeout: float = None) -> AbstractContextManager:
+        """Cross process lock, the lease makes sure a crashed holder cannot block the other workers forever."""
+
+
+@contextmanager
+def _lease_lock(acquire: Callable[[str], bool], release: Callable[[str], None], name: str, timeout: float = None):
+    """Polls acquire with a fresh token until it succeeds, for backends that only have a try lock."""
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + timeout if timeout else None
+    while not acquire(token):
+        if deadline and time.monotonic() > deadline:
+            raise TimeoutError(f"Timed out waiting for shared lock {name}")
+        time.sleep(0.1)
+    try:
+        yield
+    finally:
+        release(token)
+
+
+class SQLiteStore(SharedStore):
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._local = threading.local()
+        with self._connection as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expire_at REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, token TEXT, expire_at REAL)")
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections cannot be shared between threads, and asyncio.to_thread jobs run on a pool
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Any:
+        row = self._connection.execute("SELECT value, expire_at FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: float = None) -> None:
+        expire_at = time.time() + ttl if ttl else None
+        with self._connection as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expire_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expire_at),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._connection as connection:
+            connection.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def lock(self, name: str, lease: float = 300, timeout: float = None) -> AbstractContextManager:
+        return _lease_lock(
+            lambda token: self._acquire(name, token, lease), lambda token: self._release(name, token), name, timeout
+        )
+
+    def _acquire(self, name: str, token: str, lease: float) -> bool:
+        now = time.time()
+        with self._connection as connection:
+            connection.execute("DELETE FROM locks WHERE name = ? AND expire_at < ?", (name, now))
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO locks (name, token, expire_at) VALUES (?, ?, ?)", (name, token, now + lease)
+            )
+        return cursor.rowcount == 1
+
+    def _release(self, name: str, token: str) -> None:
+        with self._connection as connection:
+            connection.execute("DELETE FROM locks WHERE name = ? AND token = ?", (name, token))
+
+
+class RedisStore(SharedStore):
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("Please install the redis package to use a redis:// SHARED_STATE_URL")
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Any:
+        value = self.client.get(key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key: str, value: Any, ttl: float = None) -> None:
+        self.client.set(key, json.dumps(value, ensure_ascii=False), px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, key: str) -> None:
+        self.client.delete(key)
+
+    def lock(self, name: str, lease: float = 300, timeout: float = None) -> AbstractContextManager:
+        return _lease_lock(
+            lambda token: self._acquire(name, token, lease), lambda token: self._release(name, token), name, timeout
+        )
+
+    def _acquire(self, name: str, token: str, lease: float) -> bool:
+        return bool(self.client.set(f"lock:{name}", token, nx=True, px=int(lease * 1000)))
+
+    def _release(self, name: str, token: str) -> None:
+        # compare and delete in one round trip so an expired lease cannot release the next holder's lock
+        self.client.eval(
+            "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0",
+            1,
+            f"lock:{name}",
+            token,
+        )
+
+
+_shared_store = None
+
+
+def get_shared_store() -> SharedStore:
+    """SHARED_STATE_URL selects the backend: sqlite:///data/shared_state.db (default) or redis://host:port/db."""
+    global _shared_store
+    if _shared_store is None:
+        url = os.environ.get("SHARED_STATE_URL", "sqlite:///data/shared_state.db")
+        if url.startswith(("redis://", "rediss://", "unix://")):
+            _shared_store = RedisStore(url)
+        else:
+            _shared_store = SQLiteStore(url.removeprefix("sqlite:///"))
+    return _shared_store
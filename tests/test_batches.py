@@ -0,0 +1,70 @@
+import json
+from email.utils import formatdate
+import time
+from batches import MAX_BACKOFF, BatchQueue, _retry_delay
+
+
+def make_batch(queue: BatchQueue, count: int) -> str:
+    file_id = "file-input"
+    with open(queue.file_path(file_id), "w") as file:
+        for index in range(count):
+            request = {"custom_id": f"request-{index}", "method": "POST", "url": "/v1/chat/completions", "body": {}}
+            file.write(json.dumps(request) + "\n")
+    queue.add_file(file_id, "batch", "input.jsonl")
+    return queue.create_batch(file_id, "/v1/chat/completions", "24h", None)["id"]
+
+
+def test_lines_of_a_crashed_worker_run_before_the_batch_finalizes(tmp_path):
+    queue = BatchQueue(str(tmp_path))
+    batch_id = make_batch(queue, 2)
+    # a worker claims both lines and dies, its lease is already over
+    assert len(queue.claim(10, lease=-1)) == 2
+
+    assert queue.finalize_ready(lease=60) == []
+    lines = queue.claim(10, lease=60)
+    assert [line["attempts"] for line in lines] == [2, 2]
+    for line in lines:
+        queue.finish(batch_id, line["line"], "completed", {"custom_id": line["custom_id"]})
+
+    assert queue.finalize_ready(lease=60) == [batch_id]
+    queue.write_results(batch_id)
+    batch = queue.get_batch(batch_id)
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 2, "completed": 2, "failed": 0}
+    with open(queue.file_path(batch["output_file_id"])) as file:
+        assert [json.loads(line)["custom_id"] for line in file] == ["request-0", "request-1"]
+
+
+def test_cancelled_batch_does_not_wait_for_lines_of_a_crashed_worker(tmp_path):
+    queue = BatchQueue(str(tmp_path))
+    batch_id = make_batch(queue, 2)
+    queue.claim(1, lease=-1)
+    queue.cancel_batch(batch_id)
+
+    assert queue.finalize_ready(lease=60) == [batch_id]
+    queue.write_results(batch_id)
+    assert queue.get_batch(batch_id)["status"] == "cancelled"
+
+
+def test_retry_delay_reads_seconds_and_http_dates():
+    assert _retry_delay("12", 1) == 12
+    assert 25 <= _retry_delay(formatdate(time.time() + 30, usegmt=True), 1) <= 30
+    assert _retry_delay(formatdate(time.time() - 30, usegmt=True), 1) == 0
+    assert _retry_delay("soon", 3) == 8
+    assert _retry_delay(None, 20) == MAX_BACKOFF
+
+
+def test_finalizing_batch_of_a_crashed_worker_is_taken_over(tmp_path):
+    queue = BatchQueue(str(tmp_path))
+    batch_id = make_batch(queue, 1)
+    line = queue.claim(1, lease=60)[0]
+    queue.finish(batch_id, line["line"], "completed", {"custom_id": line["custom_id"]})
+
+    # the finalizing worker dies at once, its lease is already over
+    assert queue.finalize_ready(lease=-1) == [batch_id]
+    batch = queue.get_batch(batch_id)
+    assert batch["status"] == "finalizing"
+    assert isinstance(batch["finalizing_at"], int)
+    assert "finalize_lease_until" not in batch
+    assert queue.finalize_ready(lease=60) == [batch_id]
+    assert queue.finalize_ready(lease=60) == []
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from deepseek_web.conversation import create_pow_engine
+
+# the sample challenge of ds_wasm_pow.py
+SAMPLE = ("2ee17d427355d5d0bb1056a14d8ed6982f117db6c2e4046bc05f53c1546876b6", "e071bdd62e1dcb455990", 144000, 1736928349211)
+
+
+@pytest.fixture(scope="module")
+def wasm_pow():
+    return create_pow_engine("wasm")
+
+
+@pytest.fixture(scope="module")
+def numpy_pow():
+    # a small block makes the search cross block and digit count boundaries
+    return create_pow_engine("numpy", batch_size=1000)
+
+
+def make_challenge(numpy_pow, salt: str, expire_at: int, answer: int, difficulty: int) -> tuple:
+    """A challenge whose target is the NumPy digest of answer, only the wasm engine can tell whether it is right."""
+    prefix = f"{salt}_{expire_at}_".encode()
+    lanes = numpy_pow._hash_block(prefix, np.array([answer], dtype=np.uint64), len(str(answer)))
+    return lanes[0].astype("<u8").tobytes().hex(), salt, difficulty, expire_at
+
+
+def test_sample_challenge(wasm_pow, numpy_pow):
+    assert numpy_pow.calculate_answer(*SAMPLE) == wasm_pow.calculate_answer(*SAMPLE) == 38385
+
+
+@pytest.mark.parametrize(
+    "salt, expire_at, answer",
+    [
+        ("0f1e2d3c4b5a69788796", 1736928349211, 0),
+        ("a5a5a5a5a5a5a5a5a5a5", 1736928400000, 7),
+        ("1234567890abcdef1234", 1740000000000, 999),
+        ("fedcba9876543210fedc", 1750000000123, 1000),
+        ("00000000000000000000", 1760000000000, 54321),
+    ],
+)
+def test_generated_challenges_match_wasm(wasm_pow, numpy_pow, salt, expire_at, answer):
+    challenge = make_challenge(numpy_pow, salt, expire_at, answer, difficulty=100000)
+    assert wasm_pow.calculate_answer(*challenge) == answer
+    assert numpy_pow.calculate_answer(*challenge) == answer
+
+
+def test_answer_beyond_difficulty_is_not_found(wasm_pow, numpy_pow):
+    challenge = make_challenge(numpy_pow, "e071bdd62e1dcb455990", 1736928349211, 5000, difficulty=4000)
+    assert numpy_pow.calculate_answer(*challenge) is None
+    assert not wasm_pow.calculate_answer(*challenge)
@@ -1,58 +1,51 @@
 import httpx
 import json
+import os
 import random
 import asyncio
 from fastapi import HTTPException
+from pydantic import ValidationError
+from schemas import TheB_Data
 from .register import TheB_AI_Register, async_generate_api_token
-from utility import color_print, get_user_agent
+from utility import get_user_agent
+from logger import get_logger
+from prompt import TRANSCRIPT_SYSTEM_PROMPT
+from shared_state import get_shared_store
+from capture import capture_transport
+from metrics import POOL_OCCUPANCY, RETRIES, observe_stage, record_response
+
+logger = get_logger("theb_ai")
 
 
 class TheB_AI_RE:
-    theb_ai_api_url = "https://beta.theb.ai/api"
-    model_key_mapping = {
-        "TheB.AI 4.0": "theb-ai-4.0",
-        "TheB.AI": "theb-ai",
-        "Claude 3.7 Sonnet": "claude-3-7-sonnet",
-        "Claude 3.7 Sonnet Thinking": "claude-3-7-sonnet-thinking",
-        "Claude 3.5 Sonnet": "claude-3-5-sonnet",
-        "Claude 3 Opus": "claude-3-opus",
-        "Claude 3 Sonnet": "claude-3-sonnet",
-        "Llama 3.1 405B": "llama-3.1-405b",
-        "Llama 3.1 70B": "llama-3.1-70b",
-        "Llama 3.1 8B": "llama-3.1-8b",
-        "Llama 3 70B": "llama-3-70b",
-        "Llama 3 8B": "llama-3-8b",
-        "Mixtral 8x22B": "mixtral-8x22b",
-        "Mixtral 8x7B": "mixtral-8x7b",
-        "Mistral 7B": "mistral-7b",
-        "WizardLM 2 8x22B": "wizardlm-2-8x22b",
-        "DBRX Instruct": "dbrx-instruct",
-        "Qwen 2 72B": "qwen-2-72b",
-        "Qwen 1.5 110B": "qwen-1.5-110b",
-        "Qwen 1.5 72B": "qwen-1.5-72b",
-        "Qwen 1.5 32B": "qwen-1.5-32b",
-        "Qwen 1.5 14B": "qwen-1.5-14b",
-        "Qwen 1.5 7B": "qwen-1.5-7b",
-        "Yi 34B": "yi-34b",
-        "Gemma 2 27B": "gemma-2-27b",
-        "Gemma 2 9B": "gemma-2-9b",
-    }
+    theb_ai_api_url = os.environ.get("THEB_AI_API_URL", "https://beta.theb.ai/api")
+    with open("theb_ai/models.json", "r") as models_file:
+        model_key_mapping = json.load(models_file)
     organization_id = None
     headers = None
 
     def __init__(self, async_client: httpx.AsyncClient = None):
         self.api_info = self._load_api_info()
         self._init_api_info()
-        self.async_client = async_client or httpx.AsyncClient()
+        self.async_client = async_client or httpx.AsyncClient(transport=capture_transport("theb_ai"))
 
     def _load_api_info(self) -> list[dict]:
         try:
             with open(TheB_AI_Register.api_json_path, "r") as file:
                 api_info = json.load(file)
+            POOL_OCCUPANCY.labels("theb_ai_accounts").set(len(api_info))
             if len(api_info) == 0:
                 raise Exception()
         except Exception:
-            asyncio.run(async_generate_api_token())
+            # a single worker refills the account pool, the others pick up its result
+            with get_shared_store().lock("theb_ai:register", lease=900):
+                try:
+                    with open(TheB_AI_Register.api_json_path, "r") as file:
+                        refilled = len(json.load(file)) > 0
+                except Exception:
+                    refilled = False
+                if not refilled:
+                    asyncio.run(async_generate_api_token())
             return self._load_api_info()
         else:
             return api_info
@@ -65,12 +58,12 @@ class TheB_AI_RE:
         }
 
     def _remove_apis(self) -> None:
-        with open(TheB_AI_Register.api_json_path, "r") as file:
-            data = json.load(file)
-        if data:
-            data.pop(0)
-        with open(TheB_AI_Register.api_json_path, "w") as file:
-            json.dump(data, file, indent=4)
+        with get_shared_store().lock(TheB_AI_Register.api_json_path):
+            with open(TheB_AI_Register.api_json_path, "r") as file:
+                data = json.load(file)
+            if data:
+                data.pop(0)
+            TheB_AI_Register.write_api_info(data)
 
     async def _init_chat_models(self) -> dict[str, str]:
         chat_models = {}
@@ -88,23 +81,25 @@ class TheB_AI_RE:
     async def _check_balance(self) -> float:
         url = f"{self.theb_ai_api_url}/organization/balance?org_id={self.organization_id}"
         response = await self.async_client.get(url, headers=self.headers)
+        record_response("theb_ai", response.status_code)
         balance = 0.0
         need_change_api_key = False
         if response.status_code == 401:
-            color_print("Blance check unauthorized. Changing API token.", "yellow")
+            logger.warning("Blance check unauthorized. Changing API token.")
             need_change_api_key = True
         elif response.status_code == 200:
             response_json = response.json()
             balance = float(response_json["data"]["balance"])
-            color_print(f"Current Balance: {balance}", "blue")
+            logger.debug("Current Balance: %s", balance)
             if balance <= 0.0:
-                color_print("Blance out of funds. Changing API token.", "yellow")
+                logger.warning("Blance out of funds. Changing API token.")
                 need_change_api_key = True
         else:
             response.raise_for_status()
         if need_change_api_key:
-            self._remove_apis()
-            self.api_info = self._load_api_info()
+            # both take the shared file lock, and a refill runs its own event loop
+            await asyncio.to_thread(self._remove_apis)
+            self.api_info = await asyncio.to_thread(self._load_api_info)
             self._init_api_info()
         return balance
 
@@ -116,17 +111,34 @@ class TheB_AI_RE:
                 break
         # all accounts are not enough balance, generate new and choose the new one
         else:
-            color_print("All accounts are not enough balance, generating new API token.", "yellow")
+            logger.warning("All accounts are not enough balance, generating new API token.")
             await async_generate_api_token()
-            self.api_info = self._load_api_info()
+            self.api_info = await asyncio.to_thread(self._load_api_info)
             self.api_info.reverse()
             self._init_api_info()
 
+    @staticmethod
+    async def iter_text(response: httpx.Response):
+        """Text deltas of a conversation stream, every event repeats the whole content so far."""
+        text = ""
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            try:
+                data = TheB_Data(**json.loads(line[6:]))
+            except (json.JSONDecodeError, ValidationError):
+                continue
+            content = data.args.content
+            if isinstance(content, str) and content.startswith(text) and len(content) > len(text):
+                yield content[len(text) :]
+                text = content
+
     async def conversation(
         self, model: str = "llama-3-8b", text: str = "Hello!", temperature: float = 0.5, top_p: int = 1
     ):
-        await self._check_balance()
-        chat_models = await self._init_chat_models()
+        with observe_stage("theb_ai", "session_create"):
+            await self._check_balance()
+            chat_models = await self._init_chat_models()
 
         conversation_url = (
             f"{self.theb_ai_api_url}/conversation?org_id={self.organization_id}&req_rand={random.random()}"
@@ -139,7 +151,7 @@ class TheB_AI_RE:
             "functions": [],
             "attachments": None,
             "model_params": {
-                "system_prompt": "Act as an AI assistant that responds to user inputs in the language they use. Parse the provided JSON-formatted conversation history, but respond only to the final user message without referencing the JSON format. Maintain consistency with previous responses and adapt to the user's language preference.",
+                "system_prompt": TRANSCRIPT_SYSTEM_PROMPT,
                 "temperature": temperature,
                 "top_p": top_p,
                 "frequency_penalty": "0",
@@ -153,9 +165,11 @@ class TheB_AI_RE:
         req = self.async_client.build_request(
             "POST", conversation_url, headers=self.headers, data=json_payload, timeout=None
         )
-        response = await self.async_client.send(req, stream=True)
+        with observe_stage("theb_ai", "upstream_ttfb"):
+            response = await self.async_client.send(req, stream=True)
 
-        color_print(f"TheB AI Response Status Code: {response.status_code}", "blue")
+        record_response("theb_ai", response.status_code)
+        logger.debug("TheB AI Response Status Code: %s", response.status_code)
         if response.status_code != 200:
             # Sometimes TheB AI will update their models to require a minimum balance
             try:
@@ -165,9 +179,10 @@ class TheB_AI_RE:
                 # search nubmer after $ sign
                 required_min_balance = float(detail.split("$")[1])
                 if required_min_balance > 0.05:
-                    color_print(f"API error: {detail}", "yellow")
+                    logger.warning("API error: %s", detail)
                     raise Exception("Required minimum balance is above trial limit.")
                 await self._select_target_balance_account(required_min_balance)
+                RETRIES.labels("theb_ai", "balance").inc()
                 return await self.conversation(model, text, temperature, top_p)
             except Exception as e:
                 raise HTTPException(status_code=400, detail=str(e))
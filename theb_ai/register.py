@@ -1,15 +1,52 @@
+"""Creates TheB.AI accounts to refill theb_ai/Theb_API.json.
+
+Each registration creates a temporary email, signs up in a browser, opens the verification link in the shared
+browser pool and logs in for an API key. The blocking sign-up browsers run in a pool of THEB_REGISTER_WORKERS
+processes, the email polling and the API calls stay on the event loop, so refilling n accounts takes about
+n / THEB_REGISTER_WORKERS registrations worth of time. The verification email is polled with backoff for up to
+THEB_VERIFY_TIMEOUT seconds.
+"""
+
 import re
 import json
 import os
 import asyncio
-import nest_asyncio
+import random
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
 from random import randint
 from curl_cffi.requests import AsyncSession
 from seleniumbase import SB
 from webscout import tempid
-from utility import color_print, get_user_agent
+from utility import get_user_agent
+from logger import get_logger
+from browser_pool import get_browser_pool
+from shared_state import get_shared_store
+
+logger = get_logger("theb_ai.register")
+
+VERIFY_POLL_INITIAL = 2.0
+VERIFY_POLL_MAX = 15.0
+VERIFICATION_LINK_PATTERN = re.compile(r"https://beta\.theb\.ai/verify-email\?t=[^ ]+")
 
-nest_asyncio.apply()  # Fix "RuntimeError: This event loop is already running" error
+
+def _register_user(email: str, full_name: str, password: str, headless: bool) -> None:
+    """Registers on the website using the temporary email, runs in a pool process."""
+
+    with SB(uc=True, locale_code="en", headed=True, xvfb=headless) as sb:
+        url = "https://beta.theb.ai/register"
+        sb.uc_open_with_reconnect(url, 2)
+        sb.uc_gui_click_captcha()
+        sb.sleep(randint(2, 3))
+        sb.type('input[placeholder="Name"]', full_name)
+        sb.type('input[placeholder="Email"]', email)
+        sb.type('input[placeholder="Password"]', password)
+        sb.click('button[type="button"]:contains("Create Account")')
+        sb.sleep(randint(1, 2))
+        if sb.is_text_visible("An error occurred during registration."):
+            raise Exception("Failed to register")
 
 
 class TheB_AI_Register:
@@ -18,156 +55,170 @@ class TheB_AI_Register:
     full_name = "ILoveAI"
     password = "ILoveAI@777"
 
-    def __init__(self, headless: bool = True):
+    def __init__(self, headless: bool = True, browser_pool: Executor | None = None):
         self.headless = headless
+        # browsers run on threads when no process pool is given
+        self.browser_pool = browser_pool
         self.headers = {
             "user-agent": get_user_agent("chrome"),
         }
 
     @classmethod
-    def update_file(cls, api_key, organization_id):
-        data = []  # Initialize an empty list
-
-        # Check if the JSON file exists and is not empty
-        if os.path.exists(cls.api_json_path) and os.path.getsize(cls.api_json_path) > 0:
-            # Read the existing JSON data as a list of dictionaries
-            with open(cls.api_json_path, "r") as file:
-                try:
-                    data = json.load(file)
-                except json.JSONDecodeError:
-                    pass  # Ignore and continue with an empty list if the file is not valid JSON
-
-        # Update the API key and organization ID
-        data.append({"API_KEY": api_key, "ORGANIZATION_ID": organization_id})
-
-        # Write the updated data back to the JSON file
-        with open(cls.api_json_path, "w") as file:
+    def write_api_info(cls, data: list[dict]) -> None:
+        """Replaces the file in one step, readers see either the old or the new list. Hold the file's shared lock."""
+        temp_path = f"{cls.api_json_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
             json.dump(data, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        try:
+            os.replace(temp_path, cls.api_json_path)
+        except OSError:
+            # docker-compose bind mounts the file itself, which cannot be renamed over
+            os.remove(temp_path)
+            with open(cls.api_json_path, "w") as file:
+                json.dump(data, file, indent=4)
+
+    @classmethod
+    def update_file(cls, api_key, organization_id):
+        with get_shared_store().lock(cls.api_json_path):
+            data = []  # Initialize an empty list
+
+            # Check if the JSON file exists and is not empty
+            if os.path.exists(cls.api_json_path) and os.path.getsize(cls.api_json_path) > 0:
+                # Read the existing JSON data as a list of dictionaries
+                with open(cls.api_json_path, "r") as file:
+                    try:
+                        data = json.load(file)
+                    except json.JSONDecodeError:
+                        pass  # Ignore and continue with an empty list if the file is not valid JSON
+
+            # Update the API key and organization ID
+            data.append({"API_KEY": api_key, "ORGANIZATION_ID": organization_id})
+            cls.write_api_info(data)
 
     @staticmethod
     async def generate_email() -> str:
         """Generates a temporary email using webscout."""
 
+        client = tempid.Client()
         try:
-            client = tempid.Client()
             domains = await client.get_domains()
             email = (await client.create_email(domain=domains[0].name)).email
-            color_print(f"Temporary email created: {email}", color="green")
+            logger.info("Temporary email created: %s", email)
             return email
         finally:
             await client.close()
 
-    def _register_user(self, email: str):
-        """Registers on the website using the temporary email."""
-
-        with SB(uc=True, locale_code="en", headed=True, xvfb=self.headless) as sb:
-            url = "https://beta.theb.ai/register"
-            sb.uc_open_with_reconnect(url, 2)
-            sb.uc_gui_click_captcha()
-            sb.sleep(randint(2, 3))
-            sb.type('input[placeholder="Name"]', self.full_name)
-            sb.type('input[placeholder="Email"]', email)
-            sb.type('input[placeholder="Password"]', self.password)
-            sb.click('button[type="button"]:contains("Create Account")')
-            sb.sleep(randint(1, 2))
-            if sb.is_text_visible("An error occurred during registration."):
-                raise Exception("Failed to register")
-            color_print("User registered successfully!", color="green")
+    async def _run_browser(self, function, *args) -> None:
+        if self.browser_pool is None:
+            await asyncio.to_thread(function, *args)
+        else:
+            await asyncio.get_running_loop().run_in_executor(self.browser_pool, partial(function, *args))
 
-    async def _verify_email(self, email):
-        """Extracts the verification link from the temporary email and verifies it."""
+    async def _register_user(self, email: str):
+        await self._run_browser(_register_user, email, self.full_name, self.password, self.headless)
+        logger.info("User registered successfully!")
+
+    @staticmethod
+    async def _get_verification_link(email: str, timeout: float) -> str | None:
+        """Polls the inbox with exponential backoff until the verification email arrives."""
 
-        color_print("--- VERIFICATION ---", color="red")
-
-        async def get_verification_link() -> str:
-            try:
-                client = tempid.Client()
-                color_print("Waiting for the verification email...", color="yellow")
-                while True:
-                    messages = await client.get_messages(email)
-                    if messages:
-                        break
-                for message in messages:
-                    match = re.search(r"https://beta\.theb\.ai/verify-email\?t=[^ ]+", message.body_text)
+        client = tempid.Client()
+        try:
+            logger.info("Waiting for the verification email...")
+            deadline = time.monotonic() + timeout
+            delay = VERIFY_POLL_INITIAL
+            while True:
+                for message in await client.get_messages(email) or []:
+                    match = VERIFICATION_LINK_PATTERN.search(message.body_text)
                     if match:
                         return match.group(0)
-            finally:
-                await client.close()
+                if time.monotonic() + delay > deadline:
+                    return None
+                # jitter keeps parallel registrations from polling the mail service in lockstep
+                await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+                delay = min(delay * 2, VERIFY_POLL_MAX)
+        finally:
+            await client.close()
 
-        verification_link = await get_verification_link()
+    async def _verify_email(self, email):
+        """Extracts the verification link from the temporary email and verifies it."""
+
+        verification_link = await self._get_verification_link(email, float(os.environ.get("THEB_VERIFY_TIMEOUT", 180)))
         if verification_link:
-            color_print("Verification link found in the email.", color="green")
-            with SB(uc=True, locale_code="en", headed=True, xvfb=self.headless) as sb:
-                sb.open(verification_link)
-                sb.sleep(randint(1, 2))
-            color_print("Email verified successfully!", color="green")
+            logger.info("Verification link found in the email.")
+            # a page load in a warm browser, no need to start one of our own
+            await get_browser_pool().solve(verification_link)
+            logger.info("Email verified successfully!")
         else:
-            color_print("Verification link not found in the email.", color="red")
+            logger.error("Verification link not found in the email.")
 
     async def _get_api_token(self, email: str):
         """Gets the API token for the user."""
 
-        color_print("--- API TOKEN ---", color="red")
         async with AsyncSession() as session:
             url = "https://beta.theb.ai/api/token"
             payload = {"username": email, "password": self.password}
             headers = self.headers | {"X-Client-Language": "en"}
             response = await session.post(url, data=payload, headers=headers, impersonate="chrome")
-            print("Response Status Code (Token):", response.status_code)
-            print("Response Content (Token):", response.json())
+            # the body holds the access token, only the status is logged
+            logger.debug("Token response %s", response.status_code)
 
             if response.status_code == 200:
                 access_token = response.json()["access_token"]
-                print("Access Token:", access_token)
                 return access_token
             else:
-                print(
-                    "Failed to retrieve API token. Error:",
+                logger.error(
+                    "Failed to retrieve API token. Error: %s",
                     response.json().get("data", {}).get("detail", "Unknown error"),
                 )
                 return
 
     async def _get_organization_id(self, access_token):
-        color_print("--- ORGANIZATION ID ---", color="red")
         async with AsyncSession() as session:
             url = "https://beta.theb.ai/api/me"
             headers = self.headers | {"Authorization": f"Bearer {access_token}", "X-Client-Language": "en"}
             response = await session.get(url, headers=headers, impersonate="chrome")
-            print("Response Status Code (Organization):", response.status_code)
-            print("Response Content (Organization):", response.json())
+            logger.debug("Organization response %s", response.status_code)
             if response.status_code == 200:
-                print("User logged in successfully!")
+                logger.info("User logged in successfully!")
                 organization_id = response.json()["data"]["organizations"][0]["id"]
-                print("Organization ID:", organization_id)
                 return organization_id
             else:
-                print("Failed to Login. Error:", response.json())
+                logger.error("Failed to Login. Error: %s", response.text)
 
-    async def generate_api_token(self):
+    async def generate_api_token(self) -> bool:
         email = await self.generate_email()
-        self._register_user(email)
+        await self._register_user(email)
         await self._verify_email(email)
         api_token = await self._get_api_token(email)
         organization_id = await self._get_organization_id(api_token)
         if api_token is not None and organization_id is not None:
-            print(
-                f"Successfully Initialized.....\nAPI KEY : \033[92m{api_token}\033[0m\nORGANIZATION ID : \033[92m{organization_id}\033[0m"
-            )
-            self.update_file(api_key=api_token, organization_id=organization_id)
-        else:
-            color_print("Failed to initialize. Please try again.", color="red")
+            logger.info("Successfully Initialized organization %s", organization_id)
+            await asyncio.to_thread(self.update_file, api_key=api_token, organization_id=organization_id)
+            return True
+        logger.error("Failed to initialize. Please try again.")
+        return False
 
 
-async def async_generate_api_token(at_once: int = 3):
-    """Generates multiple API tokens concurrently using asyncio."""
+async def async_generate_api_token(at_once: int = 3, workers: int | None = None) -> int:
+    """Registers at_once accounts with up to workers browsers running in parallel, returns how many succeeded."""
 
+    workers = workers or int(os.environ.get("THEB_REGISTER_WORKERS", 3))
+    # spawned processes start clean instead of inheriting the event loop and open sockets of this one
+    browser_pool = ProcessPoolExecutor(max_workers=min(workers, at_once), mp_context=get_context("spawn"))
     try:
-        # Create list of coroutines to run concurrently
-        tasks = [TheB_AI_Register().generate_api_token() for _ in range(at_once)]
-
-        # Run all tasks concurrently and wait for completion
-        await asyncio.gather(*tasks)
-
-        color_print("All API token generation tasks completed successfully.", "green")
-    except Exception as e:
-        color_print(f"Error during API token generation: {str(e)}", "red")
+        results = await asyncio.gather(
+            *[TheB_AI_Register(browser_pool=browser_pool).generate_api_token() for _ in range(at_once)],
+            return_exceptions=True,
+        )
+    finally:
+        # never blocks the event loop, a cancelled refill leaves its running browsers to finish on their own
+        browser_pool.shutdown(wait=False, cancel_futures=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.error("Error during API token generation: %r", result)
+    succeeded = sum(result is True for result in results)
+    logger.info("Generated %s of %s API tokens.", succeeded, at_once)
+    return succeeded
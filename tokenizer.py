@@ -0,0 +1,131 @@
+import asyncio
+import re
+from functools import lru_cache
+from schemas import Message, Usage
+from logger import get_logger
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = get_logger("tokenizer")
+
+# Ordered (substrings, encoding) table, the first matching row wins. The upstreams don't publish their
+# vocabularies, cl100k_base is the closest public one for DeepSeek, Llama, Qwen, Mistral and Claude.
+MODEL_ENCODINGS: tuple[tuple[tuple[str, ...], str], ...] = (
+    (("gpt-4o", "gpt-4.1", "gpt-5", "o1", "o3", "o4"), "o200k_base"),
+)
+DEFAULT_ENCODING = "cl100k_base"
+
+# Pieces the tiktoken pre-tokenizer would produce, used to estimate counts when tiktoken is not installed
+APPROX_PIECES = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]|\s?[^\W\d_]+|\s?\d{1,3}|\s?[^\s\w]+|\s+(?!\S)|\s+")
+
+# OpenAI chat format overhead: every message is wrapped in 3 tokens, the reply is primed with 3 more
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_REPLY_PRIMING = 3
+
+
+@lru_cache(maxsize=None)
+def get_encoding_name(model: str) -> str:
+    for patterns, encoding_name in MODEL_ENCODINGS:
+        if any(pattern in model for pattern in patterns):
+            return encoding_name
+    return DEFAULT_ENCODING
+
+
+# vocabularies loaded by load_encodings, count_tokens estimates for the others
+_encodings: dict[str, object] = {}
+
+
+def _load_encoding(encoding_name: str) -> None:
+    try:
+        _encodings[encoding_name] = tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        # tiktoken downloads the vocabulary on first use, offline hosts end up here
+        logger.warning("tiktoken encoding %s unavailable, estimating token counts: %s", encoding_name, e)
+
+
+async def load_encodings(timeout: float) -> None:
+    """Loads every vocabulary of MODEL_ENCODINGS on threads at startup, waiting at most timeout seconds.
+
+    A download still running after the timeout is used once it completes, counts are estimated until then.
+    """
+    if tiktoken is None:
+        return
+    encoding_names = {DEFAULT_ENCODING} | {encoding_name for _, encoding_name in MODEL_ENCODINGS}
+    loads = [asyncio.to_thread(_load_encoding, encoding_name) for encoding_name in encoding_names]
+    try:
+        await asyncio.wait_for(asyncio.gather(*loads), timeout)
+    except asyncio.TimeoutError:
+        missing = encoding_names - _encodings.keys()
+        logger.warning("tiktoken encodings %s not loaded after %ss, estimating until they are", missing, timeout)
+
+
+def get_encoding(encoding_name: str):
+    """The loaded vocabulary, None falls back to the estimate. Never loads, that would block the event loop."""
+    return _encodings.get(encoding_name)
+
+
+def count_tokens(text: str, model: str) -> int:
+    if not text:
+        return 0
+    encoding = get_encoding(get_encoding_name(model))
+    if encoding is None:
+        # long words split into several tokens, roughly one per 4 characters
+        return sum(1 + (len(piece.strip()) - 1) // 4 if piece.strip() else 1 for piece in APPROX_PIECES.findall(text))
+    return len(encoding.encode_ordinary(text))
+
+
+def get_message_text(message: Message) -> str:
+    content = message.content
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(part.text for part in content if part.text)
+    return "".join(part for part in content.parts if isinstance(part, str))
+
+
+def count_prompt_tokens(messages: list[Message], model: str) -> int:
+    num_tokens = TOKENS_REPLY_PRIMING
+    for message in messages:
+        num_tokens += TOKENS_PER_MESSAGE + count_tokens(message.role or "", model)
+        num_tokens += count_tokens(get_message_text(message), model)
+        if message.name:
+            num_tokens += TOKENS_PER_NAME + count_tokens(message.name, model)
+    return num_tokens
+
+
+class CompletionCounter:
+    """Estimates completion tokens as deltas arrive. Text is only encoded up to the last whitespace, where the
+    pre-tokenizer usually splits, so the running total is close to encoding the whole completion at once but can
+    differ by a few tokens where a merge or a whitespace run spans a boundary."""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.pending = ""
+        self.counted = 0
+
+    def add(self, text_delta: str) -> None:
+        self.pending += text_delta
+        # trailing whitespace stays pending, it may belong to the next word's token
+        head = self.pending.rstrip()
+        boundary = max(head.rfind(" "), head.rfind("\n"))
+        if boundary > 0:
+            self.counted += count_tokens(self.pending[:boundary], self.model)
+            self.pending = self.pending[boundary:]
+
+    @property
+    def total(self) -> int:
+        return self.counted + count_tokens(self.pending, self.model)
+
+
+def get_usage(prompt_tokens: int, completion_tokens: int) -> Usage:
+    return Usage(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
@@ -1,16 +1,36 @@
 import time
 import uuid
 import textwrap
+import anyio
 from ruamel.yaml import YAML
 from ruamel.yaml.scalarstring import DoubleQuotedScalarString
-from typing import Literal
 from fake_useragent import UserAgent
 from schemas import Choices, Message, OpenAiData
+from logger import get_logger
 
+logger = get_logger("utility")
 
-def color_print(text: str, color: Literal["red", "green", "yellow", "blue"]):
-    colors = {"red": "\033[91m", "green": "\033[92m", "yellow": "\033[93m", "blue": "\033[94m"}
-    print(f"{colors[color]}{text}\033[0m")
+
+# Ordered (substrings, vendor) table, the first matching row wins
+MODEL_VENDORS: tuple[tuple[tuple[str, ...], str], ...] = (
+    (("llama",), "Meta"),
+    (("gpt", "o1"), "OpenAI"),
+    (("gemini",), "Google"),
+    (("claude",), "Anthropic"),
+    (("command-r-plus",), "CohereForAI"),
+    (("qwen", "qwq"), "Qwen"),
+    (("hermes",), "NousResearch"),
+    (("mixtral", "mistral"), "MistralAI"),
+    (("phi", "wizardlm"), "Microsoft"),
+    (("deepseek",), "DeepSeek"),
+)
+
+
+def get_model_vendor(model_name: str) -> str:
+    for patterns, vendor in MODEL_VENDORS:
+        if any(pattern in model_name for pattern in patterns):
+            return vendor
+    return ""
 
 
 def get_user_agent(browser: str = None) -> str:
@@ -47,6 +67,19 @@ def get_openai_chunk_response_end(model: str, stream: bool) -> str:
     return f"data: {openai_data.model_dump_json(exclude_unset=True)}\n\ndata: [DONE]\n\n" if stream else ""
 
 
+async def close_upstream(response) -> None:
+    """Drop an upstream stream right away. curl_cffi's Response.aclose waits for the transfer to finish, cancelling
+    its stream task removes the handle from curl instead."""
+    stream_task = getattr(response, "astream_task", None)
+    if stream_task is not None:
+        response.quit_now.set()
+        stream_task.cancel()
+        return
+    # httpx responses, shielded because this runs while the disconnected request is being cancelled
+    with anyio.CancelScope(shield=True):
+        await response.aclose()
+
+
 def update_nextchat_custom_models(models: list[str], delete_models: list[str] = []):
     yaml = YAML()
     yaml.indent(mapping=2, sequence=4, offset=2)
@@ -59,28 +92,7 @@ def update_nextchat_custom_models(models: list[str], delete_models: list[str] =
     current_custom_models = data["services"]["chatgpt-next-web"]["environment"]["CUSTOM_MODELS"].split(",")
 
     def add_company_suffix(model_name: str) -> str:
-        if "llama" in model_name:
-            suffix = "Meta"
-        elif "gpt" in model_name or "o1" in model_name:
-            suffix = "OpenAI"
-        elif "gemini" in model_name:
-            suffix = "Google"
-        elif "claude" in model_name:
-            suffix = "Anthropic"
-        elif "command-r-plus" in model_name:
-            suffix = "CohereForAI"
-        elif "qwen" in model_name or "qwq" in model_name:
-            suffix = "Qwen"
-        elif "hermes" in model_name:
-            suffix = "NousResearch"
-        elif "mixtral" in model_name or "mistral" in model_name:
-            suffix = "MistralAI"
-        elif "phi" in model_name or "wizardlm" in model_name:
-            suffix = "Microsoft"
-        elif "deepseek" in model_name:
-            suffix = "DeepSeek"
-        else:
-            suffix = ""
+        suffix = get_model_vendor(model_name)
         return f"{model_name}@{suffix}" if suffix else model_name
 
     # Add new models
@@ -111,4 +123,4 @@ def update_nextchat_custom_models(models: list[str], delete_models: list[str] =
         file.write(file_content)
 
     open("scripts/update_signal", "w").close()  # Create a signal file to trigger the update
-    color_print("Updated custom models in docker-compose.yml", "green")
+    logger.info("Updated custom models in docker-compose.yml")